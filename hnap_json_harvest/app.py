@@ -1,27 +1,383 @@
 import os
 import json
-import requests
-import boto3
-#import smart_open
-import urllib.request
-import xml.dom.minidom
 import logging
 import datetime
-import boto3.exceptions
+import time
+import threading
+import hashlib
+import gzip
+import zlib
+import re
+import codecs
+import collections
+import contextlib
+import io
+import itertools
+import random
 
 from botocore.exceptions import ClientError
-from xml.dom import minidom
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
-JSON_BUCKET_NAME = os.environ['BUCKET_NAME']
-GEOJSON_BUCKET_NAME = os.environ['GEOJSON_BUCKET_NAME']
-geojson_bucket_name, folder_path = (GEOJSON_BUCKET_NAME.split("/", 1) + [None])[:2]
-BASE_URL = os.environ['BASE_URL']
-GN_JSON_RECORD_URL_START = os.environ['GN_JSON_RECORD_URL_START']
-RUN_INTERVAL_MINUTES = os.environ['RUN_INTERVAL_MINUTES']
+# boto3, requests and the other heavy or rarely used modules are imported on first use, which
+# keeps them out of the cold start of every invocation that does not need them. See get_config for
+# the required settings, they are resolved on the first invocation rather than at import.
+
+def _positive(value):
+    return value > 0
+
+def _non_negative(value):
+    return value >= 0
+
+def _iso_datetime(value):
+    try:
+        datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return False
+    return True
+
+# Optional settings: (name, type, default, check). The type is int, float, bool, str or a tuple of the
+# accepted values. They become the module constants of the same name, which the code reads directly.
+# An invalid value never fails the import: the default is used and load_config reports the setting
+# with the required ones, so the first invocation fails with every problem named.
+TUNING_SETTINGS = (
+    ('HARVEST_WORKERS', int, '8', _positive),
+    ('HTTP_POOL_SIZE', int, '16', _positive),
+    ('S3_POOL_SIZE', int, '16', _positive),
+    ('GN_TIMEOUT_SECONDS', float, '30', _positive),
+    ('GN_MAX_RETRIES', int, '4', _non_negative),
+    ('GN_BACKOFF_BASE_SECONDS', float, '0.5', _non_negative),
+    ('GN_BACKOFF_MAX_SECONDS', float, '20', _non_negative),
+    ('GN_MAX_CONCURRENCY', int, '', _positive), #defaults to HARVEST_WORKERS
+    ('GN_LATENCY_TARGET_MS', float, '2000', _positive),
+    ('RECORD_FORMAT', ('pretty', 'passthrough'), 'pretty', None),
+    ('RECORD_COMPRESSION', ('none', 'gzip', 'zstd'), 'none', None),
+    ('METRICS_NAMESPACE', str, 'HnapJsonHarvest', None),
+    ('HARVEST_PROFILE', bool, 'false', None),
+    ('STATE_BUCKET_NAME', str, '', None),
+    ('STATE_PREFIX', str, 'harvest_state', None),
+    ('CONDITIONAL_FETCH', bool, 'true', None),
+    ('BUNDLE_MODE', bool, 'false', None),
+    ('BUNDLE_PREFIX', str, 'bundles', None),
+    ('BUNDLE_PART_SIZE', int, str(8 * 1024 * 1024), _positive), #raised to the 5 MB minimum of S3 parts
+    ('RUN_REPORT', bool, 'false', None),
+    ('CHECKPOINT_MODE', bool, 'false', None),
+    ('CHANGE_FEED_PAGE_SIZE', int, '0', _non_negative),
+    ('CHANGE_FEED_WINDOW_DAYS', float, '7', _positive),
+    ('CHANGE_FEED_WINDOW_RECORDS', int, '2000', _positive),
+    ('CHANGE_FEED_CONCURRENCY', int, '4', _positive),
+    ('LEASE_STORE', ('s3', 'local', 'none'), 's3', None),
+    ('LEASE_SECONDS', int, '360', _positive), #longer than the Lambda timeout
+    ('DEADLINE_RESERVE_SECONDS', int, '30', _non_negative),
+    ('FULL_RELOAD_START', str, '2000-01-01T00:00:00Z', _iso_datetime),
+    ('FULL_RELOAD_WINDOW_DAYS', int, '30', _positive),
+    ('FULL_RELOAD_RESERVE_SECONDS', int, '90', _non_negative),
+    ('FULL_RELOAD_SELF_INVOKE', bool, 'true', None),
+    ('FULL_RELOAD_STALE_MINUTES', int, '30', _positive),
+    ('FANOUT_THRESHOLD', int, '0', _non_negative),
+    ('FANOUT_SHARD_SIZE', int, '500', _positive),
+    ('FANOUT_CONCURRENCY', int, '10', _positive),
+    ('FANOUT_DISPATCHER', ('lambda', 'process'), 'lambda', None),
+    ('HARVEST_QUEUE_URL', str, '', None),
+    ('RECONCILE_LIST_WORKERS', int, '16', _positive),
+    ('RECONCILE_MAX_ORPHAN_RATIO', float, '0.1', _non_negative),
+)
+
+def parse_setting(kind, raw):
+    """ Value of an optional setting of the given TUNING_SETTINGS type, None for an empty number.
+    Raises ValueError if raw is not a valid value """
+    
+    if kind is bool:
+        if raw.lower() not in ('true', 'false'):
+            raise ValueError(raw + " is not true or false")
+        return raw.lower() == 'true'
+    if isinstance(kind, tuple):
+        if raw.lower() not in kind:
+            raise ValueError(raw + " is not one of " + ", ".join(kind))
+        return raw.lower()
+    if kind is str:
+        return raw
+    if not raw:
+        return None
+    try:
+        return kind(raw)
+    except ValueError:
+        raise ValueError(raw + " is not a number")
+
+def load_tuning(environ=None):
+    """ Read the optional settings of TUNING_SETTINGS
+    
+    :param environ: mapping of environment variables, defaults to os.environ
+    :return: (dict of setting name to value, list of error messages). An invalid setting has its default value
+    """
+    
+    if environ is None:
+        environ = os.environ
+    values = {}
+    errors = []
+    for name, kind, default, check in TUNING_SETTINGS:
+        raw = environ.get(name, '').strip() or default
+        try:
+            value = parse_setting(kind, raw)
+            if value is not None and check is not None and not check(value):
+                raise ValueError(raw + " is out of range")
+        except ValueError as e:
+            errors.append(name + " is invalid: " + str(e))
+            value = parse_setting(kind, default)
+        values[name] = value
+    if values['GN_MAX_CONCURRENCY'] is None:
+        values['GN_MAX_CONCURRENCY'] = values['HARVEST_WORKERS']
+    values['BUNDLE_PART_SIZE'] = max(5 * 1024 * 1024, values['BUNDLE_PART_SIZE'])
+    return values, errors
+
+_tuning = load_tuning()[0]
+HARVEST_WORKERS = _tuning['HARVEST_WORKERS']
+HTTP_POOL_SIZE = _tuning['HTTP_POOL_SIZE']
+S3_POOL_SIZE = _tuning['S3_POOL_SIZE']
+GN_TIMEOUT_SECONDS = _tuning['GN_TIMEOUT_SECONDS']
+GN_MAX_RETRIES = _tuning['GN_MAX_RETRIES']
+GN_BACKOFF_BASE_SECONDS = _tuning['GN_BACKOFF_BASE_SECONDS']
+GN_BACKOFF_MAX_SECONDS = _tuning['GN_BACKOFF_MAX_SECONDS']
+GN_MAX_CONCURRENCY = _tuning['GN_MAX_CONCURRENCY']
+GN_LATENCY_TARGET_MS = _tuning['GN_LATENCY_TARGET_MS']
+RECORD_FORMAT = _tuning['RECORD_FORMAT']
+RECORD_COMPRESSION = _tuning['RECORD_COMPRESSION']
+METRICS_NAMESPACE = _tuning['METRICS_NAMESPACE']
+HARVEST_PROFILE = _tuning['HARVEST_PROFILE']
+STATE_BUCKET_NAME = _tuning['STATE_BUCKET_NAME']
+STATE_PREFIX = _tuning['STATE_PREFIX']
+CONDITIONAL_FETCH = _tuning['CONDITIONAL_FETCH']
+BUNDLE_MODE = _tuning['BUNDLE_MODE']
+BUNDLE_PREFIX = _tuning['BUNDLE_PREFIX']
+BUNDLE_PART_SIZE = _tuning['BUNDLE_PART_SIZE']
+RUN_REPORT = _tuning['RUN_REPORT']
+CHECKPOINT_MODE = _tuning['CHECKPOINT_MODE']
+CHANGE_FEED_PAGE_SIZE = _tuning['CHANGE_FEED_PAGE_SIZE']
+CHANGE_FEED_WINDOW_DAYS = _tuning['CHANGE_FEED_WINDOW_DAYS']
+CHANGE_FEED_WINDOW_RECORDS = _tuning['CHANGE_FEED_WINDOW_RECORDS']
+CHANGE_FEED_CONCURRENCY = _tuning['CHANGE_FEED_CONCURRENCY']
+LEASE_STORE = _tuning['LEASE_STORE']
+LEASE_SECONDS = _tuning['LEASE_SECONDS']
+DEADLINE_RESERVE_SECONDS = _tuning['DEADLINE_RESERVE_SECONDS']
+FULL_RELOAD_START = _tuning['FULL_RELOAD_START']
+FULL_RELOAD_WINDOW_DAYS = _tuning['FULL_RELOAD_WINDOW_DAYS']
+FULL_RELOAD_RESERVE_SECONDS = _tuning['FULL_RELOAD_RESERVE_SECONDS']
+FULL_RELOAD_SELF_INVOKE = _tuning['FULL_RELOAD_SELF_INVOKE']
+FULL_RELOAD_STALE_MINUTES = _tuning['FULL_RELOAD_STALE_MINUTES']
+FANOUT_THRESHOLD = _tuning['FANOUT_THRESHOLD']
+FANOUT_SHARD_SIZE = _tuning['FANOUT_SHARD_SIZE']
+FANOUT_CONCURRENCY = _tuning['FANOUT_CONCURRENCY']
+FANOUT_DISPATCHER = _tuning['FANOUT_DISPATCHER']
+HARVEST_QUEUE_URL = _tuning['HARVEST_QUEUE_URL']
+RECONCILE_LIST_WORKERS = _tuning['RECONCILE_LIST_WORKERS']
+RECONCILE_MAX_ORPHAN_RATIO = _tuning['RECONCILE_MAX_ORPHAN_RATIO']
+
+GN_RETRY_STATUS = (429, 500, 502, 503, 504)
+DELETE_BATCH_SIZE = 1000 #maximum number of keys accepted by DeleteObjects
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+MANIFEST_NAME = "manifest.json.gz"
+VALIDATORS_NAME = "validators.json.gz"
+BUNDLE_SETTLE_MINUTES = 5 #run bundles closed more recently than this are left for the next compaction
+SNAPSHOT_NAME = "bundle_snapshot.json"
+WATERMARK_NAME = "watermark.json"
+CHANGE_FEED_CHUNK_SIZE = 64 * 1024
+CHANGE_FEED_MIN_WINDOW_MINUTES = 60 #a window that cannot be read is split in halves down to this width
+CHANGE_FEED_MAX_SPLITS = 2 #and at most this many times
+FULL_RELOAD_NAME = "full_reload.json"
+PENDING_NAME = "pending.json"
+LEASES_NAME = "leases/%s.json.gz" #one lease object per leading hex digit of the uuid, see lease_shard
+LEASE_CLAIM_CHUNK_SIZE = 1000 #uuids of a streamed list claimed with one write of the lease store
+LAMBDA_READ_TIMEOUT = 910 #longer than the maximum Lambda timeout, a worker is waited for until it returns
+QUEUE_ACTIONS = ("insert", "delete")
+QUEUE_SEND_BATCH_SIZE = 10 #maximum number of messages accepted by SendMessageBatch
+LIST_PARTITION_BOUNDARIES = "123456789abcdef" #uuids are hex, one listing per leading digit
+
+GN_CHANGE_API_PATH = "/geonetwork/srv/api/0.1/records/status/change"
+GN_JSON_RECORD_URL_END = "/formatters/json?addSchemaLocation=true&attachment=false&withInfo=false" #other flags: increasePopularity
+BUCKET_LOCATION = "ca-central-1"
+
+# Harvest outcome of a single record
+HARVESTED = "harvested"
+SKIPPED = "skipped"
+
+class ConfigError(ValueError):
+    """ Missing or invalid setting """
+
+HarvestConfig = collections.namedtuple('HarvestConfig', [
+    'json_bucket_name', 'geojson_bucket_name', 'base_url', 'gn_json_record_url_start', 'run_interval_minutes'])
+HarvestConfig.__doc__ = """ Required settings: the JSON and GeoJSON 'bucket[/folder]' names, the GeoNetwork base URL,
+the start of the GeoNetwork record URL and the lookback of scheduled runs in minutes """
+
+_config = None
+
+# Clients shared by every invocation of a warm Lambda container, see get_http_session/get_s3_client
+_clients = {}
+_clients_lock = threading.Lock()
+_verified_buckets = set()
+# uuid -> content digest of the last record written, cached on warm containers, see load_manifest
+_manifest_cache = {"etag": None, "data": {}}
+# uuid -> ETag/Last-Modified of the GeoNetwork record last fetched, see load_validators
+_validator_cache = {"etag": None, "data": {}}
+
+class RunMetrics:
+    """ Metrics of a single run: phase durations, counters and latency histograms
+    
+    Thread safe, the harvest workers record into the same instance. emit() prints the run as one
+    CloudWatch Embedded Metric Format (EMF) record: every phase duration and counter becomes a metric,
+    histograms are summarised as p50/p99/max metrics and kept in full as structured properties.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.phases = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.histograms = collections.OrderedDict()
+        self.dimensions = collections.OrderedDict()
+    
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Time the enclosed block, durations of the same phase add up """
+        
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_duration(name, time.perf_counter() - start)
+    
+    def add_duration(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds * 1000.0
+    
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def observe(self, name, seconds):
+        """ Add a latency sample to the histogram name """
+        
+        ms = seconds * 1000.0
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {"counts": [0] * (len(LATENCY_BUCKETS_MS) + 1), "count": 0, "sum": 0.0, "max": 0.0}
+            index = len(LATENCY_BUCKETS_MS)
+            for i, bound in enumerate(LATENCY_BUCKETS_MS):
+                if ms <= bound:
+                    index = i
+                    break
+            histogram["counts"][index] += 1
+            histogram["count"] += 1
+            histogram["sum"] += ms
+            histogram["max"] = max(histogram["max"], ms)
+    
+    def set_dimension(self, name, value):
+        with self.lock:
+            self.dimensions[name] = str(value)
+    
+    @staticmethod
+    def histogram_percentile(histogram, pct):
+        """ Upper bound of the bucket holding the pct percentile, the max for the overflow bucket """
+        
+        rank = pct / 100.0 * histogram["count"]
+        seen = 0
+        for i, count in enumerate(histogram["counts"]):
+            seen += count
+            if count and seen >= rank:
+                return min(LATENCY_BUCKETS_MS[i], histogram["max"]) if i < len(LATENCY_BUCKETS_MS) else histogram["max"]
+        return histogram["max"]
+    
+    def to_emf(self):
+        """ Return the run as an EMF record (dict) """
+        
+        with self.lock:
+            record = collections.OrderedDict()
+            metrics = []
+            record.update(self.dimensions)
+            self.phases["Total"] = (time.perf_counter() - self.start) * 1000.0
+            for name, ms in self.phases.items():
+                record[name + "Duration"] = round(ms, 3)
+                metrics.append({"Name": name + "Duration", "Unit": "Milliseconds"})
+            for name, value in self.counters.items():
+                record[name] = value
+                unit = "Bytes" if name.startswith("Bytes") else "Count"
+                metrics.append({"Name": name, "Unit": unit})
+            for name, histogram in self.histograms.items():
+                if not histogram["count"]:
+                    continue
+                for suffix, value in (("P50", self.histogram_percentile(histogram, 50)),
+                                      ("P99", self.histogram_percentile(histogram, 99)),
+                                      ("Max", histogram["max"])):
+                    record[name + "Latency" + suffix] = round(value, 3)
+                    metrics.append({"Name": name + "Latency" + suffix, "Unit": "Milliseconds"})
+                record[name + "LatencyHistogram"] = {
+                    "BucketsMs": list(LATENCY_BUCKETS_MS) + ["+Inf"],
+                    "Counts": list(histogram["counts"]),
+                    "Count": histogram["count"],
+                    "SumMs": round(histogram["sum"], 3),
+                }
+            record["_aws"] = {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [list(self.dimensions)],
+                    "Metrics": metrics,
+                }],
+            }
+            return record
+    
+    def emit(self):
+        """ Print the EMF record, CloudWatch Logs extracts the metrics from the Lambda log """
+        
+        print(json.dumps(self.to_emf()))
+
+_run_metrics = RunMetrics()
+
+def metrics():
+    """ Metrics of the current run """
+    
+    return _run_metrics
+
+def start_run_metrics():
+    """ Start recording the metrics of a new run """
+    
+    global _run_metrics
+    _run_metrics = RunMetrics()
+    _run_metrics.set_dimension("FunctionName", os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'hnap_json_harvest'))
+    return _run_metrics
 
 def lambda_handler(event, context):
     """
     AWS Lambda Entry
+    
+    Runs handle_event, or handle_queue_event for a batch of SQS messages, and emits the metrics of the run. With HARVEST_PROFILE=true the run is
+    profiled and the 30 most expensive functions (cumulative time) are printed.
+    """
+    
+    run_metrics = start_run_metrics()
+    profiler = None
+    if HARVEST_PROFILE:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if isinstance(event, dict) and "Records" in event:
+            return handle_queue_event(event, context)
+        return handle_event(event, context)
+    except Exception:
+        run_metrics.count("RunErrors")
+        raise
+    finally:
+        if profiler:
+            import pstats
+            profiler.disable()
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(30)
+            print(report.getvalue())
+        run_metrics.emit()
+
+def handle_event(event, context):
+    """
+    Harvest according to the query string parameters of event, see README
     """
     #print(event)
     
@@ -29,21 +385,34 @@ def lambda_handler(event, context):
     #base_url = "https://maps.canada.ca"
     #gn_json_record_url_start = "https://maps.canada.ca/geonetwork/srv/api/0.1/records/"
     
-    base_url = BASE_URL
-    gn_change_api_url = "/geonetwork/srv/api/0.1/records/status/change"    
-    gn_json_record_url_start = GN_JSON_RECORD_URL_START
-    gn_json_record_url_end = "/formatters/json?addSchemaLocation=true&attachment=false&withInfo=false" #other flags: increasePopularity
-    bucket_location = "ca-central-1"
-    bucket = JSON_BUCKET_NAME #redacted
+    config = get_config()
+    base_url = config.base_url
+    gn_change_api_url = GN_CHANGE_API_PATH
+    gn_json_record_url_start = config.gn_json_record_url_start
+    gn_json_record_url_end = GN_JSON_RECORD_URL_END
+    bucket_location = BUCKET_LOCATION
+    bucket = config.json_bucket_name #redacted
     bucket, bucket_folder_path = (bucket.split("/", 1) + [None])[:2]
-    print(bucket, " ", bucket_folder_path)
-    geojson_bucket_name = GEOJSON_BUCKET_NAME
-    geojson_bucket_name, folder_path = (geojson_bucket_name.split("/", 1) + [None])[:2]
-    run_interval_minutes = int(RUN_INTERVAL_MINUTES)
+    geojson_bucket_name, folder_path = geojson_location(config)
+    run_interval_minutes = config.run_interval_minutes
     err_msg = None
     err_msg_2 = None
     uuid_list = []
     uuid_deleted_list = []
+    checkpoint = None
+    latest = None
+    scheduled = False
+    feed = None
+    feed_error = None
+    full_reload_status = None
+    bundle = None
+    bundle_status = None
+    report = None
+    report_url = None
+    pending = None
+    pending_count = 0
+    harvest_stats = {"harvested": 0, "skipped": 0, "failed": 0, "failures": {}, "pending": []}
+    delete_stats = {"deleted": 0, "failed": 0, "failures": {}, "pending": []}
     
     """ 
     Parse query string parameters 
@@ -53,6 +422,16 @@ def lambda_handler(event, context):
         verbose = event["queryStringParameters"]["verbose"]
     except:
         verbose = False
+    
+    try:
+        force = event["queryStringParameters"]["force"] == "true"
+    except:
+        force = False
+    
+    try:
+        restart = event["queryStringParameters"]["restart"] == "true"
+    except:
+        restart = False
         
     try:
         runtype = event["queryStringParameters"]["runtype"]
@@ -85,10 +464,10 @@ def lambda_handler(event, context):
             toDateTime = False
     except:
         toDateTime = False
-        
-    #run_interval_minutes
-    if run_interval_minutes == None or run_interval_minutes == "":
-        run_interval_minutes = 11
+    
+    #Per-uuid outcomes go to a report object, the response only carries the counts
+    if (verbose == "true" or RUN_REPORT) and runtype != "compact":
+        report = open_run_report()
     
     """ 
     Construct the body of the response object 
@@ -102,415 +481,2654 @@ def lambda_handler(event, context):
     elif runtype == "delete_uuid" and uuid:
         message = "Deleting a list of JSON records..."
         uuid_deleted_list = [uuid]
+    elif runtype == "worker":
+        message = "Harvesting a shard of JSON records..."
+        uuid_list = list((event.get("shard") or {}).get("insert", []))
+    elif runtype == "compact":
+        message = "Compacting the run bundles..."
+        with metrics().phase("Compact"):
+            snapshot = compact_bundles(bucket, bucket_folder_path=bucket_folder_path)
+        if snapshot:
+            bundle_status = "...snapshot of " + str(snapshot["records"]) + " record(s) written to " + str(snapshot["key"])
+        else:
+            bundle_status = "...no new run bundle to compact"
+    elif runtype == "reconcile":
+        message = "Reconciling the JSON records with the catalogue..."
+        #Missing records may still be in the manifest, they are uploaded whatever their digest
+        force = True
+        #Like a partially read change feed, the missing records are harvested but the run is reported as failed
+        with metrics().phase("Reconcile"):
+            feed_error, uuid_list, uuid_deleted_list = reconcile(base_url + gn_change_api_url, bucket, geojson_bucket_name,
+                                                                 bucket_folder_path=bucket_folder_path,
+                                                                 geojson_folder_path=folder_path)
+        if uuid_list or uuid_deleted_list or not feed_error:
+            message += "..." + str(len(uuid_list)) + " missing and " + str(len(uuid_deleted_list)) + " orphaned record(s) found"
+    elif runtype == "full":
+        message = "Reloading all JSON records..."
+        #One bundle for every window reloaded by this invocation, closed with the bundles of the other runs below
+        if BUNDLE_MODE:
+            bundle = open_run_bundle(bucket, bucket_folder_path)
+        with metrics().phase("FullReload"):
+            err_msg, harvest_stats, delete_stats, full_reload_status = run_full_reload(
+                base_url + gn_change_api_url, gn_json_record_url_start, gn_json_record_url_end, bucket, bucket_location,
+                geojson_bucket_name, bucket_folder_path=bucket_folder_path, geojson_folder_path=folder_path,
+                context=context, restart=restart, force=force,
+                report=report, bundle=bundle)
     elif fromDateTime and toDateTime:
         message = "Reloading JSON records from: " + fromDateTime + " to" + toDateTime + "..."
-        uuid_list,uuid_deleted_list = get_fromtoDateTime_uuids_list(base_url + gn_change_api_url, fromDateTime, toDateTime)
+        feed = open_change_feed(base_url + gn_change_api_url, fromDateTime=fromDateTime, toDateTime=toDateTime)
     elif fromDateTime:
         message = "Reloading JSON records from: " + fromDateTime + "..."
-        uuid_list,uuid_deleted_list = get_fromDateTime_uuids_list(base_url + gn_change_api_url, fromDateTime)
+        feed = open_change_feed(base_url + gn_change_api_url, fromDateTime=fromDateTime)
     elif toDateTime:
         message = "Reloading JSON records to: " + toDateTime + "..."
-        uuid_list, uuid_deleted_list = get_toDateTime_uuids_list(base_url + gn_change_api_url, toDateTime)
+        feed = open_change_feed(base_url + gn_change_api_url, toDateTime=toDateTime)
     else:
-        fromDateTime = datetime.datetime.utcnow().now() - datetime.timedelta(minutes=run_interval_minutes)
-        fromDateTime = fromDateTime.isoformat()[:-7] + 'Z'
-        message = "Default setting. Harvesting JSON records from: " + fromDateTime + "..."
-        uuid_list, uuid_deleted_list = get_fromDateTime_uuids_list(base_url + gn_change_api_url, fromDateTime)
+        scheduled = True
+        checkpoint = load_watermark() if CHECKPOINT_MODE else None
+        if checkpoint:
+            fromDateTime = checkpoint
+            message = "Checkpoint setting. Harvesting JSON records from: " + fromDateTime + "..."
+        else:
+            fromDateTime = datetime.datetime.utcnow().now() - datetime.timedelta(minutes=run_interval_minutes)
+            fromDateTime = fromDateTime.isoformat()[:-7] + 'Z'
+            message = "Default setting. Harvesting JSON records from: " + fromDateTime + "..."
+            #First checkpoint run: start the watermark at the lookback window
+            checkpoint = fromDateTime if CHECKPOINT_MODE else None
+        feed = open_change_feed(base_url + gn_change_api_url, fromDateTime=fromDateTime)
 
-    if len(uuid_list) > 0:
-        err_msg = harvest_uuids(uuid_list, gn_json_record_url_start, gn_json_record_url_end, bucket, bucket_location, bucket_folder_path=bucket_folder_path)
+    metrics().set_dimension("RunType", runtype or ("scheduled" if scheduled else "reload"))
+    
+    if feed is not None:
+        #Classify the whole feed first so records deleted later in the feed are never fetched
+        with metrics().phase("ChangeFeed"):
+            changes = feed.classify()
+        uuid_list, uuid_deleted_list, latest = sorted(changes.inserted), sorted(changes.deleted), changes.latest
+        feed_error = changes.error
+        #Work left by runs that hit their deadline goes first
+        pending = load_pending()
+        if pending["insert"] or pending["delete"]:
+            uuid_list, uuid_deleted_list = merge_pending(pending, changes)
+        
+    if feed is not None and HARVEST_QUEUE_URL and (uuid_list or uuid_deleted_list):
+        #Producer: the records are harvested by the invocations consuming the queue
+        with metrics().phase("Enqueue"):
+            queued, not_queued = enqueue_changes(uuid_list, uuid_deleted_list)
+        message += "..." + str(queued) + " record(s) queued"
+        if not_queued:
+            err_msg = "Could not queue " + str(len(not_queued)) + " record(s)"
+            harvest_stats["failures"].update(not_queued)
+        uuid_list, uuid_deleted_list = [], []
+    
+    if BUNDLE_MODE and bundle is None and (uuid_list or uuid_deleted_list):
+        bundle = open_run_bundle(bucket, bucket_folder_path)
+    
+    if runtype != "worker" and fan_out_due(uuid_list):
+        #Coordinator: the records are harvested by worker invocations, deletes stay here (1000 per call)
+        with metrics().phase("FanOut"):
+            err_msg, harvest_stats = fan_out(uuid_list, get_dispatcher(context), force=force, report=report, context=context)
+    elif len(uuid_list) > 0:
+        with metrics().phase("Harvest"):
+            err_msg, harvest_stats = harvest_uuids(uuid_list, gn_json_record_url_start, gn_json_record_url_end, bucket, bucket_location, bucket_folder_path=bucket_folder_path, force=force, context=context, bundle=bundle, report=report)
     
     if len(uuid_deleted_list) > 0:
-        err_msg_2 = delete_uuids(uuid_deleted_list, geojson_bucket_name, folder_path=bucket_folder_path)
+        with metrics().phase("Delete"):
+            err_msg_2, delete_stats = delete_uuids(uuid_deleted_list, geojson_bucket_name, folder_path=folder_path, context=context, report=report)
+    
+    pending_insert, pending_delete = list(harvest_stats.get("pending", [])), list(delete_stats.get("pending", []))
+    pending_count = len(pending_insert) + len(pending_delete)
+    if feed is not None:
+        #Failed uuids (drained ones included) stay pending, the watermark moves past them
+        pending_insert += list(harvest_stats["failures"])
+        pending_delete += list(delete_stats["failures"])
+    pending_saved = True
+    
+    if bundle is not None:
+        bundle_status, bundle_error = finish_run_bundle(bundle, bucket_folder_path,
+                                                        deleted_uuids(uuid_deleted_list, delete_stats))
+        err_msg = err_msg or bundle_error
+    if pending_insert or pending_delete or (pending and (pending["insert"] or pending["delete"])):
+        #Stopped before the deadline: keep what was not reached for the next run
+        with metrics().phase("Pending"):
+            pending_saved = save_pending(pending_insert, pending_delete, drained=pending)
+            if not pending_saved:
+                err_msg = err_msg or "Could not save " + str(len(pending_insert) + len(pending_delete)) + " pending record(s)"
+        
+    #A partially read change feed is harvested, but the run is reported as failed
+    err_msg = err_msg or feed_error
+        
+    if checkpoint and not feed_error and pending_saved:
+        #The failed records are retried from pending, only an unread feed is retried from the same mark
+        with metrics().phase("Watermark"):
+            save_watermark(latest or checkpoint)
+    
+    if scheduled and not err_msg and not err_msg_2 and not pending_count and full_reload_handoff_due(load_full_reload_cursor()[0]):
+        #Hand off: spend the rest of the scheduled run on the pending full reload
+        reload_bundle = open_run_bundle(bucket, bucket_folder_path) if BUNDLE_MODE else None
+        with metrics().phase("FullReload"):
+            err_msg, reload_harvest_stats, reload_delete_stats, full_reload_status = run_full_reload(
+                base_url + gn_change_api_url, gn_json_record_url_start, gn_json_record_url_end, bucket, bucket_location,
+                geojson_bucket_name, bucket_folder_path=bucket_folder_path, geojson_folder_path=folder_path,
+                context=context, report=report,
+                bundle=reload_bundle)
+        merge_stats(harvest_stats, reload_harvest_stats)
+        merge_stats(delete_stats, reload_delete_stats)
+        if reload_bundle is not None:
+            reload_bundle_status, bundle_error = finish_run_bundle(reload_bundle, bucket_folder_path)
+            bundle_status = (bundle_status or "") + (reload_bundle_status or "") or None
+            err_msg = err_msg or bundle_error
         
     if not err_msg and not err_msg_2:
-        message += "..." + str(len(uuid_list)) + " record(s) harvested into " + bucket
-        message += "..." + str(len(uuid_deleted_list)) + " record(s) deleted from " + geojson_bucket_name
-        if verbose == "true" and len(uuid_list) >0:
-            message += '"uuid": ['
-            for i in range(len(uuid_list)):
-                #JSON format does not allow trailing commas for the last item of an array
-                #See: https://www.json.org/json-en.html
-                #Append comma if not the first element 
-                if i:
-                    message += ","
-                message += "{" + uuid_list[i] + "}"
-            message += "]"
+        message += "..." + str(harvest_stats["harvested"]) + " record(s) harvested into " + bucket
+        message += "..." + str(harvest_stats["skipped"]) + " unchanged record(s) skipped"
+        message += "..." + str(delete_stats["deleted"]) + " record(s) deleted from " + geojson_bucket_name
+        if pending_count:
+            message += "..." + str(pending_count) + " record(s) left for the next run"
     else:
-        message += "... some error occured:" + err_msg
+        message += "... some error occured:" + str(err_msg or err_msg_2)
+    if full_reload_status:
+        message += full_reload_status
+    if bundle_status:
+        message += bundle_status
+    
+    if report is not None:
+        try:
+            with metrics().phase("Report"):
+                report_url = report.close({
+                    "runType": runtype or ("scheduled" if scheduled else "reload"),
+                    "fromDateTime": fromDateTime,
+                    "harvested": harvest_stats["harvested"],
+                    "skipped": harvest_stats["skipped"],
+                    "failed": harvest_stats["failed"] + delete_stats["failed"],
+                    "deleted": delete_stats["deleted"],
+                    "pending": pending_count,
+                })
+            message += "...report written to " + report_url
+        except Exception as e:
+            logging.error("Could not write the run report: %s", e)
+            message += "...could not write the run report"
             
+    body = {
+        "fromDateTime": fromDateTime,
+        "harvestCount": str(harvest_stats["harvested"]),
+        "skippedCount": str(harvest_stats["skipped"]),
+        "failedCount": str(harvest_stats["failed"]),
+        "deleteCount": str(delete_stats["deleted"]),
+        "deleteFailedCount": str(delete_stats["failed"]),
+        "pendingCount": str(pending_count),
+        "message": message,
+    }
+    if report_url:
+        body["report"] = report_url
+    if runtype == "worker":
+        #The coordinator aggregates the failures of every shard
+        body["failures"] = harvest_stats["failures"]
     response = {
         "statusCode": "200",
         "headers": {"Content-type": "application/json"},
-        "body": json.dumps(
-            {
-                "fromDateTime": fromDateTime,
-                "harvestCount": str(len(uuid_list)),
-                "message": message,
-            }
-        ),
+        "body": json.dumps(body),
     }
     return response
 
-def datetime_valid(dt_str):
-    """
-    Check to see if user supplied a valid datetime 
-    in ISO:8601 UTC time with +00:00 or 'Z' 
-    https://stackoverflow.com/a/61569783
+def parse_queue_message(record):
+    """ Read the uuid and the action of an SQS message, whose body is {"uuid": ..., "action": "insert" or "delete"}
     
+    :return: (uuid, action). Raises ValueError if the body is not a valid message
     """
-    try:
-        datetime.datetime.fromisoformat(dt_str)
-    except:
-        try:
-            datetime.datetime.fromisoformat(dt_str.replace('Z', '+00:00'))
-        except:
-            print("fromDateTime is not a valid ISO:8601 UTC datetime with +00:00 or 'Z' ")
-            return False
-        return True
-    return True
     
-def convert_to_datetime(dt_str):
+    body = json.loads(record["body"])
+    if not isinstance(body, dict) or not isinstance(body.get("uuid"), str) or not body["uuid"]:
+        raise ValueError("Message without a uuid")
+    action = body.get("action", "insert")
+    if action not in QUEUE_ACTIONS:
+        raise ValueError("Unknown action: " + str(action))
+    return body["uuid"], action
+
+def handle_queue_event(event, context):
     """
-    Check to see if user supplied a valid datetime and returns it as a datetime object
-    in ISO:8601 UTC time with +00:00 or 'Z' 
-    https://stackoverflow.com/a/61569783
+    Harvest or delete the records of a batch of SQS messages
     
+    The inserts are harvested and the deletes applied concurrently, by harvest_uuids and delete_uuids.
+    A uuid sent several times in the batch gets the action of its last message. The messages of the
+    records that failed, that were not reached before the deadline or that cannot be read are returned
+    in batchItemFailures (a record without messageId is skipped), so only they are delivered again (requires ReportBatchItemFailures on the
+    event source mapping). With BUNDLE_MODE, each batch writes a run bundle.
     """
     
-    try:
-        dt_str = datetime.datetime.fromisoformat(dt_str)
-    except:
+    config = get_config()
+    bucket, bucket_folder_path = (config.json_bucket_name.split("/", 1) + [None])[:2]
+    geojson_bucket_name, geojson_folder_path = geojson_location(config)
+    metrics().set_dimension("RunType", "queue")
+    
+    failed_ids = []
+    actions = {}
+    message_ids = collections.defaultdict(list)
+    for record in event["Records"]:
+        message_id = record.get("messageId")
+        if not message_id:
+            #Without an id the message cannot be reported for redelivery, SQS always sends one
+            logging.error("Skipping a queue record without messageId: %s", record.get("body"))
+            metrics().count("MessageErrors")
+            continue
         try:
-            dt_str = datetime.datetime.fromisoformat(dt_str.replace('Z', '+00:00'))
-        except:
-            print("fromDateTime is not a valid ISO:8601 UTC datetime with +00:00 or 'Z' ")
-            return False
-        return dt_str
-    return dt_str
+            uuid, action = parse_queue_message(record)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error("Could not read message %s: %s", message_id, e)
+            metrics().count("MessageErrors")
+            failed_ids.append(message_id)
+            continue
+        actions[uuid] = action
+        message_ids[uuid].append(message_id)
+    metrics().count("Messages", len(event["Records"]))
     
-def get_toDateTime_uuids_list(gn_change_query, toDateTime):
-    """ Get a list of insert/deleted/modified uuids from toDateTime
-    :param gn_change_query: URL of the GeoNetwork change api
-    :param toDateTime: datetime of when to harvest
-    :return: a list of uuids to harvest
+    uuid_list = [uuid for uuid, action in actions.items() if action == "insert"]
+    uuid_deleted_list = [uuid for uuid, action in actions.items() if action == "delete"]
+    harvest_stats = {"harvested": 0, "skipped": 0, "failed": 0, "failures": {}, "pending": []}
+    delete_stats = {"deleted": 0, "failed": 0, "failures": {}, "pending": []}
+    bundle = open_run_bundle(bucket, bucket_folder_path) if BUNDLE_MODE and actions else None
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        harvest_future = delete_future = None
+        if uuid_list:
+            harvest_future = executor.submit(harvest_uuids, uuid_list, config.gn_json_record_url_start,
+                                             GN_JSON_RECORD_URL_END, bucket, BUCKET_LOCATION,
+                                             bucket_folder_path=bucket_folder_path, context=context, bundle=bundle)
+        if uuid_deleted_list:
+            delete_future = executor.submit(delete_uuids, uuid_deleted_list, geojson_bucket_name,
+                                            folder_path=geojson_folder_path, context=context)
+        with metrics().phase("Harvest"):
+            if harvest_future is not None:
+                _, harvest_stats = harvest_future.result()
+        with metrics().phase("Delete"):
+            if delete_future is not None:
+                _, delete_stats = delete_future.result()
+    if bundle is not None:
+        #The messages were handled, a bundle that cannot be written is only logged
+        finish_run_bundle(bundle, bucket_folder_path, deleted_uuids(uuid_deleted_list, delete_stats))
+    
+    not_done = set(harvest_stats["failures"]).union(harvest_stats["pending"], delete_stats["failures"], delete_stats["pending"])
+    for uuid in sorted(not_done):
+        failed_ids.extend(message_ids[uuid])
+    print("Queue batch:", len(event["Records"]), "messages,", harvest_stats["harvested"], "harvested,",
+          harvest_stats["skipped"], "skipped,", delete_stats["deleted"], "deleted,", len(failed_ids), "to retry")
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_ids]}
+
+def enqueue_changes(uuid_list, uuid_deleted_list, queue_url=None):
+    """ Send one message per record to the harvest queue, see handle_queue_event
+    
+    :param uuid_list: uuids to harvest
+    :param uuid_deleted_list: uuids to delete
+    :param queue_url: URL of the SQS queue, defaults to HARVEST_QUEUE_URL
+    :return: (number of messages sent, dict of uuid to the reason it could not be sent)
     """
     
-    uuid_list = []
-    uuid_deleted_list=[]
+    queue_url = queue_url or HARVEST_QUEUE_URL
+    messages = [(uuid, "insert") for uuid in uuid_list] + [(uuid, "delete") for uuid in uuid_deleted_list]
+    batches = [messages[i:i + QUEUE_SEND_BATCH_SIZE] for i in range(0, len(messages), QUEUE_SEND_BATCH_SIZE)]
     
-    try:
-        #Use the build in toDateTime functionality in the GN change API
-        gn_change_filter = "dateTo=" + toDateTime
-        gn_change_query = gn_change_query + "?" + gn_change_filter
-        #print (gn_change_query)
+    def send(batch):
+        entries = [{"Id": str(i), "MessageBody": json.dumps({"uuid": uuid, "action": action})}
+                   for i, (uuid, action) in enumerate(batch)]
+        response = get_sqs_client().send_message_batch(QueueUrl=queue_url, Entries=entries)
+        return {batch[int(failure["Id"])][0]: failure.get("Message") or failure.get("Code", "not sent")
+                for failure in response.get("Failed", [])}
+    
+    sent = 0
+    not_sent = {}
+    for batch, failures, e in run_bounded(send, batches, HARVEST_WORKERS):
+        if e is not None:
+            logging.error(e)
+            failures = {uuid: str(e) for uuid, _ in batch}
+        sent += len(batch) - len(failures)
+        not_sent.update(failures)
+    metrics().count("MessagesSent", sent)
+    return sent, not_sent
 
-        headers = { 
-                "Content-Type": "application/json; charset=utf-8",
-                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-            }
-        response = requests.get(gn_change_query, headers=headers)
-        str_data = json.loads(response.text)
-
-        for metadata in str_data['records']:
-            lastdatetime = metadata['lastModifiedTime']
-            modification = metadata['status']
-            if convert_to_datetime(lastdatetime) <= convert_to_datetime(toDateTime) and modification != 'deleted':
-                #print(metadata['uuid'])
-                uuid = metadata['uuid']
-                uuid_list.append(uuid)
-                
-            elif convert_to_datetime(lastdatetime) <= convert_to_datetime(toDateTime) and modification == 'deleted':
-                uuid = metadata['uuid']
-                uuid_deleted_list.append(uuid)
-            
-        print("Using the toDateTime provided: %s, there are: %i metadata records to harvest" % (toDateTime, len(uuid_list)))
-        print("Using the toDateTime provided: %s, there are: %i metadata records are deleted " % (toDateTime, len(uuid_deleted_list)))    
-        return uuid_list, uuid_deleted_list
-    except:
-        print("Could not load the GeoNetwork 3.6 change api.")
-        print("Cannot complete a load of the dataset")
-        print("Could not access or properly parse: ", gn_change_query)
-        error_msg = "Could not access or properly parse: " + gn_change_query
-        return error_msg
-        
-def get_fromDateTime_uuids_list(gn_change_query, fromDateTime):
-    """ Get a list of insert/deleted/modified uuids from fromDateTime
-    :param gn_change_query: URL of the GeoNetwork change api
-    :param fromDateTime: datetime of when to harvest
-    :return: a list of uuids to harvest
+def load_config(environ=None):
+    """ Read and validate the required settings, and validate the optional ones (see load_tuning)
+    
+    :param environ: mapping of environment variables, defaults to os.environ
+    :return: HarvestConfig. Raises ConfigError naming every missing or invalid setting
     """
     
-    uuid_list = []
-    uuid_deleted_list = []
+    if environ is None:
+        environ = os.environ
+    errors = []
+    values = {}
+    for name in ('BUCKET_NAME', 'GEOJSON_BUCKET_NAME', 'BASE_URL', 'GN_JSON_RECORD_URL_START'):
+        value = environ.get(name, '').strip()
+        if not value:
+            errors.append(name + " is not set")
+        elif name in ('BASE_URL', 'GN_JSON_RECORD_URL_START') and not value.startswith(('http://', 'https://')):
+            errors.append(name + " is not an http(s) URL: " + value)
+        elif name.endswith('BUCKET_NAME') and value.startswith('/'):
+            errors.append(name + " must start with the bucket name: " + value)
+        values[name] = value
     
+    run_interval_minutes = environ.get('RUN_INTERVAL_MINUTES', '').strip() or '11'
     try:
-        #Use the build in fromDateTime functionality in the GN change API
-        gn_change_filter = urllib.parse.quote("dateFrom=" + fromDateTime)
-        gn_change_query = gn_change_query + "?" + gn_change_filter
-        print (gn_change_query)
-   
-        ###requests
-        headers = { 
-                "Content-Type": "application/json; charset=utf-8",
-                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-            }
-        response = requests.get(gn_change_query, headers=headers)
-        str_data = json.loads(response.text)
-
-        for metadata in str_data['records']:
-            lastdatetime = metadata['lastModifiedTime']
-            modification = metadata['status']
-            if convert_to_datetime(lastdatetime) >= convert_to_datetime(fromDateTime) and modification != 'deleted':
-                #print(metadata['uuid'])
-                uuid = metadata['uuid']
-                uuid_list.append(uuid)
-            elif convert_to_datetime(lastdatetime) >= convert_to_datetime(fromDateTime) and modification == 'deleted':
-                uuid = metadata['uuid']
-                uuid_deleted_list.append(uuid)
-            
-        print("Using the fromDateTime provided: %s, there are: %i metadata records to harvest" % (fromDateTime, len(uuid_list)))
-        print("Using the fromDateTime provided: %s, there are: %i metadata records are deleted" % (fromDateTime, len(uuid_deleted_list)))
+        run_interval_minutes = int(run_interval_minutes)
+        if run_interval_minutes <= 0:
+            raise ValueError()
+    except ValueError:
+        errors.append("RUN_INTERVAL_MINUTES is not a positive number of minutes: " + str(run_interval_minutes))
+    
+    errors.extend(load_tuning(environ)[1])
+    if errors:
+        raise ConfigError("Invalid configuration: " + "; ".join(errors))
+    return HarvestConfig(values['BUCKET_NAME'], values['GEOJSON_BUCKET_NAME'], values['BASE_URL'],
+                         values['GN_JSON_RECORD_URL_START'], run_interval_minutes)
 
-        return uuid_list, uuid_deleted_list
-    except:
-        print("Could not load the GeoNetwork 3.6 change api.")
-        print("Cannot complete a load of the dataset")
-        print("Could not access or properly parse: ", gn_change_query)
-        error_msg = "Could not access or properly parse: " + gn_change_query
-        return error_msg
-        
-def get_fromtoDateTime_uuids_list(gn_change_query, fromDateTime, toDateTime):
-    """ Get a list of insert/deleted/modified uuids from fromDateTime to toDateTime
-    :param gn_change_query: URL of the GeoNetwork change api
-    :param fromDateTime: lower datetime of when to harvest
-    :param toDateTime: upper datetime of when to harvest
-    :return: a list of uuids to harvest
-    """
+def get_config():
+    """ Return the settings of this container, resolved and validated on first use """
     
-    uuid_list = []
-    uuid_deleted_list = []
+    global _config
+    if _config is None:
+        _config = load_config()
+    return _config
+
+def set_config(config):
+    """ Use config instead of the environment, None to resolve the environment again on next use """
     
-    try:
-        #Use the build in toDateTime functionality in the GN change API
-        gn_change_filter = "dateFrom=" + fromDateTime + "&dateTo=" + toDateTime
-        gn_change_query = gn_change_query + "?" + gn_change_filter
-        #print (gn_change_query)
+    global _config
+    _config = config
 
-        headers = { 
-                "Content-Type": "application/json; charset=utf-8",
-                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-            }
-        response = requests.get(gn_change_query, headers=headers)
-        str_data = json.loads(response.text)
-
-        for metadata in str_data['records']:
-            lastdatetime = metadata['lastModifiedTime']
-            modification = metadata['status']
-            if (convert_to_datetime(lastdatetime) <= convert_to_datetime(toDateTime) and 
-                convert_to_datetime(lastdatetime) >= convert_to_datetime(fromDateTime) and 
-                modification != 'deleted'):
-                #print(metadata['uuid'])
-                uuid = metadata['uuid']
-                uuid_list.append(uuid)
-            elif (convert_to_datetime(lastdatetime) <= convert_to_datetime(toDateTime) and 
-                convert_to_datetime(lastdatetime) >= convert_to_datetime(fromDateTime) and 
-                modification == 'deleted'): 
-                uuid = metadata['uuid']
-                uuid_deleted_list.append(uuid)
-            
-        print("Using the toDateTime and fromDateTime provided, there are: %i metadata records to harvest" % (len(uuid_list)))
-        print("Using the toDateTime and fromDateTime provided, there are: %i metadata records are deleted" % (len(uuid_deleted_list)))
-        return uuid_list, uuid_deleted_list
-    except:
-        print("Could not load the GeoNetwork 3.6 change api.")
-        print("Cannot complete a load of the dataset")
-        print("Could not access or properly parse: ", gn_change_query)
-        error_msg = "Could not access or properly parse: " + gn_change_query
-        return error_msg
+def geojson_location(config):
+    """ (bucket, folder) of the GeoJSON records, listed by reconcile and deleted by delete_uuids
     
-def create_bucket(bucket_name, region=None):
-    """Create an S3 bucket in a specified region
+    The folder is that of GEOJSON_BUCKET_NAME, or that of BUCKET_NAME when it has none,
+    as the GeoJSON records mirror the JSON records.
+    """
+    
+    geojson_bucket_name, folder_path = (config.geojson_bucket_name.split("/", 1) + [None])[:2]
+    return geojson_bucket_name, folder_path or (config.json_bucket_name.split("/", 1) + [None])[1]
 
-    If a region is not specified, the bucket is created in the S3 default
-    region (us-east-1).
+def get_http_session():
+    """ Return the pooled HTTP session used for every GeoNetwork call
+    
+    The session is created on first use and kept for the life of the Lambda container,
+    so warm invocations reuse open keep-alive connections instead of a new TLS handshake per request.
+    
+    :return: requests.Session with a connection pool of HTTP_POOL_SIZE
+    """
+    
+    session = _clients.get('http')
+    if session is None:
+        with _clients_lock:
+            session = _clients.get('http')
+            if session is None:
+                import requests
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _clients['http'] = session
+    return session
 
-    :param bucket_name: Bucket to create
-    :param region: String region to create bucket in, e.g., 'us-west-2'
-    :return: True if bucket created, else False
+class RateController:
+    """ Limits the number of concurrent GeoNetwork requests with an AIMD scheme
+    
+    The limit grows by one request per limit's worth of fast successful responses (additive increase)
+    and is halved on a throttle, a server error, a timeout or a response slower than the latency
+    target (multiplicative decrease, at most once per cooldown so a burst of failures counts once).
+    A Retry-After header pauses every request until it has passed, for GN_BACKOFF_MAX_SECONDS at most.
+    
+    :param max_limit: highest number of concurrent requests
+    :param latency_target: seconds above which a response counts as a sign of overload
+    :param cooldown: minimum seconds between two decreases
     """
     
+    def __init__(self, max_limit=None, latency_target=None, cooldown=1.0):
+        self.max_limit = max(1, max_limit or GN_MAX_CONCURRENCY)
+        self.latency_target = latency_target if latency_target is not None else GN_LATENCY_TARGET_MS / 1000.0
+        self.cooldown = cooldown
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
     
-    client = boto3.client('s3', region_name=region)
-    response = client.head_bucket(Bucket=bucket_name)
-    if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-        """ Bucket already exists and we have sufficent permissions """
-        print("Bucket already exists and we have sufficent permissions")
-        return True
-    else:
-        """" Create bucket """
+    def acquire(self):
+        with self.condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    self.condition.wait(pause)
+                elif self.in_flight >= int(self.limit):
+                    self.condition.wait()
+                else:
+                    self.in_flight += 1
+                    return
+    
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+    
+    @contextlib.contextmanager
+    def slot(self):
+        """ Hold one of the concurrent request slots for the enclosed block """
+        
+        self.acquire()
         try:
-            if region is None:
-                s3_client = boto3.client('s3')
-                s3_client.create_bucket(Bucket=bucket_name)
-            else:
-                s3_client = boto3.client('s3', region_name=region)
-                location = {'LocationConstraint': region}
-                s3_client.create_bucket(Bucket=bucket_name,
-                                        CreateBucketConfiguration=location)
+            yield
+        finally:
+            self.release()
     
-        except ClientError as e:
-            logging.error(e)
-            return False
-        return True #Success
+    def on_success(self, seconds):
+        if seconds > self.latency_target:
+            self.on_overload()
+            return
+        with self.condition:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+    
+    def on_overload(self, retry_after=None):
+        now = time.monotonic()
+        with self.condition:
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + min(retry_after, GN_BACKOFF_MAX_SECONDS))
+            if now - self.last_decrease >= self.cooldown:
+                self.limit = max(1.0, self.limit / 2.0)
+                self.last_decrease = now
 
-def upload_json_stream(file_name, bucket, json_data, folder_path=None, object_name=None):
-    """Upload a JSON file to an S3 bucket inside a folder if specified.
+def get_rate_controller():
+    """ Return the RateController shared by every GeoNetwork call, created on first use """
+    
+    controller = _clients.get('gn_rate')
+    if controller is None:
+        with _clients_lock:
+            controller = _clients.get('gn_rate')
+            if controller is None:
+                controller = _clients['gn_rate'] = RateController()
+    return controller
 
-    :param file_name: File to upload
-    :param bucket: Bucket to upload to
-    :param json_data: Stream of JSON data to write
-    :param folder_path: Folder inside the bucket to upload to
-    :param object_name: S3 object name. If not specified, file_name is used
-    :return: True if file was uploaded, else False
-    """
-    # Include folder path if specified
-    if folder_path:
-        file_name = f"{folder_path}/{file_name}"
+def set_gn_concurrency(max_limit):
+    """ Replace the shared RateController with one allowing max_limit concurrent GeoNetwork requests
+    instead of GN_MAX_CONCURRENCY, e.g., for a backfill running more workers """
+    
+    with _clients_lock:
+        _clients['gn_rate'] = RateController(max_limit=max_limit)
 
-    # If S3 object_name was not specified, use file_name
-    if object_name is None:
-        object_name = file_name
+def parse_retry_after(value):
+    """ Seconds to wait from a Retry-After header, in seconds or as an HTTP date, None if absent or invalid """
+    
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
 
-    print(object_name)
+def backoff_delay(attempt, retry_after=None):
+    """ Seconds to wait before retry attempt (0 based): exponential backoff with full jitter,
+    never less than retry_after and never more than GN_BACKOFF_MAX_SECONDS """
+    
+    delay = random.uniform(0, min(GN_BACKOFF_MAX_SECONDS, GN_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+    return min(max(delay, retry_after or 0.0), GN_BACKOFF_MAX_SECONDS)
 
-    # Upload the file
-    s3 = boto3.resource('s3')
-    try:
-        s3object = s3.Object(bucket, object_name)
-        s3object.put(Body=(bytes(json.dumps(json_data, indent=4, ensure_ascii=False).encode('utf-8'))))
-    except ClientError as e:
-        logging.error(e)
-        return False
-    return True
+class RetryDeferred(Exception):
+    """ A GeoNetwork request was not retried because the wait asked for is too long: a Retry-After
+    longer than GN_BACKOFF_MAX_SECONDS, or a backoff running past the Lambda deadline """
 
-def harvest_uuids(uuid_list, gn_json_record_url_start, gn_json_record_url_end, bucket, bucket_location, bucket_folder_path=None):
-    """ Harvests GeoNetwork JSON file into s3_bucket_name
+def gn_get(url, context=None, **kwargs):
+    """ GET from GeoNetwork through the rate controller, retrying throttles, server errors and timeouts
     
-    :param uuid_list: list of uuids to upload
-    :param gn_json_record_url: starting base path to the geonetwork record api
-    :param gn_json_record_url: ending base path to the geonetwork record api
-    :param bucket: bucket to upload to
-    :return: accumulated error messages
+    :param url: URL to get
+    :param context: Lambda context, no retry waits into the last DEADLINE_RESERVE_SECONDS
+    :param kwargs: passed to requests.Session.get, the timeout defaults to GN_TIMEOUT_SECONDS
+    :return: the response, which can still have an error status once the retries are used up.
+             Raises RetryDeferred instead of waiting longer than GN_BACKOFF_MAX_SECONDS or past the deadline
     """
     
-    error_msg = None
-    
-    if create_bucket(bucket, bucket_location):
-        count = 0
-        for uuid in uuid_list:
+    import requests
+    kwargs.setdefault('timeout', GN_TIMEOUT_SECONDS)
+    controller = get_rate_controller()
+    attempt = 0
+    while True:
+        response = None
+        retry_after = None
+        with controller.slot():
+            start = time.perf_counter()
             try:
-                """urllib
-                req = urllib.request.Request(gn_json_record_url_start + uuid + gn_json_record_url_end)
-                req.add_header('Accept', 'application/json; charset=utf-8')
-                str_data = urllib.request.urlopen(req).read()
-                """
-                
-                #requests
-                headers = {
-                    "Content-Type": "text/html; charset=utf-8",
-                    "Accept": "application/json; charset=utf-8"
-                }
-                
-                response = requests.get(gn_json_record_url_start + uuid + gn_json_record_url_end, headers=headers)
-                str_data = json.loads(response.text)
-                
-                uuid_filename = uuid + ".json"
-                #print(gn_json_record_url_start + uuid + gn_json_record_url_end)
-                print(bucket)
-                if upload_json_stream(uuid_filename, bucket, str_data, folder_path=bucket_folder_path):
-                    count += 1
-            except ClientError as e:
-                logging.error(e)
-                error_msg += e
-        print("Uploaded", count, " records")
-    else:
-        error_msg = "Could not create S3 bucket: " + bucket
+                response = get_http_session().get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= GN_MAX_RETRIES:
+                    raise
+                logging.warning("GeoNetwork request failed, retrying: %s", e)
+                controller.on_overload()
+            else:
+                if response.status_code not in GN_RETRY_STATUS:
+                    controller.on_success(time.perf_counter() - start)
+                    return response
+                if attempt >= GN_MAX_RETRIES:
+                    return response
+                if response.status_code == 429:
+                    metrics().count("Throttles")
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                response.close()
+                controller.on_overload(retry_after)
+        if retry_after is not None and retry_after > GN_BACKOFF_MAX_SECONDS:
+            metrics().count("RetriesDeferred")
+            raise RetryDeferred("GeoNetwork asked to retry " + url + " in " + str(int(retry_after)) + " seconds")
+        delay = backoff_delay(attempt, retry_after)
+        remaining = remaining_seconds(context)
+        if remaining is not None and remaining - delay < DEADLINE_RESERVE_SECONDS:
+            metrics().count("RetriesDeferred")
+            raise RetryDeferred("No time left to retry " + url)
+        metrics().count("Retries")
+        time.sleep(delay)
+        attempt += 1
 
-    return error_msg
+def get_s3_client(region=None):
+    """ Return the pooled S3 client for region
     
+    Clients are created on first use from a dedicated boto3 session (the default session is not
+    thread safe) and kept for the life of the Lambda container.
     
-""" def get_full_uuids_list(gn_q_query):
-    #NOTE: function cannot finish in 15 minutes
-    # Get a full list of all uuids
-    #:param gn_q_query: URL of the GeoNetwork 'q' search
-    #See https://geonetwork-opensource.org/manuals/3.10.x/en/api/q-search.html
-    #:return: a full list of uuids to harvest
+    :param region: String region of the client, e.g., 'ca-central-1'. None uses the default region
+    :return: boto3 S3 client with a connection pool of S3_POOL_SIZE
+    """
     
-    uuid_list = []
+    key = ('s3', region)
+    client = _clients.get(key) or _clients.get(('s3', '*'))
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                import boto3
+                from botocore.config import Config
+                config = Config(max_pool_connections=S3_POOL_SIZE, tcp_keepalive=True)
+                client = boto3.session.Session().client('s3', region_name=region, config=config)
+                _clients[key] = client
+    return client
+
+def register_s3_client(client):
+    """ Use client for every region instead of creating boto3 clients, e.g., a local S3 stand-in """
     
-    try:
-        str_data = urllib.request.urlopen(gn_q_query).read()
-        xmldoc = minidom.parseString(str_data)
-        
-        metadatas = xmldoc.getElementsByTagName("metadata")
-        print("XML has: %i metadata records" % len(metadatas))
-        
-        for metadata in metadatas:
-            uuid = metadata.getElementsByTagName("uuid")[0]
-            uuid_list.append(uuid.firstChild.data)
-        
-        return uuid_list
-    except:
-        print("Could not load the GeoNetwork 3.6 'q' search.")
-        print("Cannot complete a full load of the dataset")
-        print("Could not access: ", gn_q_query)
-        return uuid_list
-"""
+    with _clients_lock:
+        _clients[('s3', '*')] = client
 
-def delete_uuids(uuid_deleted_list, bucket, folder_path=None):
-    """ Delete the json files in uuid_deleted_list from a s3 bucket
-    Return a message to the user: delete xx uuid from xx bucket 
+def get_lambda_client():
+    """ Return the Lambda client used to re-invoke this function, created on first use """
+    
+    client = _clients.get('lambda')
+    if client is None:
+        with _clients_lock:
+            client = _clients.get('lambda')
+            if client is None:
+                import boto3
+                from botocore.config import Config
+                #No retries: a timed out synchronous invocation may still be running
+                client = boto3.session.Session().client('lambda', config=Config(
+                    read_timeout=LAMBDA_READ_TIMEOUT,
+                    tcp_keepalive=True,
+                    retries={'total_max_attempts': 1},
+                ))
+                _clients['lambda'] = client
+    return client
 
-    :parm uuid_deleted_list: a list of uuid needs to be deleted 
-    :parm bucket:bucket to delete from 
+def get_sqs_client():
+    """ Return the SQS client sending to HARVEST_QUEUE_URL, created on first use """
+    
+    client = _clients.get('sqs')
+    if client is None:
+        with _clients_lock:
+            client = _clients.get('sqs')
+            if client is None:
+                import boto3
+                client = boto3.session.Session().client('sqs')
+                _clients['sqs'] = client
+    return client
 
+def reset_clients(keep_registered=False):
+    """ Drop every cached session and client, they are recreated on next use
+    
+    :param keep_registered: keep the S3 client given to register_s3_client, e.g., in a forked process
     """
-    error_msg = None 
-    count = 0 
-    for uuid in uuid_deleted_list:    
-        try: 
-            uuid_filename = uuid + ".geojson"
-            if delete_json_streams(uuid_filename, geojson_bucket_name, folder_path=folder_path):
-                count += 1
-        except ClientError as e: 
-            logging.error(e)
-            error_msg += e
-    print('Deleted', count, " records")
-        
-    return error_msg
-
-def delete_json_streams(filename, bucket, folder_path=None):
-    """Delete a JSON file from an S3 bucket inside a folder if specified.
+    
+    with _clients_lock:
+        registered = _clients.get(('s3', '*'))
+        session = _clients.pop('http', None)
+        if session is not None:
+            session.close()
+        _clients.clear()
+        _verified_buckets.clear()
+        if keep_registered and registered is not None:
+            _clients[('s3', '*')] = registered
 
-    :param filename: File to delete
-    :param bucket: Bucket to delete from
-    :param folder_path: Folder inside the bucket where the file resides
-    :return: True if file was deleted, else False
+def get_state_location(name):
+    """ Return the bucket and key of a harvest state object
+    
+    State objects live in STATE_BUCKET_NAME (default: the JSON bucket) under STATE_PREFIX,
+    followed by the JSON bucket folder path so deployments sharing a bucket do not collide.
+    
+    :param name: name of the state object, e.g., 'manifest.json.gz'
+    :return: (bucket, key)
     """
-    # Include folder path if specified
-    if folder_path:
-        filename = f"{folder_path}/{filename}"
     
-    print("filename:" , filename)
-    print("bucket:", bucket)
+    bucket, bucket_folder_path = (get_config().json_bucket_name.split("/", 1) + [None])[:2]
+    prefix = STATE_PREFIX
+    if bucket_folder_path:
+        prefix = f"{prefix}/{bucket_folder_path}"
+    return (STATE_BUCKET_NAME or bucket), f"{prefix}/{name}"
 
-    s3 = boto3.resource('s3')
+def read_state_object(name, etag=None):
+    """ Read a JSON state object, gzip compressed if name ends with .gz
+    
+    :param name: name of the state object
+    :param etag: ETag of a cached copy. If the object still has this ETag it is not downloaded
+    :return: (data, etag). data is None when the object is unchanged since etag,
+             (None, None) when the object does not exist
+    """
+    
+    bucket, key = get_state_location(name)
+    kwargs = {"Bucket": bucket, "Key": key}
+    if etag:
+        kwargs["IfNoneMatch"] = etag
     try:
-        s3object = s3.Object(bucket, filename)
-        s3object.delete()
-        print(f"Deleted {filename} from {bucket}")
+        response = get_s3_client().get_object(**kwargs)
     except ClientError as e:
-        logging.error(e)
-        return False
-    return True
+        code = e.response.get('Error', {}).get('Code')
+        if code in ('304', 'NotModified'):
+            return None, etag
+        if code in ('NoSuchKey', '404'):
+            return None, None
+        raise
+    body = response['Body'].read()
+    if name.endswith('.gz'):
+        body = gzip.decompress(body)
+    return json.loads(body), response['ETag']
+
+def write_state_object(name, data, etag=None, create_only=False):
+    """ Write a JSON state object, gzip compressed if name ends with .gz
+    
+    :param name: name of the state object
+    :param data: JSON serializable data
+    :param etag: only overwrite the object if it still has this ETag
+    :param create_only: only write the object if it does not exist yet
+    :return: ETag of the written object. Raises ClientError (PreconditionFailed) if a condition does not hold
+    """
+    
+    bucket, key = get_state_location(name)
+    body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    if name.endswith('.gz'):
+        body = gzip.compress(body)
+    kwargs = {"Bucket": bucket, "Key": key, "Body": body}
+    if etag:
+        kwargs["IfMatch"] = etag
+    elif create_only:
+        kwargs["IfNoneMatch"] = '*'
+    response = get_s3_client().put_object(**kwargs)
+    return response['ETag']
+
+def is_precondition_failed(e):
+    """ True if the ClientError e was raised by a failed conditional write """
+    
+    return e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict', '412')
+
+def load_watermark():
+    """ Return the lastModifiedTime high-water mark of the last fully successful checkpoint run
+    
+    :return: ISO 8601 datetime string, None if no run completed yet
+    """
+    
+    data, _ = read_state_object(WATERMARK_NAME)
+    if data is None:
+        return None
+    return data.get("lastModifiedTime")
+
+def save_watermark(lastModifiedTime):
+    """ Persist the high-water mark of a fully successful checkpoint run
+    
+    The watermark never moves backwards, a concurrent run that finished with an
+    older mark does not overwrite a newer one.
+    
+    :param lastModifiedTime: ISO 8601 datetime string
+    """
+    
+    current = load_watermark()
+    if current and convert_to_datetime(current) >= convert_to_datetime(lastModifiedTime):
+        return
+    write_state_object(WATERMARK_NAME, {
+        "lastModifiedTime": lastModifiedTime,
+        "updated": utc_now_iso(),
+    })
+
+def record_digest(json_data):
+    """ Digest of the canonical form (sorted keys, no whitespace) of a JSON record,
+    or of the raw bytes of a record stored as received (RECORD_FORMAT=passthrough) """
+    
+    if isinstance(json_data, bytes):
+        return hashlib.blake2b(json_data, digest_size=16).hexdigest()
+    canonical = json.dumps(json_data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+def load_cached_map(name, cache):
+    """ Load a uuid keyed state object into cache
+    
+    The object is kept in memory and only downloaded again when its ETag changed,
+    so warm containers usually pay a single conditional GET.
+    
+    :param name: name of the state object
+    :param cache: dict with the 'etag' and 'data' of the copy in memory, updated in place
+    :return: the loaded dict. Do not modify, pass updates to save_cached_map
+    """
+    
+    data, etag = read_state_object(name, etag=cache["etag"])
+    if data is not None:
+        cache["data"] = data
+    elif etag is None:
+        cache["data"] = {}
+    cache["etag"] = etag
+    return cache["data"]
+
+def save_cached_map(name, cache, updates, retries=3, removed=()):
+    """ Merge updates into a uuid keyed state object
+    
+    The write is conditional on the ETag of the cached copy; if another run saved the object in the meantime
+    it is reloaded and the updates merged again.
+    
+    :param name: name of the state object
+    :param cache: dict with the 'etag' and 'data' of the copy in memory, see load_cached_map
+    :param updates: dict of uuid to value
+    :param retries: number of attempts on conflicting writes
+    :param removed: uuids removed from the object
+    :return: True if the object was saved, else False
+    """
+    
+    for attempt in range(retries):
+        data = dict(cache["data"])
+        data.update(updates)
+        for uuid in removed:
+            data.pop(uuid, None)
+        try:
+            etag = write_state_object(name, data, etag=cache["etag"], create_only=cache["etag"] is None)
+        except ClientError as e:
+            if not is_precondition_failed(e) or attempt == retries - 1:
+                logging.error(e)
+                return False
+            load_cached_map(name, cache)
+            continue
+        cache["data"] = data
+        cache["etag"] = etag
+        return True
+    return False
+
+def load_manifest():
+    """ Load the uuid -> content digest manifest of the records already written, see load_cached_map
+    
+    :return: dict of uuid to digest. Do not modify, pass updates to save_manifest
+    """
+    
+    return load_cached_map(MANIFEST_NAME, _manifest_cache)
+
+def save_manifest(updates, retries=3, removed=()):
+    """ Merge updates (dict of uuid to digest) into the manifest and drop the removed uuids, see save_cached_map """
+    
+    return save_cached_map(MANIFEST_NAME, _manifest_cache, updates, retries=retries, removed=removed)
+
+def load_validators():
+    """ Load the uuid -> GeoNetwork validators (ETag and Last-Modified) of the records already fetched
+    
+    :return: dict of uuid to {'etag': ..., 'lastModified': ...}. Do not modify, pass updates to save_validators
+    """
+    
+    return load_cached_map(VALIDATORS_NAME, _validator_cache)
+
+def save_validators(updates, retries=3, removed=()):
+    """ Merge updates (dict of uuid to validators) into the validator cache and drop the removed uuids, see save_cached_map """
+    
+    return save_cached_map(VALIDATORS_NAME, _validator_cache, updates, retries=retries, removed=removed)
+
+def forget_uuids(uuids):
+    """ Drop deleted uuids from the manifest and the validator cache so a record inserted again
+    with the same content is fetched and written again instead of being skipped as unchanged
+    
+    :param uuids: uuids of the deleted records
+    :return: True if both state objects are up to date, else False
+    """
+    
+    saved = True
+    for name, load, save in (("manifest", load_manifest, save_manifest),
+                             ("validators", load_validators, save_validators)):
+        try:
+            with metrics().phase("ManifestSave" if name == "manifest" else "ValidatorsSave"):
+                data = load()
+                removed = [uuid for uuid in uuids if uuid in data]
+                if removed and not save({}, removed=removed):
+                    saved = False
+        except ClientError as e:
+            logging.error("Could not drop the deleted records from the %s: %s", name, e)
+            saved = False
+    return saved
+
+def datetime_valid(dt_str):
+    """
+    Check to see if user supplied a valid datetime 
+    in ISO:8601 UTC time with +00:00 or 'Z' 
+    https://stackoverflow.com/a/61569783
+    
+    """
+    try:
+        datetime.datetime.fromisoformat(dt_str)
+    except:
+        try:
+            datetime.datetime.fromisoformat(dt_str.replace('Z', '+00:00'))
+        except:
+            print("fromDateTime is not a valid ISO:8601 UTC datetime with +00:00 or 'Z' ")
+            return False
+        return True
+    return True
+    
+def utc_now_iso():
+    """ Current UTC time in ISO:8601 with 'Z', to the second """
+    
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    
+def parse_utc(dt_str):
+    """ Parse an ISO:8601 datetime, a datetime without timezone is taken as UTC
+    
+    :return: timezone aware datetime, None if dt_str is not a valid datetime
+    """
+    
+    dt = convert_to_datetime(dt_str)
+    if not dt:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt
+    
+def convert_to_datetime(dt_str):
+    """
+    Check to see if user supplied a valid datetime and returns it as a datetime object
+    in ISO:8601 UTC time with +00:00 or 'Z' 
+    https://stackoverflow.com/a/61569783
+    
+    """
+    
+    try:
+        dt_str = datetime.datetime.fromisoformat(dt_str)
+    except:
+        try:
+            dt_str = datetime.datetime.fromisoformat(dt_str.replace('Z', '+00:00'))
+        except:
+            print("fromDateTime is not a valid ISO:8601 UTC datetime with +00:00 or 'Z' ")
+            return False
+        return dt_str
+    return dt_str
+    
+def iter_json_array(chunks, key):
+    """ Incrementally parse the items of the array stored under key in a JSON object
+    
+    Items are decoded and yielded as soon as they are complete, so only the
+    current chunk and the current item are held in memory.
+    
+    :param chunks: iterable of bytes, e.g., response.iter_content()
+    :param key: name of the array member, e.g., 'records'
+    :return: generator of the decoded array items
+    """
+    
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    array_start = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+    buffer = ""
+    in_array = False
+    for chunk in chunks:
+        buffer += utf8.decode(chunk)
+        pos = 0
+        if not in_array:
+            match = array_start.search(buffer)
+            if match is None:
+                #Keep enough of the tail to match a key split across chunks
+                buffer = buffer[-(len(key) + 64):]
+                continue
+            in_array = True
+            pos = match.end()
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                #Item is not complete yet, wait for the next chunk
+                break
+            yield item
+        buffer = buffer[pos:]
+    raise ValueError("JSON stream ended before the end of the '" + key + "' array")
+
+def counted_chunks(chunks):
+    """ Pass chunks through, counting their size in the BytesDownloaded metric """
+    
+    for chunk in chunks:
+        metrics().count("BytesDownloaded", len(chunk))
+        yield chunk
+
+def iter_change_records(gn_change_query, params=None, headers=None, page_size=None):
+    """ Stream the records of the GeoNetwork change api
+    
+    The response is parsed while it is downloaded. With a page size, the feed is requested
+    page by page (from/size parameters) until a page returns fewer records than the page size.
+    
+    :param gn_change_query: URL of the GeoNetwork change api
+    :param params: dict of query string parameters, e.g., dateFrom/dateTo
+    :param headers: dict of request headers
+    :param page_size: records per page, defaults to CHANGE_FEED_PAGE_SIZE. 0 requests the whole feed at once
+    :return: generator of change records (dict with uuid, status and lastModifiedTime)
+    """
+    
+    if page_size is None:
+        page_size = CHANGE_FEED_PAGE_SIZE
+    if headers is None:
+        headers = { 
+            "Content-Type": "application/json; charset=utf-8",
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+        }
+    
+    offset = 0
+    while True:
+        page_params = dict(params or {})
+        if page_size:
+            page_params.update({"from": offset, "size": page_size})
+        count = 0
+        with gn_get(gn_change_query, params=page_params, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            for record in iter_json_array(counted_chunks(response.iter_content(chunk_size=CHANGE_FEED_CHUNK_SIZE)), 'records'):
+                count += 1
+                yield record
+        metrics().count("ChangeRecords", count)
+        if not page_size or count < page_size:
+            return
+        offset += count
+
+ChangeSet = collections.namedtuple('ChangeSet', ['inserted', 'deleted', 'latest', 'error'])
+ChangeSet.__doc__ = """ Classified change feed: sets of uuids to harvest and to delete, the latest
+lastModifiedTime seen (ISO 8601 string, None if no records) and an error message if the feed could not be read """
+
+class ChangeFeed:
+    """ Change feed classifier of the GeoNetwork change api
+    
+    Every record is classified once: its lastModifiedTime is parsed a single time and compared to
+    bounds parsed when the feed is created. A uuid listed several times is collapsed to its
+    latest status, so a record deleted after being modified is deleted and never fetched.
+    
+    classify() reads the whole feed and returns a ChangeSet. Alternatively, iterating the feed
+    yields, once each, the uuids of created or modified records as soon as they are parsed, so a
+    harvest can start before the feed is fully downloaded; deletes must then be applied after the
+    harvest, from deleted, for the latest status to win.
+    
+    A feed is read once. If it cannot be read, reading stops and error is set.
+    """
+    
+    def __init__(self, gn_change_query, fromDateTime=None, toDateTime=None):
+        """
+        :param gn_change_query: URL of the GeoNetwork change api
+        :param fromDateTime: lower datetime of when to harvest, ISO 8601
+        :param toDateTime: upper datetime of when to harvest, ISO 8601
+        """
+        
+        self.gn_change_query = gn_change_query
+        self.fromDateTime = fromDateTime
+        self.toDateTime = toDateTime
+        self.lower = parse_utc(fromDateTime) if fromDateTime else None
+        self.upper = parse_utc(toDateTime) if toDateTime else None
+        self.changes = {} #uuid -> (lastModifiedTime, deleted)
+        self.latest = None
+        self.latest_str = None
+        self.error = None
+        self.consumed = False
+    
+    @property
+    def inserted(self):
+        return {uuid for uuid, (_, deleted) in self.changes.items() if not deleted}
+    
+    @property
+    def deleted(self):
+        return {uuid for uuid, (_, deleted) in self.changes.items() if deleted}
+    
+    def add(self, metadata):
+        """ Classify one change record
+        
+        :param metadata: dict with uuid, status and lastModifiedTime
+        :return: True if the record is within the bounds and is the latest change of its uuid
+        """
+        
+        lastdatetime = parse_utc(metadata['lastModifiedTime'])
+        if lastdatetime is not None:
+            if (self.lower and lastdatetime < self.lower) or (self.upper and lastdatetime > self.upper):
+                return False
+            if self.latest is None or lastdatetime > self.latest:
+                self.latest = lastdatetime
+                self.latest_str = metadata['lastModifiedTime']
+        
+        uuid = metadata['uuid']
+        previous = self.changes.get(uuid)
+        if previous is not None and previous[0] is not None and lastdatetime is not None and lastdatetime < previous[0]:
+            return False
+        self.changes[uuid] = (lastdatetime, metadata['status'] == 'deleted')
+        return True
+    
+    def __iter__(self):
+        if self.consumed:
+            raise RuntimeError("A change feed can only be read once")
+        self.consumed = True
+        params = {}
+        if self.fromDateTime:
+            params["dateFrom"] = self.fromDateTime
+        if self.toDateTime:
+            params["dateTo"] = self.toDateTime
+        yielded = set()
+        
+        try:
+            for metadata in iter_change_records(self.gn_change_query, params=params):
+                if self.add(metadata) and metadata['status'] != 'deleted' and metadata['uuid'] not in yielded:
+                    yielded.add(metadata['uuid'])
+                    yield metadata['uuid']
+        except Exception as e:
+            print("Could not load the GeoNetwork 3.6 change api.")
+            print("Could not access or properly parse: ", self.gn_change_query, params)
+            logging.error(e)
+            self.error = "Could not access or properly parse: " + self.gn_change_query
+        
+        print("Change feed from %s to %s: %i metadata records to harvest, %i metadata records are deleted"
+              % (self.fromDateTime, self.toDateTime, len(self.inserted), len(self.deleted)))
+    
+    def classify(self):
+        """ Read the whole feed
+        
+        :return: ChangeSet
+        """
+        
+        if not self.consumed:
+            for _ in self:
+                pass
+        return ChangeSet(self.inserted, self.deleted, self.latest_str, self.error)
+
+def format_utc(dt):
+    """ ISO:8601 string of a timezone aware datetime, to the second, with 'Z' """
+    
+    return dt.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+class PartitionedChangeFeed(ChangeFeed):
+    """ Change feed of a wide date range, read as concurrent queries of narrower windows
+    
+    The range is cut into windows of CHANGE_FEED_WINDOW_DAYS, queried CHANGE_FEED_CONCURRENCY at a time.
+    The width adapts to the density of the catalogue: when a window returns more than
+    CHANGE_FEED_WINDOW_RECORDS records the windows planned after it are narrowed in proportion, and
+    they are widened (up to a quarter of the range per worker) while they return few. A window that
+    cannot be read is split in halves and queried again, up to CHANGE_FEED_MAX_SPLITS times, so a single
+    slow or failing query does not fail the whole range.
+    
+    Every record goes through add, the merged result is the same as that of a single query.
+    Iterating yields the uuids of a window once the whole window is read.
+    """
+    
+    def __init__(self, gn_change_query, fromDateTime=None, toDateTime=None, workers=None):
+        """
+        :param gn_change_query: URL of the GeoNetwork change api
+        :param fromDateTime: lower datetime of when to harvest, ISO 8601, defaults to FULL_RELOAD_START
+        :param toDateTime: upper datetime of when to harvest, ISO 8601, defaults to now
+        :param workers: windows queried concurrently, defaults to CHANGE_FEED_CONCURRENCY
+        """
+        
+        super().__init__(gn_change_query, fromDateTime=fromDateTime, toDateTime=toDateTime)
+        self.start = self.lower or parse_utc(FULL_RELOAD_START)
+        self.end = self.upper or datetime.datetime.now(datetime.timezone.utc)
+        self.workers = workers or CHANGE_FEED_CONCURRENCY
+        self.width = datetime.timedelta(days=CHANGE_FEED_WINDOW_DAYS)
+        self.min_width = datetime.timedelta(minutes=CHANGE_FEED_MIN_WINDOW_MINUTES)
+        #Sparse years are read in a few wide windows, still several per worker so the width can adapt
+        self.max_width = max(self.width, (self.end - self.start) / (self.workers * 4))
+        self.windows = 0
+    
+    def plan(self):
+        """ Generator of the (start, end, splits) windows covering the range, the width of each decided when it is planned """
+        
+        cursor = self.start
+        while cursor < self.end:
+            window_end = min(cursor + self.width, self.end)
+            yield cursor, window_end, 0
+            cursor = window_end
+    
+    def adapt(self, count):
+        """ Narrow or widen the windows not planned yet after a window returned count records """
+        
+        if count > CHANGE_FEED_WINDOW_RECORDS:
+            self.width = max(self.min_width, self.width * (CHANGE_FEED_WINDOW_RECORDS / 2.0 / count))
+        elif count < CHANGE_FEED_WINDOW_RECORDS / 4:
+            self.width = min(self.max_width, self.width * 2)
+    
+    def read_window(self, window):
+        params = {"dateFrom": format_utc(window[0])}
+        if self.upper or window[1] < self.end:
+            #The last window of an open ended range stays open, like a single query
+            params["dateTo"] = format_utc(window[1])
+        return [(record['uuid'], record['status'], record['lastModifiedTime'])
+                for record in iter_change_records(self.gn_change_query, params=params)]
+    
+    def __iter__(self):
+        if self.consumed:
+            raise RuntimeError("A change feed can only be read once")
+        self.consumed = True
+        yielded = set()
+        windows = self.plan()
+        while windows:
+            failed = []
+            for window, records, e in run_bounded(self.read_window, windows, self.workers):
+                if e is not None:
+                    logging.error("Could not read the change feed from %s to %s: %s", format_utc(window[0]), format_utc(window[1]), e)
+                    failed.append(window)
+                    continue
+                self.windows += 1
+                metrics().count("ChangeFeedWindows")
+                self.adapt(len(records))
+                for uuid, status, lastModifiedTime in records:
+                    metadata = {"uuid": uuid, "status": status, "lastModifiedTime": lastModifiedTime}
+                    if self.add(metadata) and status != 'deleted' and uuid not in yielded:
+                        yielded.add(uuid)
+                        yield uuid
+            #Query the failed windows again, in halves
+            windows = []
+            for start, end, splits in failed:
+                if end - start < 2 * self.min_width or splits >= CHANGE_FEED_MAX_SPLITS:
+                    self.error = "Could not access or properly parse: " + self.gn_change_query + " from " + format_utc(start)
+                    continue
+                metrics().count("ChangeFeedSplits")
+                middle = start + (end - start) / 2
+                windows += [(start, middle, splits + 1), (middle, end, splits + 1)]
+        
+        print("Change feed from %s to %s in %i windows: %i metadata records to harvest, %i metadata records are deleted"
+              % (self.fromDateTime, self.toDateTime, self.windows, len(self.inserted), len(self.deleted)))
+
+def open_change_feed(gn_change_query, fromDateTime=None, toDateTime=None):
+    """ Return the change feed of a date range: a PartitionedChangeFeed if the range is wider than
+    CHANGE_FEED_WINDOW_DAYS (or open ended), else a ChangeFeed read with a single query
+    
+    :param gn_change_query: URL of the GeoNetwork change api
+    :param fromDateTime: lower datetime of when to harvest, ISO 8601
+    :param toDateTime: upper datetime of when to harvest, ISO 8601
+    """
+    
+    lower = parse_utc(fromDateTime) if fromDateTime else parse_utc(FULL_RELOAD_START)
+    upper = parse_utc(toDateTime) if toDateTime else datetime.datetime.now(datetime.timezone.utc)
+    if CHANGE_FEED_CONCURRENCY > 1 and upper - lower > datetime.timedelta(days=CHANGE_FEED_WINDOW_DAYS):
+        return PartitionedChangeFeed(gn_change_query, fromDateTime=fromDateTime, toDateTime=toDateTime)
+    return ChangeFeed(gn_change_query, fromDateTime=fromDateTime, toDateTime=toDateTime)
+
+def create_bucket(bucket_name, region=None):
+    """Create an S3 bucket in a specified region
+
+    If a region is not specified, the bucket is created in the S3 default
+    region (us-east-1).
+
+    :param bucket_name: Bucket to create
+    :param region: String region to create bucket in, e.g., 'us-west-2'
+    :return: True if bucket created, else False
+    """
+    
+    
+    if bucket_name in _verified_buckets:
+        return True
+    
+    client = get_s3_client(region)
+    with metrics().phase("CreateBucket"):
+        response = client.head_bucket(Bucket=bucket_name)
+    if response['ResponseMetadata']['HTTPStatusCode'] == 200:
+        """ Bucket already exists and we have sufficent permissions """
+        _verified_buckets.add(bucket_name)
+        return True
+    else:
+        """" Create bucket """
+        try:
+            if region is None:
+                client.create_bucket(Bucket=bucket_name)
+            else:
+                location = {'LocationConstraint': region}
+                client.create_bucket(Bucket=bucket_name,
+                                     CreateBucketConfiguration=location)
+    
+        except ClientError as e:
+            logging.error(e)
+            return False
+        _verified_buckets.add(bucket_name)
+        return True #Success
+
+def upload_json_stream(file_name, bucket, json_data, folder_path=None, object_name=None, s3_client=None, content_encoding=None):
+    """Upload a JSON file to an S3 bucket inside a folder if specified.
+
+    :param file_name: File to upload
+    :param bucket: Bucket to upload to
+    :param json_data: Stream of JSON data to write, or bytes written as is
+    :param folder_path: Folder inside the bucket to upload to
+    :param object_name: S3 object name. If not specified, file_name is used
+    :param s3_client: S3 client to upload with. If not specified, the shared client is used
+    :param content_encoding: Content-Encoding of bytes json_data, e.g., 'gzip'
+    :return: True if file was uploaded, else False
+    """
+    # Include folder path if specified
+    if folder_path:
+        file_name = f"{folder_path}/{file_name}"
+
+    # If S3 object_name was not specified, use file_name
+    if object_name is None:
+        object_name = file_name
+
+    # Upload the file
+    if s3_client is None:
+        s3_client = get_s3_client()
+    if isinstance(json_data, bytes):
+        body = json_data
+    else:
+        body = json.dumps(json_data, indent=4, ensure_ascii=False).encode('utf-8')
+    extra_args = {"ContentEncoding": content_encoding} if content_encoding else {}
+    try:
+        response = s3_client.put_object(Bucket=bucket, Key=object_name, Body=body,
+                                        ContentType="application/json", **extra_args)
+        metrics().count("S3Retries", response.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+    except ClientError as e:
+        logging.error(e)
+        return False
+    return True
+
+def is_json_object_bytes(body):
+    """ Cheap validity check of a raw JSON record, without parsing it: a non-empty {...} body """
+    
+    stripped = body.strip()
+    return len(stripped) >= 2 and stripped[:1] == b'{' and stripped[-1:] == b'}'
+
+def compress_body(body, compression=None):
+    """ Compress a record body for storage
+    
+    :param body: bytes to compress
+    :param compression: 'none', 'gzip' or 'zstd', defaults to RECORD_COMPRESSION
+    :return: (compressed body, Content-Encoding or None)
+    """
+    
+    if compression is None:
+        compression = RECORD_COMPRESSION
+    if compression in ('', 'none'):
+        return body, None
+    if compression == 'gzip':
+        return gzip.compress(body, compresslevel=6), 'gzip'
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("RECORD_COMPRESSION=zstd requires the zstandard package")
+        return zstandard.ZstdCompressor().compress(body), 'zstd'
+    raise ValueError("Unknown record compression: " + compression)
+
+def get_bundle_prefix(bucket_folder_path=None):
+    """ Key prefix of the run bundles and snapshots: BUNDLE_PREFIX followed by the JSON bucket folder path """
+    
+    return f"{BUNDLE_PREFIX}/{bucket_folder_path}" if bucket_folder_path else BUNDLE_PREFIX
+
+def bundle_timestamp(when=None):
+    """ Sortable UTC timestamp used in bundle keys """
+    
+    return (when or datetime.datetime.now(datetime.timezone.utc)).strftime("%Y%m%dT%H%M%S%fZ")
+
+class S3StreamWriter:
+    """ Writes an S3 object from a stream of byte chunks in bounded memory
+    
+    Small objects are sent with a single PUT on close(). Once part_size bytes are buffered the object
+    becomes a multipart upload and every full buffer is sent as a part. Not thread safe, callers lock.
+    
+    :param bucket: bucket to write to
+    :param key: key of the object
+    :param s3_client: S3 client to write with. If not specified, the shared client is used
+    :param part_size: size of the multipart upload parts, defaults to BUNDLE_PART_SIZE
+    :param extra_args: dict of object settings, e.g., ContentType
+    """
+    
+    def __init__(self, bucket, key, s3_client=None, part_size=None, **extra_args):
+        self.bucket = bucket
+        self.key = key
+        self.s3_client = s3_client or get_s3_client()
+        self.part_size = part_size or BUNDLE_PART_SIZE
+        self.extra_args = extra_args
+        self.buffer = bytearray()
+        self.size = 0
+        self.upload_id = None
+        self.parts = []
+    
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= self.part_size:
+            self.upload_part()
+    
+    def upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.extra_args)['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              PartNumber=part_number, Body=bytes(self.buffer))
+        self.parts.append({"PartNumber": part_number, "ETag": response['ETag']})
+        metrics().count("UploadParts")
+        self.buffer = bytearray()
+    
+    def close(self):
+        """ Send what is left and complete the object, the multipart upload is aborted on failure """
+        
+        try:
+            if self.upload_id is not None:
+                if self.buffer:
+                    self.upload_part()
+                self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                         MultipartUpload={"Parts": self.parts})
+            else:
+                self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), **self.extra_args)
+        except Exception:
+            self.abort()
+            raise
+        self.buffer = bytearray()
+    
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+class BundleWriter:
+    """ Writes records as one gzip compressed NDJSON object with an offset index
+    
+    Each record is a separate gzip member holding one JSON line, so the bundle reads as a single
+    NDJSON stream (e.g., zcat) and any record can be read alone with a ranged GET of the
+    [offset, length] kept in the index object written by close(). Bundles larger than
+    BUNDLE_PART_SIZE are sent as a multipart upload while records are added.
+    Thread safe, the harvest workers add records concurrently.
+    
+    :param bucket: bucket to write to
+    :param key: key of the bundle, ending with .ndjson.gz
+    :param s3_client: S3 client to write with. If not specified, the shared client is used
+    :param part_size: size of the multipart upload parts, defaults to BUNDLE_PART_SIZE
+    """
+    
+    def __init__(self, bucket, key, s3_client=None, part_size=None):
+        self.key = key
+        self.stream = S3StreamWriter(bucket, key, s3_client=s3_client, part_size=part_size, ContentType="application/gzip")
+        self.lock = threading.Lock()
+        self.index = {}
+        self.deleted = []
+    
+    def add(self, uuid, record):
+        """ Add a record, a JSON serializable object or the bytes of a JSON object """
+        
+        if isinstance(record, bytes) and b'\n' not in record.strip():
+            line = record.strip()
+        else:
+            if isinstance(record, bytes):
+                record = json.loads(record)
+            line = json.dumps(record, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        self.add_member(uuid, gzip.compress(line + b'\n', compresslevel=6))
+    
+    def add_member(self, uuid, member):
+        """ Add a record already compressed as a gzip member, e.g., copied from another bundle """
+        
+        with self.lock:
+            self.index[uuid] = [self.stream.size, len(member)]
+            self.stream.write(member)
+    
+    def delete(self, uuids):
+        """ Record uuids deleted by the run, so compaction drops them from the snapshot """
+        
+        with self.lock:
+            self.deleted.extend(uuids)
+    
+    def close(self, index_key=None, extra=None):
+        """ Finish the bundle and write its index
+        
+        :param index_key: key of the index, defaults to the bundle key with a .index.json extension
+        :param extra: dict of additional index entries
+        :return: dict with the bundle and index keys and the number of records, None if nothing was added
+        """
+        
+        if index_key is None:
+            index_key = re.sub(r'\.ndjson\.gz$', '', self.key) + ".index.json"
+        
+        with self.lock:
+            if not self.index and not self.deleted:
+                return None
+            self.stream.close()
+            index = {"bundle": self.key, "size": self.stream.size, "records": self.index, "deleted": self.deleted}
+            index.update(extra or {})
+            self.stream.s3_client.put_object(Bucket=self.stream.bucket, Key=index_key, ContentType="application/json",
+                                             Body=json.dumps(index, separators=(',', ':')).encode('utf-8'))
+            metrics().count("BytesBundled", self.stream.size)
+            return {"bundle": self.key, "index": index_key, "records": len(self.index)}
+
+class RunReport:
+    """ Streams the outcome of every uuid of a run into a gzip compressed NDJSON object
+    
+    Each line is {"uuid", "action", "outcome"} plus the "reason" of a failure; the last line holds the
+    summary counts. Lines are compressed as they are added and sent as multipart upload parts, so the
+    memory used does not grow with the size of the run. Thread safe.
+    
+    :param bucket: bucket to write to
+    :param key: key of the report
+    :param s3_client: S3 client to write with. If not specified, the shared client is used
+    """
+    
+    def __init__(self, bucket, key, s3_client=None):
+        self.bucket = bucket
+        self.key = key
+        self.stream = S3StreamWriter(bucket, key, s3_client=s3_client, ContentType="application/x-ndjson",
+                                     ContentEncoding="gzip")
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) #gzip container
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+    
+    @property
+    def url(self):
+        return f"s3://{self.bucket}/{self.key}"
+    
+    def write(self, entry, count=None):
+        line = json.dumps(entry, separators=(',', ':'), ensure_ascii=False).encode('utf-8') + b'\n'
+        with self.lock:
+            if count is not None:
+                self.counts[count] += 1
+            self.stream.write(self.compressor.compress(line))
+    
+    def add(self, uuid, action, outcome, reason=None):
+        """ Record the outcome of uuid, e.g., ('harvest', HARVESTED) or ('delete', 'failed', reason) """
+        
+        entry = {"uuid": uuid, "action": action, "outcome": outcome}
+        if reason is not None:
+            entry["reason"] = reason
+        self.write(entry, count=action + ":" + outcome)
+    
+    def add_report(self, url, records):
+        """ Point at the report of a worker that handled records uuids of this run """
+        
+        self.write({"action": "shard", "report": url, "records": records}, count="shard:reported")
+    
+    def close(self, summary=None):
+        """ Write the summary line and complete the object
+        
+        :param summary: dict of the run summary, the counts of each action:outcome are added
+        :return: the s3:// URL of the report
+        """
+        
+        with self.lock:
+            outcomes = dict(self.counts)
+        self.write({"summary": dict(summary or {}, outcomes=outcomes)})
+        with self.lock:
+            self.stream.write(self.compressor.flush())
+            self.stream.close()
+        return self.url
+
+def open_run_report():
+    """ Return a RunReport for this run, in the state bucket under STATE_PREFIX[/folder]/reports/<date>/ """
+    
+    now = datetime.datetime.now(datetime.timezone.utc)
+    bucket, key = get_state_location(f"reports/{now:%Y-%m-%d}/{bundle_timestamp(now)}-{os.urandom(4).hex()}.ndjson.gz")
+    return RunReport(bucket, key)
+
+def open_run_bundle(bucket, bucket_folder_path=None):
+    """ Return a BundleWriter for the records of this run, see close_run_bundle """
+    
+    now = datetime.datetime.now(datetime.timezone.utc)
+    name = bundle_timestamp(now) + "-" + os.urandom(4).hex()
+    return BundleWriter(bucket, f"{get_bundle_prefix(bucket_folder_path)}/runs/{now:%Y-%m-%d}/{name}.ndjson.gz")
+
+def close_run_bundle(bundle, bucket_folder_path=None):
+    """ Close the bundle of a run
+    
+    The index is named after the time the bundle was closed, so listing the indexes in key order
+    gives the run bundles in the order they were completed (see compact_bundles).
+    
+    :return: dict returned by BundleWriter.close
+    """
+    
+    now = datetime.datetime.now(datetime.timezone.utc)
+    name = bundle_timestamp(now) + "-" + os.urandom(4).hex()
+    return bundle.close(index_key=f"{get_bundle_prefix(bucket_folder_path)}/runs/{now:%Y-%m-%d}/{name}.index.json")
+
+def finish_run_bundle(bundle, bucket_folder_path=None, deleted=()):
+    """ Record the uuids deleted by the run in bundle and close it, see close_run_bundle
+    
+    :return: (status message or None, error message or None). A bundle that cannot be written is logged, not raised
+    """
+    
+    bundle.delete(list(deleted))
+    try:
+        with metrics().phase("Bundle"):
+            bundle_info = close_run_bundle(bundle, bucket_folder_path)
+    except Exception as e:
+        logging.error("Could not write the run bundle: %s", e)
+        return None, "Could not write the run bundle: " + str(e)
+    if bundle_info:
+        return "...run bundle written to " + bundle_info["bundle"], None
+    return None, None
+
+def deleted_uuids(uuid_deleted_list, delete_stats):
+    """ The uuids of uuid_deleted_list that delete_uuids did delete, i.e. neither failed nor left pending """
+    
+    not_deleted = set(delete_stats["failures"]).union(delete_stats.get("pending", []))
+    return [uuid for uuid in uuid_deleted_list if uuid not in not_deleted]
+
+def list_keys(bucket, prefix, start_after=None, s3_client=None, stop_after=None):
+    """ Generator of the keys under prefix in lexicographic order, after start_after and up to stop_after if given """
+    
+    if s3_client is None:
+        s3_client = get_s3_client()
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if start_after:
+        kwargs["StartAfter"] = start_after
+    while True:
+        response = s3_client.list_objects_v2(**kwargs)
+        for obj in response.get('Contents', []):
+            if stop_after is not None and obj['Key'] > stop_after:
+                return
+            yield obj['Key']
+        if not response.get('IsTruncated'):
+            return
+        kwargs["ContinuationToken"] = response['NextContinuationToken']
+
+def read_exactly(body, size):
+    """ Read size bytes from a streaming body """
+    
+    data = bytearray()
+    while len(data) < size:
+        chunk = body.read(min(size - len(data), CHANGE_FEED_CHUNK_SIZE * 16))
+        if not chunk:
+            raise EOFError("Bundle ended before the end of a record")
+        data += chunk
+    return bytes(data)
+
+def compact_bundles(bucket, bucket_folder_path=None):
+    """ Compact the latest snapshot and the run bundles written since into a new snapshot
+    
+    Later bundles win, and records deleted by a later run are dropped. Records are copied as
+    their gzip members, streamed from one source bundle at a time, without recompression.
+    Bundles closed in the last BUNDLE_SETTLE_MINUTES are left for the next compaction, so a run
+    still writing its index can not be skipped.
+    
+    :param bucket: bucket of the bundles
+    :param bucket_folder_path: folder path of the JSON bucket
+    :return: dict describing the new snapshot (see bundle_snapshot.json), None if there was nothing to compact
+    """
+    
+    s3_client = get_s3_client()
+    prefix = get_bundle_prefix(bucket_folder_path)
+    snapshot, snapshot_etag = read_state_object(SNAPSHOT_NAME)
+    settled = bundle_timestamp(datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=BUNDLE_SETTLE_MINUTES))
+    index_keys = [key for key in list_keys(bucket, prefix + "/runs/", start_after=snapshot["until"] if snapshot else None)
+                  if key.endswith(".index.json") and key.rsplit("/", 1)[-1] < settled]
+    if not index_keys:
+        return None
+    
+    sources = ([snapshot["index"]] if snapshot and snapshot.get("index") else []) + index_keys
+    winners = {}
+    for source in sources:
+        index = json.loads(s3_client.get_object(Bucket=bucket, Key=source)['Body'].read())
+        for uuid, (offset, length) in index["records"].items():
+            winners[uuid] = (index["bundle"], offset, length)
+        for uuid in index.get("deleted", []):
+            winners.pop(uuid, None)
+    
+    by_bundle = collections.defaultdict(list)
+    for uuid, (bundle, offset, length) in winners.items():
+        by_bundle[bundle].append((offset, length, uuid))
+    writer = BundleWriter(bucket, f"{prefix}/snapshots/{bundle_timestamp()}.ndjson.gz", s3_client=s3_client)
+    for bundle in sorted(by_bundle):
+        members = sorted(by_bundle[bundle])
+        body = s3_client.get_object(Bucket=bucket, Key=bundle)['Body']
+        position = 0
+        for offset, length, uuid in members:
+            if offset > position:
+                read_exactly(body, offset - position)
+            writer.add_member(uuid, read_exactly(body, length))
+            position = offset + length
+        body.close()
+    
+    result = writer.close(extra={"until": index_keys[-1]}) or {"bundle": None, "index": None, "records": 0}
+    snapshot = {"key": result["bundle"], "index": result["index"], "records": result["records"],
+                "until": index_keys[-1], "updated": utc_now_iso()}
+    write_state_object(SNAPSHOT_NAME, snapshot, etag=snapshot_etag, create_only=snapshot_etag is None)
+    metrics().count("BundlesCompacted", len(index_keys))
+    return snapshot
+
+def run_bounded(func, items, workers):
+    """ Run func over items on a pool of at most workers threads
+    
+    Items are pulled lazily from the iterable and at most 2 * workers calls are in
+    flight at any time, so a long (or streamed) list does not build up a backlog of futures.
+    
+    :param func: callable taking a single item
+    :param items: iterable of items
+    :param workers: maximum number of concurrent calls
+    :return: generator of (item, result, exception) tuples in completion order
+    """
+    
+    workers = max(1, int(workers))
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < 2 * workers:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_flight[executor.submit(func, item)] = item
+            if not in_flight:
+                return
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = in_flight.pop(future)
+                exception = future.exception()
+                yield item, (None if exception else future.result()), exception
+
+def harvest_uuid(uuid, gn_json_record_url_start, gn_json_record_url_end, bucket, bucket_folder_path=None, s3_client=None, manifest=None, manifest_updates=None, validators=None, validator_updates=None, bundle=None, context=None):
+    """ Download a single GeoNetwork JSON record and upload it to bucket
+    
+    :param uuid: uuid of the record
+    :param gn_json_record_url_start: starting base path to the geonetwork record api
+    :param gn_json_record_url_end: ending base path to the geonetwork record api
+    :param bucket: bucket to upload to
+    :param bucket_folder_path: folder inside the bucket to upload to
+    :param s3_client: S3 client to upload with
+    :param manifest: dict of uuid to digest of the records already written. The upload is
+                     skipped when the record digest matches
+    :param manifest_updates: dict receiving the digest of the record once uploaded
+    :param validators: dict of uuid to the ETag/Last-Modified of the record last fetched. The record
+                       is requested conditionally and a 304 Not Modified skips the download and the upload.
+                       A uuid missing from manifest (e.g. deleted since) is always downloaded
+    :param validator_updates: dict receiving the ETag/Last-Modified of the record once stored
+    :param bundle: BundleWriter receiving the record once uploaded
+    :param context: Lambda context, see gn_get
+    :return: HARVESTED if the record was uploaded, SKIPPED if it is unchanged, else False
+    """
+    
+    headers = {
+        "Content-Type": "text/html; charset=utf-8",
+        "Accept": "application/json; charset=utf-8"
+    }
+    validator = validators.get(uuid) if validators and (manifest is None or uuid in manifest) else None
+    if validator:
+        if validator.get("etag"):
+            headers["If-None-Match"] = validator["etag"]
+        if validator.get("lastModified"):
+            headers["If-Modified-Since"] = validator["lastModified"]
+    
+    start = time.perf_counter()
+    response = gn_get(gn_json_record_url_start + uuid + gn_json_record_url_end, context=context, headers=headers)
+    if response.status_code == 304:
+        metrics().observe("Fetch", time.perf_counter() - start)
+        metrics().count("RecordsNotModified")
+        return SKIPPED
+    response.raise_for_status()
+    metrics().observe("Fetch", time.perf_counter() - start)
+    metrics().count("BytesDownloaded", len(response.content))
+    if RECORD_FORMAT == 'passthrough':
+        #Store the body as received: no decode/re-encode copies, only a cheap sanity check.
+        #It is not streamed to S3, the digest of the whole body decides whether it is uploaded at all
+        str_data = response.content
+        if not is_json_object_bytes(str_data):
+            raise ValueError("GeoNetwork did not return a JSON object for " + uuid)
+    else:
+        str_data = json.loads(response.content)
+    
+    digest = None
+    if manifest is not None or manifest_updates is not None:
+        digest = record_digest(str_data)
+        if manifest is not None and manifest.get(uuid) == digest:
+            record_validator(uuid, response, validator_updates)
+            return SKIPPED
+    
+    record = str_data
+    if not isinstance(str_data, bytes):
+        str_data = json.dumps(str_data, indent=4, ensure_ascii=False).encode('utf-8')
+    content_encoding = None
+    if RECORD_COMPRESSION not in ('', 'none'):
+        str_data, content_encoding = compress_body(str_data)
+    
+    uuid_filename = uuid + ".json"
+    start = time.perf_counter()
+    if not upload_json_stream(uuid_filename, bucket, str_data, folder_path=bucket_folder_path, s3_client=s3_client,
+                              content_encoding=content_encoding):
+        return False
+    metrics().observe("Upload", time.perf_counter() - start)
+    metrics().count("BytesUploaded", len(str_data))
+    if manifest_updates is not None:
+        manifest_updates[uuid] = digest
+    record_validator(uuid, response, validator_updates)
+    if bundle is not None:
+        bundle.add(uuid, record)
+    return HARVESTED
+
+def record_validator(uuid, response, validator_updates):
+    """ Keep the ETag and Last-Modified of a stored record in validator_updates, if GeoNetwork sent any """
+    
+    if validator_updates is None:
+        return
+    validator = {}
+    for header, key in (('ETag', 'etag'), ('Last-Modified', 'lastModified')):
+        value = response.headers.get(header)
+        if isinstance(value, str) and value:
+            validator[key] = value
+    if validator:
+        validator_updates[uuid] = validator
+
+def harvest_uuids(uuid_list, gn_json_record_url_start, gn_json_record_url_end, bucket, bucket_location, bucket_folder_path=None, workers=None, use_manifest=True, force=False, context=None, bundle=None, report=None, save_state=True):
+    """ Harvests GeoNetwork JSON file into s3_bucket_name
+    
+    Records are fetched and uploaded by a bounded pool of workers, so the download of
+    one record overlaps with the upload of another. Records whose content did not change
+    since they were last written (see load_manifest) are not uploaded again.
+    
+    :param uuid_list: list (or any iterable) of uuids to upload. An iterable is read, and its uuids
+                      claimed (see claim_as_read), as the workers need them. The uuids leased by another
+                      run are not harvested and left pending
+    :param gn_json_record_url_start: starting base path to the geonetwork record api
+    :param gn_json_record_url_end: ending base path to the geonetwork record api
+    :param bucket: bucket to upload to
+    :param bucket_location: region of the bucket
+    :param bucket_folder_path: folder inside the bucket to upload to
+    :param workers: number of concurrent workers, defaults to HARVEST_WORKERS
+    :param use_manifest: skip unchanged records and record the digest of written ones
+    :param force: upload every record even if unchanged, the manifest is still updated
+    :param context: Lambda context, no new record is started with less than DEADLINE_RESERVE_SECONDS left
+    :param bundle: BundleWriter receiving every uploaded record
+    :param report: RunReport receiving the outcome of every uuid
+    :param save_state: save the manifest and validator updates. When False they are returned in
+                       stats['manifest_updates'] and stats['validator_updates'] for the caller to save
+    :return: accumulated error messages and a dict with the harvested/skipped/failed counts,
+             the failure reason of each failed uuid, the duration in seconds of each record
+             and the uuids left pending at the deadline or deferred by GeoNetwork (see RetryDeferred).
+             The pending uuids that another run can not start before long (deferred by GeoNetwork,
+             or leased by another run) are listed again in 'deferred'
+    """
+    
+    error_msg = None
+    stats = {"harvested": 0, "skipped": 0, "failed": 0, "failures": {}, "latencies": [], "pending": [], "deferred": []}
+    
+    if workers is None:
+        workers = HARVEST_WORKERS
+    
+    if create_bucket(bucket, bucket_location):
+        s3_client = get_s3_client()
+        #Records claimed by an overlapping run are left pending rather than written twice
+        owner = new_lease_owner()
+        claimed = []
+        
+        manifest = None
+        manifest_updates = None
+        validators = None
+        validator_updates = None
+        if use_manifest:
+            try:
+                with metrics().phase("ManifestLoad"):
+                    manifest = {} if force else load_manifest()
+                manifest_updates = {}
+            except ClientError as e:
+                logging.error("Could not load the harvest manifest, every record will be written: %s", e)
+        if use_manifest and CONDITIONAL_FETCH:
+            try:
+                with metrics().phase("ValidatorsLoad"):
+                    validators = {} if force or manifest is None else load_validators()
+                validator_updates = {}
+            except ClientError as e:
+                logging.error("Could not load the record validators, every record will be fetched: %s", e)
+        
+        def harvest(uuid):
+            start = time.perf_counter()
+            outcome = harvest_uuid(uuid, gn_json_record_url_start, gn_json_record_url_end, bucket,
+                                   bucket_folder_path=bucket_folder_path, s3_client=s3_client,
+                                   manifest=manifest, manifest_updates=manifest_updates,
+                                   validators=validators, validator_updates=validator_updates, bundle=bundle,
+                                   context=context)
+            return outcome, time.perf_counter() - start
+        
+        uuids = claim_as_read(uuid_list, owner, claimed, stats["pending"], context=context, deferred=stats["deferred"])
+        for uuid, result, e in run_bounded(harvest, uuids, workers):
+            if isinstance(e, RetryDeferred):
+                #GeoNetwork asked for a longer wait than this run can afford, leave the record to the next one
+                logging.warning("Harvest of %s deferred: %s", uuid, e)
+                stats["pending"].append(uuid)
+                stats["deferred"].append(uuid)
+                continue
+            outcome = None
+            if result:
+                outcome, seconds = result
+                stats["latencies"].append(seconds)
+                metrics().observe("Record", seconds)
+            if outcome:
+                stats[outcome] += 1
+                metrics().count("Records" + outcome.capitalize())
+                if report is not None:
+                    report.add(uuid, "harvest", outcome)
+            else:
+                metrics().count("RecordErrors")
+                if e is not None:
+                    logging.error("Could not harvest %s: %s", uuid, e)
+                stats["failed"] += 1
+                stats["failures"][uuid] = str(e) if e is not None else "upload failed"
+                if report is not None:
+                    report.add(uuid, "harvest", "failed", stats["failures"][uuid])
+        release_uuids(claimed, owner)
+        print("Uploaded", stats["harvested"], " records, skipped", stats["skipped"], "unchanged records")
+        if stats["pending"]:
+            print(len(stats["pending"]), "records left pending")
+            metrics().count("RecordsPending", len(stats["pending"]))
+            if report is not None:
+                for uuid in stats["pending"]:
+                    report.add(uuid, "harvest", "pending")
+        if not save_state:
+            stats["manifest_updates"] = manifest_updates or {}
+            stats["validator_updates"] = validator_updates or {}
+        if manifest_updates and save_state:
+            with metrics().phase("ManifestSave"):
+                save_manifest(manifest_updates)
+        if validator_updates and save_state:
+            with metrics().phase("ValidatorsSave"):
+                save_validators(validator_updates)
+        if stats["failed"]:
+            error_msg = "Could not harvest " + str(stats["failed"]) + " record(s)"
+    else:
+        error_msg = "Could not create S3 bucket: " + bucket
+        #Every record failed, so the caller keeps them for the next run
+        stats["failures"] = {uuid: error_msg for uuid in uuid_list}
+        stats["failed"] = len(stats["failures"])
+
+    return error_msg, stats
+    
+    
+def merge_stats(total, stats):
+    """ Add the counts and failures of stats into total
+    
+    :param total: dict of counts and a 'failures' dict, updated in place
+    :param stats: dict returned by harvest_uuids or delete_uuids
+    :return: total
+    """
+    
+    for key, value in stats.items():
+        if key == "failures":
+            total.setdefault("failures", {}).update(value)
+        elif isinstance(value, list):
+            total.setdefault(key, []).extend(value)
+        elif isinstance(value, int):
+            total[key] = total.get(key, 0) + value
+    return total
+
+def remaining_seconds(context):
+    """ Seconds left before the Lambda timeout, None when not running in Lambda """
+    
+    get_remaining_time = getattr(context, "get_remaining_time_in_millis", None)
+    if get_remaining_time is None:
+        return None
+    return get_remaining_time() / 1000.0
+
+def out_of_time(context):
+    """ True if less than DEADLINE_RESERVE_SECONDS are left before the Lambda timeout """
+    
+    remaining = remaining_seconds(context)
+    return remaining is not None and remaining < DEADLINE_RESERVE_SECONDS
+
+def until_deadline(items, context, pending):
+    """ Yield items until the run is out of time, the items not reached are appended to pending
+    
+    :param items: iterable of work items
+    :param context: Lambda context, None to yield every item
+    :param pending: list receiving the items not yielded
+    """
+    
+    items = iter(items)
+    for item in items:
+        if out_of_time(context):
+            pending.append(item)
+            pending.extend(items)
+            return
+        yield item
+
+def load_pending():
+    """ Return the pending work left by runs that stopped before their deadline
+    
+    :return: dict with the 'insert' and 'delete' lists of uuids, empty if there is none
+    """
+    
+    pending, _ = read_state_object(PENDING_NAME)
+    pending = pending or {}
+    return {"insert": pending.get("insert", []), "delete": pending.get("delete", [])}
+
+def merge_pending(pending, changes):
+    """ Put the pending uuids ahead of the uuids of changes, the newer changes win
+    
+    :param pending: dict returned by load_pending
+    :param changes: ChangeSet of the current run
+    :return: (uuids to harvest, uuids to delete)
+    """
+    
+    pending_insert = [uuid for uuid in pending["insert"] if uuid not in changes.deleted]
+    pending_delete = [uuid for uuid in pending["delete"] if uuid not in changes.inserted]
+    uuid_list = pending_insert + sorted(changes.inserted.difference(pending_insert))
+    uuid_deleted_list = pending_delete + sorted(changes.deleted.difference(pending_delete))
+    return uuid_list, uuid_deleted_list
+
+def save_pending(insert, delete, drained=None, retries=3):
+    """ Update the pending work object
+    
+    The uuids drained by this run are removed, the uuids left to do (not reached, or failed) are added. The write is
+    conditional, so the updates of concurrent runs (e.g., fan-out workers) are merged rather than lost.
+    
+    :param insert: uuids left to harvest, including drained uuids to keep
+    :param delete: uuids left to delete, including drained uuids to keep
+    :param drained: dict returned by load_pending at the start of the run, None if it was not drained
+    :param retries: number of attempts on conflicting writes
+    :return: True if the pending work was saved, else False
+    """
+    
+    drained = drained or {"insert": [], "delete": []}
+    for attempt in range(retries):
+        current, etag = read_state_object(PENDING_NAME)
+        current = current or {}
+        pending = {}
+        for action, left in (("insert", insert), ("delete", delete)):
+            done = set(drained[action])
+            uuids = [uuid for uuid in current.get(action, []) if uuid not in done]
+            seen = set(uuids)
+            pending[action] = uuids + [uuid for uuid in left if uuid not in seen]
+        pending["updated"] = utc_now_iso()
+        try:
+            write_state_object(PENDING_NAME, pending, etag=etag, create_only=etag is None)
+            return True
+        except ClientError as e:
+            if not is_precondition_failed(e) or attempt == retries - 1:
+                logging.error(e)
+                return False
+    return False
+
+def claim_leases(leases, owner, uuids, seconds, now=None):
+    """ Claim the uuids that are free, expired or already held by owner
+    
+    :param leases: dict of uuid to [owner, expiry time], updated in place. Expired leases are dropped
+    :param owner: id of the claiming run
+    :param uuids: list of uuids
+    :param seconds: duration of the new leases
+    :param now: current time in seconds since the epoch
+    :return: list of the claimed uuids
+    """
+    
+    now = time.time() if now is None else now
+    for uuid in [uuid for uuid, (_, expires) in leases.items() if expires <= now]:
+        del leases[uuid]
+    claimed = [uuid for uuid in uuids if uuid not in leases or leases[uuid][0] == owner]
+    for uuid in claimed:
+        leases[uuid] = [owner, now + seconds]
+    return claimed
+
+def release_leases(leases, owner, uuids):
+    """ Drop the leases of owner on uuids, updating leases in place """
+    
+    for uuid in uuids:
+        if uuid in leases and leases[uuid][0] == owner:
+            del leases[uuid]
+
+def lease_shard(uuid):
+    """ Lease object of uuid: its leading hex digit, '_' for a uuid starting with anything else """
+    
+    first = uuid[:1].lower()
+    return first if first and first in "0123456789abcdef" else "_"
+
+class S3LeaseStore:
+    """ Leases kept in state objects, one per leading hex digit of the uuids (see lease_shard and get_lease_store)
+    
+    A claim or a release reads the leases of each object concerned and writes them back on condition
+    that the object still has the ETag read. Of two runs claiming the same uuid at the same time, the
+    second write fails and is retried against the leases of the first, so the runs end up with disjoint
+    sets of uuids. Runs only conflict on the objects of the uuids they share, which are updated concurrently.
+    
+    :param name: name of the state objects, with %s for the shard
+    :param retries: attempts on conflicting writes
+    """
+    
+    def __init__(self, name=LEASES_NAME, retries=5):
+        self.name = name
+        self.retries = retries
+    
+    def update(self, shard, change):
+        name = self.name % shard
+        for attempt in range(self.retries):
+            leases, etag = read_state_object(name)
+            leases = leases or {}
+            result = change(leases)
+            try:
+                write_state_object(name, leases, etag=etag, create_only=etag is None)
+                return result
+            except ClientError as e:
+                if not is_precondition_failed(e) or attempt == self.retries - 1:
+                    raise
+                metrics().count("LeaseConflicts")
+                time.sleep(random.uniform(0, 0.05 * (attempt + 1)))
+    
+    def update_shards(self, uuids, change):
+        """ Apply change(leases, uuids of the shard) to the lease object of every shard of uuids
+        
+        :return: list of ((shard, uuids of the shard), result, exception)
+        """
+        
+        shards = collections.defaultdict(list)
+        for uuid in uuids:
+            shards[lease_shard(uuid)].append(uuid)
+        update = lambda item: self.update(item[0], lambda leases: change(leases, item[1]))
+        return list(run_bounded(update, shards.items(), len(shards)))
+    
+    def claim(self, owner, uuids, seconds):
+        claimed = []
+        for (shard, _), result, e in self.update_shards(uuids, lambda leases, shard_uuids: claim_leases(leases, owner, shard_uuids, seconds)):
+            if e is not None:
+                #Unclaimed, the uuids of the shard are left to a later run
+                logging.error("Could not claim the records of lease object %s: %s", shard, e)
+                metrics().count("LeaseErrors")
+            else:
+                claimed.extend(result)
+        return claimed
+    
+    def release(self, owner, uuids):
+        errors = [e for _, _, e in self.update_shards(uuids, lambda leases, shard_uuids: release_leases(leases, owner, shard_uuids))
+                  if e is not None]
+        if errors:
+            raise errors[0]
+
+class LocalLeaseStore:
+    """ Leases kept in memory, shared by the threads of one process (tests and local runs) """
+    
+    def __init__(self):
+        self.leases = {}
+        self.lock = threading.Lock()
+    
+    def claim(self, owner, uuids, seconds):
+        with self.lock:
+            return claim_leases(self.leases, owner, uuids, seconds)
+    
+    def release(self, owner, uuids):
+        with self.lock:
+            release_leases(self.leases, owner, uuids)
+
+def get_lease_store():
+    """ Return the lease store selected by LEASE_STORE: 's3', 'local' or 'none' (None) """
+    
+    store = _clients.get('leases')
+    if store is None and LEASE_STORE in ('s3', 'local'):
+        with _clients_lock:
+            store = _clients.get('leases')
+            if store is None:
+                store = S3LeaseStore() if LEASE_STORE == 's3' else LocalLeaseStore()
+                _clients['leases'] = store
+    return store
+
+def register_lease_store(store):
+    """ Use store, any object with claim(owner, uuids, seconds) and release(owner, uuids), for the leases """
+    
+    with _clients_lock:
+        _clients['leases'] = store
+
+def new_lease_owner():
+    """ Id of a new lease owner, unique across processes and containers """
+    
+    return "%d-%08x" % (os.getpid(), random.getrandbits(32))
+
+def claim_uuids(uuids, owner):
+    """ Claim uuids for owner, so overlapping runs do not harvest or delete the same records
+    
+    Leases last LEASE_SECONDS, the claims of a run that crashed expire on their own. When the lease
+    store cannot be reached no uuid is claimed, they are all returned as leased by other runs.
+    
+    :param uuids: list of uuids
+    :param owner: id of the claiming run, see new_lease_owner
+    :return: (claimed uuids, uuids leased by other runs), in the order of uuids
+    """
+    
+    store = get_lease_store()
+    if store is None or not uuids:
+        return list(uuids), []
+    try:
+        with metrics().phase("LeaseClaim"):
+            claimed = set(store.claim(owner, uuids, LEASE_SECONDS))
+    except Exception as e:
+        logging.error("Could not claim the records, they are left pending: %s", e)
+        metrics().count("LeaseErrors")
+        return [], list(uuids)
+    busy = [uuid for uuid in uuids if uuid not in claimed]
+    if busy:
+        print(len(busy), "records are leased by another run, left pending")
+        metrics().count("RecordsLeased", len(busy))
+    return [uuid for uuid in uuids if uuid in claimed], busy
+
+def claim_as_read(uuids, owner, claimed, pending, context=None, chunk_size=None, deferred=None):
+    """ Yield the uuids of an iterable claimed by owner, claiming them chunk_size at a time as they
+    are read, so a streamed list is neither read nor claimed ahead of the workers (see claim_uuids)
+    
+    :param uuids: iterable of uuids
+    :param owner: id of the claiming run, see new_lease_owner
+    :param claimed: list receiving the claimed uuids, to release once done
+    :param pending: list receiving the uuids leased by other runs and, once out of time, the uuids not yielded
+    :param context: Lambda context, no uuid is yielded with less than DEADLINE_RESERVE_SECONDS left
+    :param chunk_size: number of uuids claimed at a time, defaults to LEASE_CLAIM_CHUNK_SIZE
+    :param deferred: list also receiving the uuids leased by other runs, if given
+    """
+    
+    uuids = iter(uuids)
+    chunk_size = chunk_size or LEASE_CLAIM_CHUNK_SIZE
+    while True:
+        chunk = list(itertools.islice(uuids, chunk_size))
+        if not chunk:
+            return
+        #The deadline is checked once per uuid yielded, for the first one before the chunk is claimed
+        if out_of_time(context):
+            pending.extend(chunk)
+            pending.extend(uuids)
+            return
+        mine, busy = claim_uuids(chunk, owner)
+        claimed.extend(mine)
+        pending.extend(busy)
+        if deferred is not None:
+            deferred.extend(busy)
+        for i, uuid in enumerate(mine):
+            if i and out_of_time(context):
+                pending.extend(mine[i:])
+                pending.extend(uuids)
+                return
+            yield uuid
+
+def release_uuids(uuids, owner):
+    """ Release the leases of owner on uuids, see claim_uuids """
+    
+    store = get_lease_store()
+    if store is None or not uuids:
+        return
+    try:
+        with metrics().phase("LeaseRelease"):
+            store.release(owner, uuids)
+    except Exception as e:
+        logging.error("Could not release the leases, they expire in %s seconds: %s", LEASE_SECONDS, e)
+        metrics().count("LeaseErrors")
+
+def load_full_reload_cursor():
+    """ Return the resume cursor of the full reload and its ETag, (None, None) if no reload was started """
+    
+    return read_state_object(FULL_RELOAD_NAME)
+
+def full_reload_done(cursor):
+    """ True if the full reload described by cursor walked every window and has no record left pending """
+    
+    return bool(cursor.get("done")) and not cursor.get("pending")
+
+def run_full_reload(gn_change_query, gn_json_record_url_start, gn_json_record_url_end, bucket, bucket_location, geojson_bucket_name, bucket_folder_path=None, context=None, restart=False, force=False, report=None, bundle=None, geojson_folder_path=None):
+    """ Harvest the whole catalogue, one date window of the change api at a time
+    
+    The catalogue is walked from FULL_RELOAD_START to the time the reload was started in windows of
+    FULL_RELOAD_WINDOW_DAYS. After every window the resume cursor is saved to the full_reload.json
+    state object. When the Lambda is about to time out the walk stops and either re-invokes the
+    function (FULL_RELOAD_SELF_INVOKE) or leaves the cursor for the next scheduled run.
+    A window too dense to finish before the timeout saves its unprocessed uuids in the cursor
+    ('pending'); they are processed before the next window. An invocation that made no progress,
+    or whose pending uuids were all deferred by GeoNetwork or leased by another run, does not
+    re-invoke the function: the scheduled hand-off picks the reload up once the cursor is stale.
+    
+    :param gn_change_query: URL of the GeoNetwork change api
+    :param gn_json_record_url_start: starting base path to the geonetwork record api
+    :param gn_json_record_url_end: ending base path to the geonetwork record api
+    :param bucket: bucket to upload to
+    :param bucket_location: region of the bucket
+    :param geojson_bucket_name: bucket to delete the deleted records from
+    :param bucket_folder_path: folder inside the buckets
+    :param context: Lambda context, used to stop before the timeout and to re-invoke the function
+    :param restart: start a new reload even if one is in progress
+    :param force: upload every record even if unchanged
+    :param report: RunReport receiving the outcome of every uuid
+    :param bundle: BundleWriter receiving the records harvested and the uuids deleted, see open_run_bundle
+    :param geojson_folder_path: folder inside the GeoJSON bucket, see geojson_location
+    :return: error message, harvest stats, delete stats and a status message
+    """
+    
+    harvest_stats = {"harvested": 0, "skipped": 0, "failed": 0, "failures": {}}
+    delete_stats = {"deleted": 0, "failed": 0, "failures": {}}
+    
+    cursor, etag = load_full_reload_cursor()
+    if restart or not cursor or full_reload_done(cursor):
+        now = utc_now_iso()
+        cursor = {"cursor": FULL_RELOAD_START, "until": now, "started": now, "force": force,
+                  "windows": 0, "harvested": 0, "deleted": 0, "failed": 0, "done": False}
+        etag = write_state_object(FULL_RELOAD_NAME, cursor, etag=etag)
+    #A forced reload stays forced in the invocations continuing it
+    force = force or cursor.get("force", False)
+    
+    window = datetime.timedelta(days=FULL_RELOAD_WINDOW_DAYS)
+    until = convert_to_datetime(cursor["until"])
+    windows = 0
+    deferred = set()
+    while not full_reload_done(cursor):
+        remaining = remaining_seconds(context)
+        if remaining is not None and remaining < FULL_RELOAD_RESERVE_SECONDS:
+            break
+        
+        pending = cursor.pop("pending", None)
+        if pending:
+            #Finish the window cut short by the previous invocation before moving on
+            uuid_list, uuid_deleted_list = pending.get("insert", []), pending.get("delete", [])
+            window_end = None
+        else:
+            window_start = convert_to_datetime(cursor["cursor"])
+            window_end = min(window_start + window, until)
+            window_end_str = window_end.isoformat().replace('+00:00', 'Z')
+            
+            changes = open_change_feed(gn_change_query, fromDateTime=cursor["cursor"], toDateTime=window_end_str).classify()
+            if changes.error:
+                return changes.error, harvest_stats, delete_stats, "...full reload stopped at " + cursor["cursor"]
+            uuid_list, uuid_deleted_list = changes.inserted, changes.deleted
+        
+        pending = {"insert": [], "delete": []}
+        deferred = set()
+        if uuid_list:
+            _, stats = harvest_uuids(uuid_list, gn_json_record_url_start, gn_json_record_url_end, bucket, bucket_location, bucket_folder_path=bucket_folder_path, force=force, context=context, bundle=bundle, report=report)
+            pending["insert"] = stats.pop("pending", [])
+            deferred.update(stats.pop("deferred", []))
+            merge_stats(harvest_stats, stats)
+            cursor["harvested"] += stats["harvested"] + stats["skipped"]
+            cursor["failed"] += stats["failed"]
+        if uuid_deleted_list:
+            _, stats = delete_uuids(uuid_deleted_list, geojson_bucket_name, folder_path=geojson_folder_path, context=context, report=report)
+            pending["delete"] = stats.pop("pending", [])
+            deferred.update(stats.pop("deferred", []))
+            if bundle is not None:
+                bundle.delete(deleted_uuids(uuid_deleted_list, dict(stats, pending=pending["delete"])))
+            merge_stats(delete_stats, stats)
+            cursor["deleted"] += stats["deleted"]
+            cursor["failed"] += stats["failed"]
+        
+        #Failed records do not hold the cursor back, they are reported in the cursor and the response.
+        #Records left at the deadline are kept in the cursor so the next invocation does not re-read the window
+        if window_end is not None:
+            cursor["cursor"] = window_end_str
+            cursor["windows"] += 1
+            cursor["done"] = window_end >= until
+            windows += 1
+        if pending["insert"] or pending["delete"]:
+            cursor["pending"] = pending
+        cursor["updated"] = utc_now_iso()
+        try:
+            etag = write_state_object(FULL_RELOAD_NAME, cursor, etag=etag, create_only=etag is None)
+        except ClientError as e:
+            if not is_precondition_failed(e):
+                raise
+            #Another invocation is walking the same reload, leave the rest to it
+            return None, harvest_stats, delete_stats, "...full reload continued by another invocation"
+        if cursor.get("pending"):
+            break
+    
+    error_msg = None
+    if harvest_stats["failed"] or delete_stats["failed"]:
+        error_msg = "Could not reload " + str(harvest_stats["failed"] + delete_stats["failed"]) + " record(s)"
+    
+    if full_reload_done(cursor):
+        status = "...full reload complete, " + str(cursor["windows"]) + " window(s) processed"
+    else:
+        status = "...full reload paused at " + cursor["cursor"] + " after " + str(windows) + " window(s)"
+        if cursor.get("pending"):
+            status += " with " + str(len(cursor["pending"]["insert"]) + len(cursor["pending"]["delete"])) + " record(s) of the last window pending"
+        #Re-invoking without progress, or only to meet the same deferred or leased uuids, would loop on GeoNetwork
+        progress = windows or sum(harvest_stats[key] for key in ("harvested", "skipped", "failed")) \
+            or delete_stats["deleted"] + delete_stats["failed"]
+        stalled = cursor.get("pending") and deferred.issuperset(cursor["pending"]["insert"] + cursor["pending"]["delete"])
+        if FULL_RELOAD_SELF_INVOKE and getattr(context, "invoked_function_arn", None) and progress and not stalled:
+            get_lambda_client().invoke(
+                FunctionName=context.invoked_function_arn,
+                InvocationType='Event',
+                Payload=json.dumps({"queryStringParameters": {"runtype": "full"}}).encode('utf-8'),
+            )
+            status += ", continuing in a new invocation"
+        else:
+            status += ", the next scheduled run will continue"
+    return error_msg, harvest_stats, delete_stats, status
+
+def full_reload_handoff_due(cursor):
+    """ True if a scheduled run should continue the full reload described by cursor
+    
+    Without self invocation every scheduled run continues the reload. With it, a scheduled run
+    only takes over once the chain of invocations stopped updating the cursor.
+    """
+    
+    if not cursor or full_reload_done(cursor):
+        return False
+    if not FULL_RELOAD_SELF_INVOKE:
+        return True
+    updated = convert_to_datetime(cursor.get("updated") or cursor["started"])
+    age = datetime.datetime.now(datetime.timezone.utc) - updated
+    return age > datetime.timedelta(minutes=FULL_RELOAD_STALE_MINUTES)
+
+def list_uuids(bucket, folder_path, suffix, workers=None, s3_client=None):
+    """ Inventory of the records stored in bucket, listed in parallel
+    
+    The keys under the folder are split into key ranges at LIST_PARTITION_BOUNDARIES and every
+    range is listed, page by page, by its own worker. The ranges cover every key, whatever its first character.
+    
+    :param bucket: bucket to list
+    :param folder_path: folder inside the bucket holding the records
+    :param suffix: extension of the record keys, e.g., '.json'
+    :param workers: number of ranges listed concurrently, defaults to RECONCILE_LIST_WORKERS
+    :param s3_client: S3 client to list with
+    :return: set of the uuids of the records. Raises the first listing error
+    """
+    
+    if s3_client is None:
+        s3_client = get_s3_client()
+    prefix = folder_path + "/" if folder_path else ""
+    bounds = [None] + [prefix + boundary for boundary in LIST_PARTITION_BOUNDARIES] + [None]
+    partitions = list(zip(bounds[:-1], bounds[1:]))
+    
+    def list_partition(partition):
+        start_after, stop_after = partition
+        keys = []
+        for key in list_keys(bucket, prefix, start_after=start_after, s3_client=s3_client, stop_after=stop_after):
+            name = key[len(prefix):]
+            #State objects, bundles and other folders are not records
+            if name.endswith(suffix) and "/" not in name:
+                keys.append(name[:-len(suffix)])
+        return keys
+    
+    uuids = set()
+    for partition, keys, e in run_bounded(list_partition, partitions, workers or RECONCILE_LIST_WORKERS):
+        if e is not None:
+            raise e
+        metrics().count("ListPartitions")
+        uuids.update(keys)
+    return uuids
+
+def reconcile(gn_change_query, bucket, geojson_bucket_name, bucket_folder_path=None, geojson_folder_path=None):
+    """ Diff the records stored in the buckets against the catalogue
+    
+    The catalogue inventory is the change feed from FULL_RELOAD_START: its latest status tells
+    which uuids exist. Only the difference has to be harvested or deleted, so the work done
+    afterwards is proportional to the drift rather than to the catalogue.
+    
+    No orphan is returned when a window of the change feed could not be read, or when the orphans
+    are more than RECONCILE_MAX_ORPHAN_RATIO of the GeoJSON records: an incomplete inventory
+    would otherwise empty the bucket. The missing records are still returned.
+    
+    :param gn_change_query: URL of the GeoNetwork change api
+    :param bucket: JSON bucket
+    :param geojson_bucket_name: GeoJSON bucket
+    :param bucket_folder_path: folder inside the JSON bucket
+    :param geojson_folder_path: folder inside the GeoJSON bucket, see geojson_location
+    :return: (error message or None, sorted uuids missing from the JSON bucket or from the GeoJSON bucket,
+              sorted uuids of the GeoJSON bucket no longer in the catalogue)
+    """
+    
+    with metrics().phase("ReconcileCatalogue"):
+        changes = open_change_feed(gn_change_query, fromDateTime=FULL_RELOAD_START).classify()
+    if not changes.inserted:
+        #An empty catalogue is far more likely a GeoNetwork problem than a reason to delete every record
+        return changes.error or "The catalogue inventory is empty, nothing was reconciled", [], []
+    
+    try:
+        with metrics().phase("ReconcileList"):
+            stored = list_uuids(bucket, bucket_folder_path, ".json")
+            published = list_uuids(geojson_bucket_name, geojson_folder_path, ".geojson")
+    except ClientError as e:
+        logging.error(e)
+        return "Could not list the buckets: " + str(e), [], []
+    
+    #A record stored without its GeoJSON is written again so the GeoJSON is built again
+    missing = sorted(changes.inserted - (stored & published))
+    orphans = sorted(published - changes.inserted)
+    print("Reconcile:", len(changes.inserted), "records in the catalogue,", len(stored), "in", bucket + ",",
+          len(published), "in", geojson_bucket_name + ",", len(missing), "missing,", len(orphans), "orphaned")
+    metrics().count("RecordsMissing", len(missing))
+    metrics().count("RecordsOrphaned", len(orphans))
+    error_msg = changes.error
+    if orphans and changes.error:
+        #A window that could not be read may hold records still in the catalogue
+        error_msg += ", the " + str(len(orphans)) + " orphaned record(s) were not deleted"
+        orphans = []
+    elif len(orphans) > RECONCILE_MAX_ORPHAN_RATIO * len(published):
+        error_msg = (str(len(orphans)) + " orphaned record(s) out of " + str(len(published)) +
+                     " exceed RECONCILE_MAX_ORPHAN_RATIO, none was deleted")
+        orphans = []
+    if error_msg:
+        logging.error(error_msg)
+    return error_msg, missing, orphans
+
+def fan_out_due(uuid_list):
+    """ True if uuid_list is large enough to be harvested by worker invocations, see FANOUT_THRESHOLD """
+    
+    return FANOUT_THRESHOLD > 0 and len(uuid_list) > FANOUT_THRESHOLD
+
+def make_shards(uuid_list, shard_size=None):
+    """ Split uuid_list into lists of at most shard_size uuids """
+    
+    shard_size = max(1, int(shard_size or FANOUT_SHARD_SIZE))
+    return [uuid_list[i:i + shard_size] for i in range(0, len(uuid_list), shard_size)]
+
+def worker_event(shard, force=False, report=False):
+    """ Event of the worker invocation harvesting the uuids of shard, writing a run report if report """
+    
+    return {
+        "queryStringParameters": {"runtype": "worker", "force": "true" if force else "false",
+                                  "verbose": "true" if report else "false"},
+        "shard": {"insert": shard},
+    }
+
+class LambdaDispatcher:
+    """ Runs each worker event as a synchronous invocation of a Lambda function
+    
+    :param function_name: name or ARN of the function, normally this function
+    :param concurrency: maximum number of invocations in flight
+    """
+    
+    def __init__(self, function_name, concurrency=None):
+        self.function_name = function_name
+        self.concurrency = concurrency or FANOUT_CONCURRENCY
+    
+    def invoke(self, event):
+        result = get_lambda_client().invoke(
+            FunctionName=self.function_name,
+            InvocationType='RequestResponse',
+            Payload=json.dumps(event).encode('utf-8'),
+        )
+        payload = json.loads(result['Payload'].read())
+        if result.get('FunctionError'):
+            raise RuntimeError(payload.get('errorMessage') or result['FunctionError'])
+        return payload
+    
+    def dispatch(self, events):
+        """ Generator of (event, response, exception) tuples in completion order """
+        
+        return run_bounded(self.invoke, events, self.concurrency)
+
+class ProcessPoolDispatcher:
+    """ Runs each worker event through lambda_handler in a local process pool, for tests and local runs
+    
+    :param max_workers: number of processes
+    """
+    
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or FANOUT_CONCURRENCY
+    
+    def dispatch(self, events):
+        """ Generator of (event, response, exception) tuples in completion order """
+        
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(lambda_handler, event, None): event for event in events}
+            for future in as_completed(futures):
+                exception = future.exception()
+                yield futures[future], None if exception else future.result(), exception
+
+def get_dispatcher(context=None):
+    """ Return the dispatcher selected by FANOUT_DISPATCHER
+    
+    :param context: Lambda context, the workers are invocations of the function it describes
+    """
+    
+    if FANOUT_DISPATCHER == "process":
+        return ProcessPoolDispatcher()
+    function_name = getattr(context, "invoked_function_arn", None) or os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    if not function_name:
+        raise ValueError("Fan-out with the lambda dispatcher requires the function name")
+    return LambdaDispatcher(function_name)
+
+def fan_out(uuid_list, dispatcher, force=False, shard_size=None, report=None, context=None):
+    """ Harvest uuid_list in shards, one worker invocation per shard, and aggregate the results
+    
+    :param uuid_list: list of uuids to harvest
+    :param dispatcher: object whose dispatch(events) yields (event, response, exception), see LambdaDispatcher
+    :param force: upload the records even if unchanged
+    :param shard_size: number of uuids per worker, FANOUT_SHARD_SIZE by default
+    :param report: RunReport pointing at the report of each worker, the workers write one when given
+    :param context: Lambda context, no new shard is dispatched with less than DEADLINE_RESERVE_SECONDS left
+    :return: (error message or None, stats) as harvest_uuids, the uuids of the shards not dispatched in stats['pending']
+    """
+    
+    stats = {"harvested": 0, "skipped": 0, "failed": 0, "failures": {}, "pending": []}
+    shards = make_shards(uuid_list, shard_size)
+    metrics().count("Shards", len(shards))
+    pending_shards = []
+    events = (worker_event(shard, force=force, report=report is not None)
+              for shard in until_deadline(shards, context, pending_shards))
+    for event, response, e in dispatcher.dispatch(events):
+        shard = event["shard"]["insert"]
+        try:
+            if e is not None:
+                raise e
+            body = json.loads(response["body"])
+            merge_stats(stats, {
+                "harvested": int(body["harvestCount"]),
+                "skipped": int(body["skippedCount"]),
+                "failed": int(body["failedCount"]),
+                "failures": body.get("failures", {}),
+            })
+            if report is not None and body.get("report"):
+                report.add_report(body["report"], len(shard))
+        except Exception as e:
+            #The whole shard is reported as failed, and retried by the next run
+            print("Worker for", len(shard), "record(s) failed:", e)
+            metrics().count("ShardErrors")
+            stats["failed"] += len(shard)
+            stats["failures"].update({uuid: str(e) for uuid in shard})
+            if report is not None:
+                for uuid in shard:
+                    report.add(uuid, "harvest", "failed", str(e))
+    for shard in pending_shards:
+        stats["pending"].extend(shard)
+    if stats["pending"]:
+        metrics().count("RecordsPending", len(stats["pending"]))
+        if report is not None:
+            for uuid in stats["pending"]:
+                report.add(uuid, "harvest", "pending")
+    
+    error_msg = None
+    if stats["failed"]:
+        error_msg = "Could not harvest " + str(stats["failed"]) + " record(s)"
+    return error_msg, stats
+
+def delete_uuids(uuid_deleted_list, bucket, folder_path=None, workers=None, context=None, report=None):
+    """ Delete the json files in uuid_deleted_list from a s3 bucket
+    Return a message to the user: delete xx uuid from xx bucket 
+    
+    Keys are grouped into DeleteObjects batches of DELETE_BATCH_SIZE and the batches
+    are sent concurrently.
+
+    :parm uuid_deleted_list: a list of uuid needs to be deleted 
+    :parm bucket:bucket to delete from 
+    :parm folder_path: folder inside the bucket where the files reside
+    :parm workers: number of batches deleted concurrently, defaults to HARVEST_WORKERS
+    :parm context: Lambda context, no new batch is started with less than DEADLINE_RESERVE_SECONDS left.
+                   The uuids leased by another run (see claim_uuids) are not deleted and left pending
+    :parm report: RunReport receiving the outcome of every uuid
+    :return: accumulated error messages and a dict with the deleted/failed counts,
+             the failure reason of each failed uuid and the uuids left pending at the deadline
+             or, listed again in 'deferred', leased by another run
+    """
+    error_msg = None 
+    stats = {"deleted": 0, "failed": 0, "failures": {}, "pending": [], "deferred": []}
+    
+    if workers is None:
+        workers = HARVEST_WORKERS
+    
+    owner = new_lease_owner()
+    uuid_deleted_list, busy = claim_uuids(list(uuid_deleted_list), owner)
+    stats["pending"].extend(busy)
+    stats["deferred"].extend(busy)
+    
+    keys = {}
+    for uuid in uuid_deleted_list:
+        uuid_filename = uuid + ".geojson"
+        if folder_path:
+            uuid_filename = f"{folder_path}/{uuid_filename}"
+        keys[uuid_filename] = uuid
+    key_list = list(keys)
+    batches = [key_list[i:i + DELETE_BATCH_SIZE] for i in range(0, len(key_list), DELETE_BATCH_SIZE)]
+    
+    pending_batches = []
+    deleted = []
+    for batch, errors, e in run_bounded(lambda batch: delete_json_batch(batch, bucket), until_deadline(batches, context, pending_batches), workers):
+        if e is not None:
+            logging.error(e)
+            errors = {key: str(e) for key in batch}
+        metrics().count("DeleteBatches")
+        metrics().count("RecordsDeleted", len(batch) - len(errors))
+        metrics().count("DeleteErrors", len(errors))
+        stats["deleted"] += len(batch) - len(errors)
+        deleted.extend(keys[key] for key in batch if key not in errors)
+        for key, reason in errors.items():
+            stats["failed"] += 1
+            stats["failures"][keys[key]] = reason
+        if report is not None:
+            for key in batch:
+                if key in errors:
+                    report.add(keys[key], "delete", "failed", errors[key])
+                else:
+                    report.add(keys[key], "delete", "deleted")
+    if deleted:
+        forget_uuids(deleted)
+    release_uuids(uuid_deleted_list, owner)
+    print('Deleted', stats["deleted"], " records")
+    for batch in pending_batches:
+        stats["pending"].extend(keys[key] for key in batch)
+    if report is not None:
+        for uuid in stats["pending"]:
+            report.add(uuid, "delete", "pending")
+    if stats["pending"]:
+        metrics().count("RecordsPending", len(stats["pending"]))
+    if stats["failed"]:
+        error_msg = "Could not delete " + str(stats["failed"]) + " record(s)"
+        
+    return error_msg, stats
+
+def delete_json_batch(keys, bucket, s3_client=None):
+    """Delete up to 1000 objects from an S3 bucket with a single DeleteObjects call.
+
+    :param keys: list of object keys to delete
+    :param bucket: Bucket to delete from
+    :param s3_client: S3 client to delete with. If not specified, the shared client is used
+    :return: dict of key to error message for every key that could not be deleted
+    """
+    if s3_client is None:
+        s3_client = get_s3_client()
+    
+    start = time.perf_counter()
+    response = s3_client.delete_objects(
+        Bucket=bucket,
+        Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True},
+    )
+    metrics().observe("DeleteBatch", time.perf_counter() - start)
+    return {error['Key']: error.get('Code', '') + ": " + error.get('Message', '')
+            for error in response.get('Errors', [])}
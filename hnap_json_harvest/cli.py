@@ -0,0 +1,338 @@
+""" Command-line backfill of the HNAP JSON harvest
+
+Harvests a list of uuids, or the change feed between two dates, from a single machine instead of one
+Lambda invocation per date window. The uuids are split into chunks harvested by a pool of processes,
+each process fetching and uploading with --workers threads through the same code as the Lambda
+function (app.harvest_uuids and app.delete_uuids). Progress is printed to stderr and a JSON summary
+to stdout.
+
+With --checkpoint, the outcome of every chunk is appended to the checkpoint file as it completes.
+Running the same command again skips the uuids already harvested or deleted and retries the failed ones.
+
+    python -m hnap_json_harvest.cli --from-date 2021-01-01T00:00:00Z --processes 8 --checkpoint backfill.ndjson
+    python -m hnap_json_harvest.cli --uuids uuids.txt --force
+    cat uuids.txt | python -m hnap_json_harvest.cli --uuids -
+
+The settings are read from the same environment variables as the function, see README.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from hnap_json_harvest import app
+
+CHUNK_SIZE = 200
+STATE_SAVE_CHUNKS = 20 #the manifest and validators are saved after this many chunks, and at the end
+PROGRESS_INTERVAL_SECONDS = 1.0
+
+
+def read_uuids(stream):
+    """ Read one uuid per line, ignoring blank lines and '#' comments
+
+    :param stream: text file object
+    :return: list of unique uuids, in the order they were read
+    """
+
+    uuids = {}
+    for line in stream:
+        uuid = line.strip()
+        if uuid and not uuid.startswith("#"):
+            uuids[uuid] = None
+    return list(uuids)
+
+
+def load_checkpoint(path):
+    """ Read the uuids already harvested and deleted from a checkpoint file
+
+    A truncated last line, e.g., of an interrupted run, is ignored.
+
+    :param path: path of the checkpoint file, which may not exist yet
+    :return: (set of harvested uuids, set of deleted uuids)
+    """
+
+    done, deleted = set(), set()
+    if not path or not os.path.exists(path):
+        return done, deleted
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            done.update(entry.get("done", []))
+            deleted.update(entry.get("deleted", []))
+            #A uuid failing in a later run is retried by the next one
+            done.difference_update(entry.get("failed", {}))
+    return done, deleted
+
+
+def append_checkpoint(path, entry):
+    """ Append one entry to the checkpoint file, flushed to disk before returning """
+
+    if not path:
+        return
+    with open(path, "ab+") as f:
+        line = json.dumps(entry).encode("utf-8") + b"\n"
+        if f.tell():
+            #Start a new line after the truncated last line of an interrupted run
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                line = b"\n" + line
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class Progress:
+    """ Prints the progress of a backfill to stderr, at most once per PROGRESS_INTERVAL_SECONDS
+
+    :param total: number of uuids to process
+    :param stream: file object written to, None to stay silent
+    """
+
+    def __init__(self, total, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.done = 0
+        self.failed = 0
+        self.start = time.monotonic()
+        self.printed = 0.0
+
+    def update(self, done, failed=0, final=False):
+        self.done += done
+        self.failed += failed
+        now = time.monotonic()
+        if self.stream is None or (not final and now - self.printed < PROGRESS_INTERVAL_SECONDS):
+            return
+        self.printed = now
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate else 0.0
+        self.stream.write("\r%d/%d records, %.1f/s, %d failed, ETA %s%s" % (
+            self.done, self.total, rate, self.failed, time.strftime("%H:%M:%S", time.gmtime(eta)),
+            "\n" if final else ""))
+        self.stream.flush()
+
+
+def use_concurrency(workers, gn_concurrency=None):
+    """ Harvest workers records at a time in this process, with up to gn_concurrency (default: workers)
+    GeoNetwork requests in flight instead of GN_MAX_CONCURRENCY
+
+    The clients are created again, with a connection pool large enough for the workers.
+    """
+
+    app.HARVEST_WORKERS = workers
+    app.HTTP_POOL_SIZE = max(app.HTTP_POOL_SIZE, workers)
+    app.reset_clients(keep_registered=True)
+    app.set_gn_concurrency(gn_concurrency or workers)
+
+
+def init_worker(config, workers, gn_concurrency=None):
+    """ Set up a pool process: the parent's settings, and clients of its own """
+
+    app.set_config(config)
+    #Sessions inherited from the parent must not be shared across processes
+    use_concurrency(workers, gn_concurrency)
+
+
+def harvest_chunk(chunk, force=False):
+    """ Harvest one chunk of uuids, in a pool process or in the parent
+
+    The manifest and validator updates are returned for the parent to save, so the state
+    objects are written once per STATE_SAVE_CHUNKS chunks rather than by every process.
+
+    :param chunk: list of uuids
+    :param force: upload the records even if unchanged
+    :return: dict with the harvested/skipped counts, the uuids done, the failures, the uuids leased
+             by another run and the state updates
+    """
+
+    config = app.get_config()
+    bucket, bucket_folder_path = (config.json_bucket_name.split("/", 1) + [None])[:2]
+    error_msg, stats = app.harvest_uuids(chunk, config.gn_json_record_url_start, app.GN_JSON_RECORD_URL_END,
+                                         bucket, app.BUCKET_LOCATION, bucket_folder_path=bucket_folder_path,
+                                         force=force, save_state=False)
+    failures = stats["failures"]
+    if error_msg and not failures and not stats["harvested"] and not stats["skipped"]:
+        #The bucket could not be created, nothing was attempted
+        failures = {uuid: error_msg for uuid in chunk}
+    not_done = set(failures).union(stats["pending"])
+    return {
+        "harvested": stats["harvested"],
+        "skipped": stats["skipped"],
+        "done": [uuid for uuid in chunk if uuid not in not_done],
+        "failures": failures,
+        "pending": stats["pending"],
+        "manifest_updates": stats.get("manifest_updates", {}),
+        "validator_updates": stats.get("validator_updates", {}),
+    }
+
+
+def iter_chunks(chunks, processes, workers, force=False, gn_concurrency=None):
+    """ Harvest chunks, in a pool of processes or in this process when processes is 0
+
+    :return: generator of (chunk, result of harvest_chunk or None, exception or None) in completion order
+    """
+
+    if not processes:
+        use_concurrency(workers, gn_concurrency)
+        for chunk in chunks:
+            try:
+                yield chunk, harvest_chunk(chunk, force=force), None
+            except Exception as e:
+                yield chunk, None, e
+        return
+
+    #fork keeps the clients registered by the caller (e.g., a local S3 stand-in) and starts quickly
+    methods = multiprocessing.get_all_start_methods()
+    mp_context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    with ProcessPoolExecutor(max_workers=processes, mp_context=mp_context, initializer=init_worker,
+                             initargs=(app.get_config(), workers, gn_concurrency)) as executor:
+        futures = {executor.submit(harvest_chunk, chunk, force): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            exception = future.exception()
+            yield futures[future], None if exception else future.result(), exception
+
+
+def save_state(manifest_updates, validator_updates):
+    """ Save and clear the accumulated manifest and validator updates """
+
+    if manifest_updates and app.save_manifest(manifest_updates):
+        manifest_updates.clear()
+    if validator_updates and app.save_validators(validator_updates):
+        validator_updates.clear()
+
+
+def run_backfill(uuid_list, uuid_deleted_list=(), processes=None, workers=None, chunk_size=None, force=False,
+                 checkpoint=None, progress_stream=sys.stderr, gn_concurrency=None):
+    """ Harvest uuid_list and delete uuid_deleted_list, resuming from checkpoint
+
+    :param uuid_list: list of uuids to harvest
+    :param uuid_deleted_list: list of uuids to delete from the GeoJSON bucket
+    :param processes: number of harvest processes, 0 to harvest in this process, defaults to the CPU count
+    :param workers: concurrent records per process, defaults to HARVEST_WORKERS
+    :param chunk_size: number of uuids handed to a process at a time, defaults to CHUNK_SIZE
+    :param force: upload the records even if unchanged
+    :param checkpoint: path of the checkpoint file, None to not keep one
+    :param progress_stream: file object receiving the progress, None for none
+    :param gn_concurrency: GeoNetwork requests in flight per process, defaults to workers
+    :return: dict with the harvested/skipped/failed/deleted counts, the failure reason of each
+             failed uuid, the number of uuids leased by another run (left for the next run of the
+             command) and the number of uuids skipped because the checkpoint has them
+    """
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    workers = workers or app.HARVEST_WORKERS
+    chunk_size = chunk_size or CHUNK_SIZE
+    config = app.get_config()
+    stats = {"harvested": 0, "skipped": 0, "failed": 0, "deleted": 0, "pending": 0, "failures": {}, "resumed": 0}
+
+    done, deleted = load_checkpoint(checkpoint)
+    todo = [uuid for uuid in uuid_list if uuid not in done]
+    todo_deleted = [uuid for uuid in uuid_deleted_list if uuid not in deleted]
+    stats["resumed"] = len(uuid_list) - len(todo) + len(uuid_deleted_list) - len(todo_deleted)
+    chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    progress = Progress(len(todo), stream=progress_stream)
+
+    manifest_updates, validator_updates = {}, {}
+    try:
+        results = iter_chunks(chunks, processes, workers, force=force, gn_concurrency=gn_concurrency)
+        for count, (chunk, result, e) in enumerate(results, 1):
+            if e is not None:
+                result = {"harvested": 0, "skipped": 0, "done": [], "failures": {uuid: str(e) for uuid in chunk},
+                          "pending": [], "manifest_updates": {}, "validator_updates": {}}
+            stats["harvested"] += result["harvested"]
+            stats["skipped"] += result["skipped"]
+            stats["failed"] += len(result["failures"])
+            stats["failures"].update(result["failures"])
+            stats["pending"] += len(result["pending"])
+            manifest_updates.update(result["manifest_updates"])
+            validator_updates.update(result["validator_updates"])
+            if count % STATE_SAVE_CHUNKS == 0:
+                save_state(manifest_updates, validator_updates)
+            append_checkpoint(checkpoint, {"done": result["done"], "failed": result["failures"]})
+            progress.update(len(chunk), len(result["failures"]))
+    finally:
+        save_state(manifest_updates, validator_updates)
+    progress.update(0, final=True)
+
+    if todo_deleted:
+        geojson_bucket_name, geojson_folder_path = app.geojson_location(config)
+        error_msg, delete_stats = app.delete_uuids(todo_deleted, geojson_bucket_name, folder_path=geojson_folder_path,
+                                                   workers=workers)
+        stats["deleted"] = delete_stats["deleted"]
+        stats["failed"] += delete_stats["failed"]
+        stats["failures"].update(delete_stats["failures"])
+        stats["pending"] += len(delete_stats["pending"])
+        not_deleted = set(delete_stats["failures"]).union(delete_stats["pending"])
+        append_checkpoint(checkpoint, {"deleted": [uuid for uuid in todo_deleted if uuid not in not_deleted]})
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_argument_group("records")
+    source.add_argument("--uuids", metavar="FILE", help="file with one uuid per line to harvest, '-' for stdin")
+    source.add_argument("--from-date", help="harvest the change feed from this ISO 8601 datetime")
+    source.add_argument("--to-date", help="harvest the change feed up to this ISO 8601 datetime")
+    parser.add_argument("--processes", type=int, default=None, help="harvest processes, 0 for none (default: CPU count)")
+    parser.add_argument("--workers", type=int, default=None, help="concurrent records per process (default: HARVEST_WORKERS)")
+    parser.add_argument("--gn-concurrency", type=int, default=None,
+                        help="GeoNetwork requests in flight per process (default: --workers)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="uuids handed to a process at a time")
+    parser.add_argument("--checkpoint", metavar="FILE", help="append progress to FILE and skip the uuids it has done")
+    parser.add_argument("--force", action="store_true", help="upload every record even if unchanged")
+    parser.add_argument("--quiet", action="store_true", help="do not print the progress")
+    overrides = parser.add_argument_group("settings, instead of the environment variables")
+    overrides.add_argument("--bucket", dest="BUCKET_NAME", help="JSON 'bucket[/folder]'")
+    overrides.add_argument("--geojson-bucket", dest="GEOJSON_BUCKET_NAME", help="GeoJSON 'bucket[/folder]'")
+    overrides.add_argument("--base-url", dest="BASE_URL", help="GeoNetwork base URL")
+    overrides.add_argument("--record-url-start", dest="GN_JSON_RECORD_URL_START", help="start of the GeoNetwork record URL")
+    args = parser.parse_args(argv)
+
+    if bool(args.uuids) == bool(args.from_date or args.to_date):
+        parser.error("give either --uuids or a --from-date/--to-date range")
+    for value in (args.from_date, args.to_date):
+        if value and not app.datetime_valid(value):
+            parser.error("not an ISO 8601 datetime: " + value)
+    environ = dict(os.environ)
+    environ.update({name: value for name, value in vars(args).items() if name.isupper() and value})
+    try:
+        app.set_config(app.load_config(environ))
+    except app.ConfigError as e:
+        parser.error(str(e))
+
+    app.start_run_metrics()
+    uuid_deleted_list = []
+    if args.uuids == "-":
+        uuid_list = read_uuids(sys.stdin)
+    elif args.uuids:
+        with open(args.uuids) as f:
+            uuid_list = read_uuids(f)
+    else:
+        feed = app.open_change_feed(app.get_config().base_url + app.GN_CHANGE_API_PATH,
+                              fromDateTime=args.from_date, toDateTime=args.to_date)
+        changes = feed.classify()
+        if changes.error:
+            print(changes.error, file=sys.stderr)
+            return 1
+        uuid_list, uuid_deleted_list = sorted(changes.inserted), sorted(changes.deleted)
+
+    stats = run_backfill(uuid_list, uuid_deleted_list, processes=args.processes, workers=args.workers,
+                         chunk_size=args.chunk_size, force=args.force, checkpoint=args.checkpoint,
+                         progress_stream=None if args.quiet else sys.stderr, gn_concurrency=args.gn_concurrency)
+    print(json.dumps({key: value for key, value in stats.items() if key != "failures"}))
+    for uuid, reason in sorted(stats["failures"].items()):
+        print("Failed: %s: %s" % (uuid, reason), file=sys.stderr)
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
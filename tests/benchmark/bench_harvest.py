@@ -0,0 +1,144 @@
+""" Offline harvest benchmark
+
+Runs the harvest against a local fake GeoNetwork and an in-memory S3 stand-in and reports
+records/sec, p50/p99 per-record latency and peak RSS.
+
+    python -m tests.benchmark.bench_harvest --records 2000 --gn-latency-ms 20 --workers 1,4,16
+    python -m tests.benchmark.bench_harvest --mode handler --records 5000 --record-size 20000
+"""
+
+import argparse
+import json
+import math
+import os
+import resource
+import sys
+import time
+
+from tests.fakes import FakeGeoNetwork, InMemoryS3
+
+JSON_RECORD_URL_END = "/formatters/json?addSchemaLocation=true&attachment=false&withInfo=false"
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of values, 0.0 if empty """
+
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = math.ceil(pct / 100.0 * len(ordered))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MB """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def load_app(geonetwork):
+    """ Import app, with the configuration it requires at import pointing at the fake GeoNetwork """
+
+    for name, value in {
+        "BUCKET_NAME": "bench-json/records",
+        "GEOJSON_BUCKET_NAME": "bench-geojson/records",
+        "BASE_URL": geonetwork.base_url,
+        "GN_JSON_RECORD_URL_START": geonetwork.record_url_start,
+        "RUN_INTERVAL_MINUTES": "11",
+    }.items():
+        os.environ.setdefault(name, value)
+    from hnap_json_harvest import app
+    return app
+
+
+def run_once(app, geonetwork, mode, workers, s3_latency):
+    """ Run one harvest and return its measurements """
+
+    app.reset_clients()
+    app.register_s3_client(InMemoryS3(latency=s3_latency))
+    app.HARVEST_WORKERS = workers
+    latencies = []
+    harvest_uuids = app.harvest_uuids
+
+    def measured_harvest_uuids(*args, **kwargs):
+        error_msg, stats = harvest_uuids(*args, **kwargs)
+        latencies.extend(stats.get("latencies", []))
+        return error_msg, stats
+
+    app.harvest_uuids = measured_harvest_uuids
+    start = time.perf_counter()
+    try:
+        if mode == "handler":
+            event = {"queryStringParameters": {"fromDateTime": "2022-04-13T00:00:00Z", "force": "true"}}
+            body = json.loads(app.lambda_handler(event, None)["body"])
+            harvested = int(body["harvestCount"])
+        else:
+            _, stats = app.harvest_uuids(geonetwork.uuids, geonetwork.record_url_start, JSON_RECORD_URL_END,
+                                         "bench-json", "ca-central-1", bucket_folder_path="records",
+                                         workers=workers, force=True)
+            harvested = stats["harvested"]
+    finally:
+        app.harvest_uuids = harvest_uuids
+    elapsed = time.perf_counter() - start
+
+    return {
+        "mode": mode,
+        "workers": workers,
+        "records": harvested,
+        "seconds": round(elapsed, 3),
+        "records_per_sec": round(harvested / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def run_benchmark(records=500, record_size=4096, gn_latency=0.0, gn_jitter=0.0, s3_latency=0.0,
+                  workers=(8,), mode="harvest", repeat=1):
+    """ Run the benchmark for each worker count
+
+    :return: list of result dicts, one per worker count and repetition
+    """
+
+    results = []
+    with FakeGeoNetwork(record_count=records, record_size=record_size, latency=gn_latency, jitter=gn_jitter) as geonetwork:
+        app = load_app(geonetwork)
+        settings = (app._config, app.HARVEST_WORKERS)
+        app.set_config(app.get_config()._replace(base_url=geonetwork.base_url,
+                                                 gn_json_record_url_start=geonetwork.record_url_start))
+        try:
+            for worker_count in workers:
+                for _ in range(repeat):
+                    results.append(run_once(app, geonetwork, mode, worker_count, s3_latency))
+        finally:
+            app.set_config(settings[0])
+            app.HARVEST_WORKERS = settings[1]
+            app.reset_clients()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["harvest", "handler"], default="harvest",
+                        help="drive harvest_uuids directly or lambda_handler end to end")
+    parser.add_argument("--records", type=int, default=500, help="number of records in the fake catalogue")
+    parser.add_argument("--record-size", type=int, default=4096, help="approximate size of each record in bytes")
+    parser.add_argument("--gn-latency-ms", type=float, default=0.0, help="latency of each GeoNetwork request")
+    parser.add_argument("--gn-jitter-ms", type=float, default=0.0, help="random extra GeoNetwork latency")
+    parser.add_argument("--s3-latency-ms", type=float, default=0.0, help="latency of each S3 call")
+    parser.add_argument("--workers", default="8", help="comma separated worker counts, e.g., 1,4,16")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per worker count")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(records=args.records, record_size=args.record_size,
+                            gn_latency=args.gn_latency_ms / 1000.0, gn_jitter=args.gn_jitter_ms / 1000.0,
+                            s3_latency=args.s3_latency_ms / 1000.0,
+                            workers=[int(w) for w in args.workers.split(",")], mode=args.mode, repeat=args.repeat)
+    for result in results:
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
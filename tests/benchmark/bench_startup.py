@@ -0,0 +1,133 @@
+""" Cold start benchmark
+
+Measures, each in a fresh Python process: the import time of app, the latency of the first
+(cold) invocation against a local fake GeoNetwork and an in-memory S3 stand-in, the latency of a
+second (warm) invocation and the time to create the real boto3 S3 client, which the offline run
+replaces with the stand-in. The median of the runs is checked against the cold start budget.
+
+    python -m tests.benchmark.bench_startup --runs 5 --check
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Budget of a cold start on a developer machine, in milliseconds. Lambda CPUs are slower, keep headroom
+IMPORT_BUDGET_MS = 150
+COLD_START_BUDGET_MS = 1500
+# Modules that must not be loaded by importing app
+HEAVY_MODULES = ("boto3", "botocore.session", "requests", "urllib.request", "xml.dom.minidom")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def measure():
+    """ Run in the child process: print the measurements of one cold start as JSON """
+
+    start = time.perf_counter()
+    from hnap_json_harvest import app
+    import_ms = (time.perf_counter() - start) * 1000
+    heavy = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    from tests.fakes import FakeGeoNetwork, InMemoryS3
+
+    with FakeGeoNetwork(record_count=20, record_size=2048) as geonetwork:
+        os.environ["BASE_URL"] = geonetwork.base_url
+        os.environ["GN_JSON_RECORD_URL_START"] = geonetwork.record_url_start
+        event = {"queryStringParameters": {"fromDateTime": "2022-04-13T00:00:00Z"}}
+
+        start = time.perf_counter()
+        app.get_s3_client("ca-central-1")
+        s3_client_ms = (time.perf_counter() - start) * 1000
+        app.reset_clients()
+        app.register_s3_client(InMemoryS3())
+
+        timings = []
+        for _ in range(2):
+            start = time.perf_counter()
+            app.lambda_handler(event, None)
+            timings.append((time.perf_counter() - start) * 1000)
+
+    return {
+        "import_ms": round(import_ms, 1),
+        "first_invocation_ms": round(timings[0], 1),
+        "warm_invocation_ms": round(timings[1], 1),
+        "s3_client_ms": round(s3_client_ms, 1),
+        "cold_start_ms": round(import_ms + timings[0] + s3_client_ms, 1),
+        "heavy_modules_at_import": heavy,
+    }
+
+
+def run_once():
+    """ Measure one cold start in a fresh interpreter """
+
+    env = dict(os.environ)
+    env.update({
+        "BUCKET_NAME": "bench-json/records",
+        "GEOJSON_BUCKET_NAME": "bench-geojson/records",
+        "BASE_URL": "http://127.0.0.1",
+        "GN_JSON_RECORD_URL_START": "http://127.0.0.1/geonetwork/srv/api/0.1/records/",
+        "RUN_INTERVAL_MINUTES": "11",
+        "AWS_DEFAULT_REGION": "ca-central-1",
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+    })
+    output = subprocess.run([sys.executable, "-m", "tests.benchmark.bench_startup", "--child"], cwd=ROOT, env=env,
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    # The run metrics of the invocations are printed too, the measurements are the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_benchmark(runs=5):
+    """ Measure runs cold starts
+
+    :return: (list of result dicts, dict of the median of each measurement)
+    """
+
+    results = [run_once() for _ in range(runs)]
+    median = {key: round(statistics.median(result[key] for result in results), 1)
+              for key in results[0] if key != "heavy_modules_at_import"}
+    median["heavy_modules_at_import"] = sorted({name for result in results for name in result["heavy_modules_at_import"]})
+    return results, median
+
+
+def over_budget(median):
+    """ List of the budget violations of median measurements """
+
+    problems = []
+    if median["import_ms"] > IMPORT_BUDGET_MS:
+        problems.append("import took %.1f ms, budget %d ms" % (median["import_ms"], IMPORT_BUDGET_MS))
+    if median["cold_start_ms"] > COLD_START_BUDGET_MS:
+        problems.append("cold start took %.1f ms, budget %d ms" % (median["cold_start_ms"], COLD_START_BUDGET_MS))
+    if median["heavy_modules_at_import"]:
+        problems.append("importing app loads " + ", ".join(median["heavy_modules_at_import"]))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="number of cold starts measured")
+    parser.add_argument("--check", action="store_true", help="exit with an error if the median is over budget")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(measure()))
+        return 0
+
+    results, median = run_benchmark(args.runs)
+    for result in results:
+        print(json.dumps(result))
+    print(json.dumps(dict(median, summary="median")))
+    problems = over_budget(median)
+    for problem in problems:
+        print("Over budget: " + problem, file=sys.stderr)
+    return 1 if args.check and problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
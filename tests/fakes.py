@@ -0,0 +1,316 @@
+""" Local stand-ins for GeoNetwork and S3, used by the unit tests and the benchmarks """
+
+import datetime
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from botocore.exceptions import ClientError
+
+GN_API_PATH = "/geonetwork/srv/api/0.1/records/"
+GN_CHANGE_API_PATH = GN_API_PATH + "status/change"
+
+
+def parse_utc(value):
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class FakeGeoNetwork:
+    """ Local GeoNetwork serving the change api and the JSON formatter
+
+    :param record_count: number of records in the catalogue
+    :param record_size: approximate size in bytes of each JSON record
+    :param latency: seconds each request waits before responding
+    :param jitter: extra random latency in seconds, up to this value
+    :param deleted_every: every nth record of the change feed has the 'deleted' status, 0 for none
+    :param modified_time: lastModifiedTime of every change record
+    """
+
+    def __init__(self, record_count=100, record_size=4096, latency=0.0, jitter=0.0, deleted_every=0,
+                 modified_time="2022-04-13T10:00:00Z"):
+        self.uuids = ["00000000-0000-4000-8000-%012d" % i for i in range(record_count)]
+        self.record_size = record_size
+        self.latency = latency
+        self.jitter = jitter
+        self.deleted_every = deleted_every
+        self.modified_time = modified_time
+        self.requests = []
+        self.server = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    @property
+    def record_url_start(self):
+        return self.base_url + GN_API_PATH
+
+    def record(self, uuid):
+        record = {"id": uuid, "title": {"en": "Record " + uuid, "fr": "Enregistrement " + uuid}}
+        padding = max(0, self.record_size - len(json.dumps(record)) - 16)
+        record["abstract"] = "x" * padding
+        return record
+
+    def change_feed(self, date_from=None, date_to=None):
+        """ Change records, none if modified_time is outside of the dateFrom/dateTo of the query """
+
+        modified = parse_utc(self.modified_time)
+        if (date_from and modified < parse_utc(date_from)) or (date_to and modified > parse_utc(date_to)):
+            return {"records": []}
+        records = []
+        for i, uuid in enumerate(self.uuids):
+            deleted = self.deleted_every and (i + 1) % self.deleted_every == 0
+            records.append({"uuid": uuid, "status": "deleted" if deleted else "updated",
+                            "lastModifiedTime": self.modified_time})
+        return {"records": records}
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, data):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                fake.requests.append((url.path, parse_qs(url.query)))
+                delay = fake.latency + (random.random() * fake.jitter if fake.jitter else 0.0)
+                if delay:
+                    time.sleep(delay)
+                if url.path == GN_CHANGE_API_PATH:
+                    query = parse_qs(url.query)
+                    self.send_json(200, fake.change_feed(query.get("dateFrom", [None])[0], query.get("dateTo", [None])[0]))
+                elif url.path.startswith(GN_API_PATH) and url.path.endswith("/formatters/json"):
+                    uuid = url.path[len(GN_API_PATH):-len("/formatters/json")]
+                    self.send_json(200, fake.record(uuid))
+                else:
+                    self.send_json(404, {"message": "Not found"})
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+class InMemoryS3:
+    """ In-memory stand-in for the S3 client calls made by app
+
+    Objects are kept as {(bucket, key): (body, etag, metadata)}. Conditional writes
+    (IfMatch/IfNoneMatch) and conditional reads (IfNoneMatch) behave like S3.
+
+    :param latency: seconds each call waits before returning
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+        self.puts = []
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _error(code, operation="S3"):
+        return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def body(self, bucket, key):
+        return self.objects[(bucket, key)][0]
+
+    def keys(self, bucket, prefix=""):
+        return sorted(key for (b, key) in self.objects if b == bucket and key.startswith(prefix))
+
+    def head_bucket(self, Bucket):
+        self._wait()
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        self._wait()
+        if not isinstance(Body, bytes):
+            Body = Body.read()
+        with self.lock:
+            current = self.objects.get((Bucket, Key))
+            if IfNoneMatch == "*" and current is not None:
+                raise self._error("PreconditionFailed", "PutObject")
+            if IfMatch is not None and (current is None or current[1] != IfMatch):
+                raise self._error("PreconditionFailed", "PutObject")
+            etag = '"%s"' % hashlib.md5(Body).hexdigest()
+            self.objects[(Bucket, Key)] = (Body, etag, kwargs)
+            self.puts.append(Key)
+        return {"ETag": etag}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, Range=None):
+        self._wait()
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise self._error("NoSuchKey", "GetObject")
+            body, etag, metadata = self.objects[(Bucket, Key)]
+        if IfNoneMatch == etag:
+            raise self._error("304", "GetObject")
+        if Range:
+            start, end = Range.replace("bytes=", "").split("-")
+            body = body[int(start):int(end) + 1]
+        response = {"Body": io.BytesIO(body), "ETag": etag, "ContentLength": len(body)}
+        response.update(metadata)
+        return response
+
+    def list_objects_v2(self, Bucket, Prefix="", StartAfter="", ContinuationToken=None, MaxKeys=1000):
+        self._wait()
+        with self.lock:
+            keys = [key for key in self.keys(Bucket, Prefix) if key > (ContinuationToken or StartAfter or "")]
+        page = keys[:MaxKeys]
+        response = {"KeyCount": len(page), "IsTruncated": len(keys) > MaxKeys,
+                    "Contents": [{"Key": key, "Size": len(self.objects[(Bucket, key)][0])} for key in page]}
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = page[-1]
+        return response
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._wait()
+        with self.lock:
+            upload_id = "upload-%d" % len(self.uploads)
+            self.uploads[upload_id] = {"Bucket": Bucket, "Key": Key, "parts": {}, "metadata": kwargs}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._wait()
+        with self.lock:
+            self.uploads[UploadId]["parts"][PartNumber] = Body
+        return {"ETag": '"%s"' % hashlib.md5(Body).hexdigest()}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._wait()
+        with self.lock:
+            upload = self.uploads.pop(UploadId)
+            parts = [upload["parts"][part["PartNumber"]] for part in MultipartUpload["Parts"]]
+            for part in parts[:-1]:
+                if len(part) < 5 * 1024 * 1024:
+                    raise self._error("EntityTooSmall", "CompleteMultipartUpload")
+            body = b"".join(parts)
+            etag = '"%s-%d"' % (hashlib.md5(body).hexdigest(), len(parts))
+            self.objects[(Bucket, Key)] = (body, etag, upload["metadata"])
+            self.puts.append(Key)
+        return {"ETag": etag}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+    def delete_object(self, Bucket, Key):
+        self._wait()
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        self._wait()
+        with self.lock:
+            for obj in Delete["Objects"]:
+                self.objects.pop((Bucket, obj["Key"]), None)
+        return {}
+
+
+class InMemoryQueue:
+    """ In-memory stand-in for an SQS queue and its Lambda event source mapping
+
+    Messages are sent with send_message_batch, like app does, and delivered by deliver(), which calls
+    a handler with SQS events of up to batch_size records, as Lambda does. The messages listed in the
+    batchItemFailures of the response become visible again; after max_receives deliveries they are
+    moved to dead_letters.
+
+    :param batch_size: maximum number of records per event
+    :param max_receives: deliveries of a message before it is dead-lettered
+    """
+
+    def __init__(self, batch_size=10, max_receives=3):
+        self.batch_size = batch_size
+        self.max_receives = max_receives
+        self.messages = []  # [message id, body, receive count], in order
+        self.dead_letters = []
+        self.sent = 0
+
+    def send_message_batch(self, QueueUrl, Entries):
+        if len(Entries) > 10:
+            raise ClientError({"Error": {"Code": "TooManyEntriesInBatchRequest", "Message": "Too many entries"}},
+                              "SendMessageBatch")
+        successful = []
+        for entry in Entries:
+            self.sent += 1
+            self.messages.append(["msg-%d" % self.sent, entry["MessageBody"], 0])
+            successful.append({"Id": entry["Id"], "MessageId": "msg-%d" % self.sent})
+        return {"Successful": successful, "Failed": []}
+
+    def send(self, body):
+        """ Queue one message, body is a dict sent as JSON """
+
+        return self.send_message_batch("local", [{"Id": "0", "MessageBody": json.dumps(body)}])
+
+    def event(self, messages):
+        return {"Records": [{"messageId": message_id, "body": body, "eventSource": "aws:sqs",
+                             "attributes": {"ApproximateReceiveCount": str(count)}}
+                            for message_id, body, count in messages]}
+
+    def deliver(self, handler, context=None):
+        """ Deliver every visible message once, in batches
+
+        :param handler: callable taking (event, context) and returning the batchItemFailures response
+        :return: list of the responses
+        """
+
+        visible, self.messages = self.messages, []
+        responses = []
+        for i in range(0, len(visible), self.batch_size):
+            batch = visible[i:i + self.batch_size]
+            for message in batch:
+                message[2] += 1
+            response = handler(self.event(batch), context)
+            responses.append(response)
+            failed = {item["itemIdentifier"] for item in response.get("batchItemFailures", [])}
+            for message in batch:
+                if message[0] in failed:
+                    (self.dead_letters if message[2] >= self.max_receives else self.messages).append(message)
+        return responses
+
+    def drain(self, handler, context=None):
+        """ Deliver until the queue is empty, return the number of deliveries """
+
+        rounds = 0
+        while self.messages:
+            self.deliver(handler, context)
+            rounds += 1
+        return rounds
@@ -0,0 +1,28 @@
+from tests.benchmark import bench_harvest, bench_startup
+
+
+def test_benchmark_harness_runs_end_to_end():
+    results = bench_harvest.run_benchmark(records=30, record_size=512, workers=(1, 4), mode="harvest")
+    results += bench_harvest.run_benchmark(records=30, record_size=512, workers=(4,), mode="handler")
+
+    assert [result["records"] for result in results] == [30, 30, 30]
+    for result in results:
+        assert result["records_per_sec"] > 0
+        assert 0 < result["p50_ms"] <= result["p99_ms"]
+        assert result["peak_rss_mb"] > 0
+
+
+def test_percentile_uses_nearest_rank():
+    values = [float(i) for i in range(1, 101)]
+
+    assert bench_harvest.percentile(values, 50) == 50.0
+    assert bench_harvest.percentile(values, 99) == 99.0
+    assert bench_harvest.percentile([], 99) == 0.0
+
+
+def test_startup_benchmark_imports_app_without_heavy_modules():
+    results, median = bench_startup.run_benchmark(runs=1)
+
+    assert median["heavy_modules_at_import"] == []
+    assert 0 < median["import_ms"] < median["cold_start_ms"]
+    assert results[0]["warm_invocation_ms"] > 0
@@ -0,0 +1,93 @@
+import io
+import json
+import os
+
+import pytest
+
+os.environ.setdefault("BUCKET_NAME", "json-bucket/records")
+os.environ.setdefault("GEOJSON_BUCKET_NAME", "geojson-bucket/records")
+os.environ.setdefault("BASE_URL", "https://geonetwork.example")
+os.environ.setdefault("GN_JSON_RECORD_URL_START", "https://geonetwork.example/geonetwork/srv/api/0.1/records/")
+os.environ.setdefault("RUN_INTERVAL_MINUTES", "11")
+
+from hnap_json_harvest import app, cli
+from tests.fakes import FakeGeoNetwork, InMemoryS3
+
+
+@pytest.fixture()
+def geonetwork(mocker):
+    with FakeGeoNetwork(record_count=25, record_size=256, deleted_every=5) as geonetwork:
+        s3 = InMemoryS3()
+        mocker.patch.object(app, "HARVEST_WORKERS", app.HARVEST_WORKERS)
+        mocker.patch.object(app, "HTTP_POOL_SIZE", app.HTTP_POOL_SIZE)
+        mocker.patch.object(app, "GN_BACKOFF_BASE_SECONDS", 0)
+        mocker.patch.object(app, "_config", app.load_config(dict(
+            os.environ, BASE_URL=geonetwork.base_url, GN_JSON_RECORD_URL_START=geonetwork.record_url_start)))
+        mocker.patch.dict(app._manifest_cache, {"etag": None, "data": {}})
+        mocker.patch.dict(app._validator_cache, {"etag": None, "data": {}})
+        app.reset_clients()
+        app.register_s3_client(s3)
+        geonetwork.s3 = s3
+        geonetwork.argv = ["--base-url", geonetwork.base_url, "--record-url-start", geonetwork.record_url_start,
+                           "--quiet"]
+        yield geonetwork
+        app.reset_clients()
+
+
+def record_requests(geonetwork):
+    return [path for path, _ in geonetwork.requests if path.endswith("/formatters/json")]
+
+
+def test_backfill_of_a_change_feed_range_harvests_deletes_and_checkpoints(geonetwork, tmp_path, capsys):
+    checkpoint = str(tmp_path / "backfill.ndjson")
+
+    code = cli.main(geonetwork.argv + ["--from-date", "2022-04-13T00:00:00Z", "--processes", "0",
+                                       "--chunk-size", "7", "--checkpoint", checkpoint])
+
+    summary = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert code == 0
+    assert summary["harvested"] == 20 and summary["deleted"] == 5 and summary["failed"] == 0
+    assert len(geonetwork.s3.keys("json-bucket", "records/00000000")) == 20
+    # The manifest is saved by the parent for the next Lambda runs
+    assert len(app.read_state_object(app.MANIFEST_NAME)[0]) == 20
+    done, deleted = cli.load_checkpoint(checkpoint)
+    assert len(done) == 20 and len(deleted) == 5
+
+
+def test_backfill_resumes_from_the_checkpoint_and_retries_failures(geonetwork, tmp_path):
+    checkpoint = str(tmp_path / "backfill.ndjson")
+    uuids = geonetwork.uuids[:10]
+    cli.append_checkpoint(checkpoint, {"done": uuids[:6], "failed": {}})
+    cli.append_checkpoint(checkpoint, {"done": [], "failed": {uuids[0]: "500"}})
+    with open(checkpoint, "a") as f:
+        f.write('{"done": ["trunc')
+
+    stats = cli.run_backfill(uuids, processes=0, chunk_size=3, checkpoint=checkpoint, progress_stream=None)
+
+    harvested = sorted(path.split("/")[-3] for path in record_requests(geonetwork))
+    assert harvested == sorted([uuids[0]] + uuids[6:])
+    assert stats["harvested"] == 5 and stats["resumed"] == 5
+    assert cli.load_checkpoint(checkpoint)[0] == set(uuids)
+
+
+def test_backfill_harvests_uuids_from_stdin_in_a_process_pool(geonetwork, mocker, capsys):
+    mocker.patch("sys.stdin", io.StringIO("\n".join(["# backfill"] + geonetwork.uuids + [""])))
+
+    code = cli.main(geonetwork.argv + ["--uuids", "-", "--processes", "3", "--workers", "2", "--chunk-size", "4",
+                                       "--force"])
+
+    summary = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert code == 0
+    assert summary["harvested"] == 25 and summary["failed"] == 0
+    assert len(set(record_requests(geonetwork))) == 25
+
+
+def test_backfill_workers_raise_the_geonetwork_concurrency_cap(geonetwork, mocker):
+    mocker.patch.object(app, "GN_MAX_CONCURRENCY", 4)
+
+    cli.run_backfill(geonetwork.uuids[:3], processes=0, workers=24, progress_stream=None)
+    assert app.get_rate_controller().max_limit == 24
+    assert app.HTTP_POOL_SIZE >= 24
+
+    cli.run_backfill(geonetwork.uuids[3:6], processes=0, workers=24, gn_concurrency=12, progress_stream=None)
+    assert app.get_rate_controller().max_limit == 12
@@ -0,0 +1,1236 @@
+import gzip
+import json
+import os
+import threading
+import time
+
+import pytest
+import requests
+from botocore.exceptions import ClientError
+
+os.environ.setdefault("BUCKET_NAME", "json-bucket/records")
+os.environ.setdefault("GEOJSON_BUCKET_NAME", "geojson-bucket/records")
+os.environ.setdefault("BASE_URL", "https://geonetwork.example")
+os.environ.setdefault("GN_JSON_RECORD_URL_START", "https://geonetwork.example/geonetwork/srv/api/0.1/records/")
+os.environ.setdefault("RUN_INTERVAL_MINUTES", "11")
+
+from hnap_json_harvest import app
+from tests.fakes import InMemoryQueue, InMemoryS3
+
+
+class FakeResponse:
+    def __init__(self, body, status_code=200, headers=None):
+        self.text = body
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    @property
+    def content(self):
+        return self.text.encode("utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def close(self):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+    def iter_content(self, chunk_size=1):
+        body = self.text.encode("utf-8")
+        for i in range(0, len(body), chunk_size):
+            yield body[i:i + chunk_size]
+
+
+def in_window(records, params):
+    """ The change records within the dateFrom/dateTo of a change api query, as GeoNetwork filters them """
+
+    lower = app.parse_utc(params.get("dateFrom", "1970-01-01T00:00:00Z"))
+    upper = app.parse_utc(params.get("dateTo", "2999-01-01T00:00:00Z"))
+    return [record for record in records if lower <= app.parse_utc(record["lastModifiedTime"]) <= upper]
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(mocker):
+    # GeoNetwork errors are retried without waiting, each test starts with a fresh rate controller
+    mocker.patch.object(app, "GN_BACKOFF_BASE_SECONDS", 0)
+    app._clients.pop("gn_rate", None)
+    yield
+    app._clients.pop("gn_rate", None)
+
+
+@pytest.fixture()
+def fake_s3(mocker):
+    client = InMemoryS3()
+    mocker.patch.object(app, "get_s3_client", return_value=client)
+    mocker.patch.dict(app._manifest_cache, {"etag": None, "data": {}})
+    mocker.patch.dict(app._validator_cache, {"etag": None, "data": {}})
+    yield client
+    app.reset_clients()
+
+
+@pytest.fixture()
+def s3_client(mocker):
+    client = mocker.MagicMock()
+    client.head_bucket.return_value = {"ResponseMetadata": {"HTTPStatusCode": 200}}
+    client.get_object.side_effect = ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+    mocker.patch.object(app, "get_s3_client", return_value=client)
+    mocker.patch.dict(app._manifest_cache, {"etag": None, "data": {}})
+    mocker.patch.dict(app._validator_cache, {"etag": None, "data": {}})
+    yield client
+    app.reset_clients()
+
+
+@pytest.fixture()
+def http_session(mocker):
+    session = mocker.MagicMock()
+    mocker.patch.object(app, "get_http_session", return_value=session)
+    return session
+
+
+def test_run_bounded_limits_concurrency():
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def work(item):
+        with lock:
+            active.append(item)
+            peak.append(len(active))
+        time.sleep(0.01)
+        with lock:
+            active.remove(item)
+        return item * 2
+
+    results = list(app.run_bounded(work, range(20), 4))
+
+    assert sorted(result for _, result, _ in results) == [i * 2 for i in range(20)]
+    assert max(peak) <= 4
+
+
+def test_harvest_uuids_counts_successes_and_failures(fake_s3, http_session):
+    def fake_get(url, headers=None, **kwargs):
+        if "bad" in url:
+            return FakeResponse("Internal Server Error", status_code=500)
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+
+    error_msg, stats = app.harvest_uuids(["a", "bad", "c"], "https://gn/records/", "/formatters/json",
+                                         "json-bucket", "ca-central-1", bucket_folder_path="records", workers=3)
+
+    assert stats["harvested"] == 2
+    assert stats["failed"] == 1
+    assert list(stats["failures"]) == ["bad"]
+    assert error_msg == "Could not harvest 1 record(s)"
+    assert sorted(key for key in fake_s3.puts if key.startswith("records/")) == ["records/a.json", "records/c.json"]
+
+
+def test_clients_are_created_once_and_reused():
+    app.reset_clients()
+    try:
+        assert app.get_http_session() is app.get_http_session()
+        assert app.get_s3_client("ca-central-1") is app.get_s3_client("ca-central-1")
+        assert app.get_s3_client("ca-central-1") is not app.get_s3_client("us-east-1")
+        adapter = app.get_http_session().get_adapter("https://geonetwork.example")
+        assert adapter._pool_maxsize == app.HTTP_POOL_SIZE
+    finally:
+        app.reset_clients()
+
+
+def test_create_bucket_checks_each_bucket_once(s3_client):
+    assert app.create_bucket("json-bucket", "ca-central-1")
+    assert app.create_bucket("json-bucket", "ca-central-1")
+
+    s3_client.head_bucket.assert_called_once_with(Bucket="json-bucket")
+
+
+def test_delete_uuids_batches_keys_and_reports_per_key_errors(s3_client):
+    def fake_delete_objects(Bucket, Delete):
+        errors = [{"Key": obj["Key"], "Code": "AccessDenied", "Message": "Access Denied"}
+                  for obj in Delete["Objects"] if obj["Key"] == "records/uuid-1500.geojson"]
+        return {"Errors": errors} if errors else {}
+
+    s3_client.delete_objects.side_effect = fake_delete_objects
+    uuids = ["uuid-%d" % i for i in range(2500)]
+
+    error_msg, stats = app.delete_uuids(uuids, "geojson-bucket", folder_path="records", workers=2)
+
+    batch_sizes = sorted(len(call.kwargs["Delete"]["Objects"]) for call in s3_client.delete_objects.call_args_list)
+    assert batch_sizes == [500, 1000, 1000]
+    assert stats["deleted"] == 2499
+    assert stats["failures"] == {"uuid-1500": "AccessDenied: Access Denied"}
+    assert error_msg == "Could not delete 1 record(s)"
+
+
+def test_harvest_uuids_skips_records_unchanged_since_last_run(fake_s3, http_session):
+    bodies = {"a": {"title": "A"}, "b": {"title": "B"}}
+    http_session.get.side_effect = lambda url, headers=None, **kwargs: FakeResponse(json.dumps(bodies[url.split("/")[-3]]))
+
+    _, first = app.harvest_uuids(["a", "b"], "https://gn/records/", "/formatters/json",
+                                 "json-bucket", "ca-central-1", bucket_folder_path="records")
+    bodies["b"] = {"title": "B, revised"}
+    _, second = app.harvest_uuids(["a", "b"], "https://gn/records/", "/formatters/json",
+                                  "json-bucket", "ca-central-1", bucket_folder_path="records")
+
+    assert (first["harvested"], first["skipped"]) == (2, 0)
+    assert (second["harvested"], second["skipped"]) == (1, 1)
+    record_puts = [key for key in fake_s3.puts if key.startswith("records/")]
+    assert record_puts.count("records/a.json") == 1
+    assert record_puts.count("records/b.json") == 2
+    assert app.load_manifest()["b"] == app.record_digest({"title": "B, revised"})
+
+
+def test_record_deleted_then_inserted_again_is_rewritten(fake_s3, http_session):
+    http_session.get.side_effect = lambda url, headers=None, **kwargs: FakeResponse(json.dumps({"title": "A"}))
+
+    for runtype in ("insert_uuid", "delete_uuid", "insert_uuid"):
+        app.lambda_handler({"queryStringParameters": {"runtype": runtype, "uuid": "abc"}}, None)
+        if runtype == "delete_uuid":
+            assert "abc" not in app.load_manifest()
+
+    assert [key for key in fake_s3.puts if key.startswith("records/")] == ["records/abc.json"] * 2
+    assert "abc" in app.load_manifest()
+
+
+def test_save_manifest_merges_concurrent_updates(fake_s3):
+    app.load_manifest()
+    app.save_manifest({"a": "1"})
+    stale_etag = app._manifest_cache["etag"]
+    app.save_manifest({"b": "2"})
+    app._manifest_cache.update({"etag": stale_etag, "data": {"a": "1"}})
+
+    assert app.save_manifest({"c": "3"})
+    assert app.load_manifest() == {"a": "1", "b": "2", "c": "3"}
+
+
+def test_checkpoint_mode_resumes_from_watermark(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "CHECKPOINT_MODE", True)
+    feed = {"records": [
+        {"uuid": "a", "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"},
+        {"uuid": "b", "status": "updated", "lastModifiedTime": "2022-04-13T10:05:00Z"},
+    ]}
+
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            return FakeResponse(json.dumps(feed))
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+    app.write_state_object(app.WATERMARK_NAME, {"lastModifiedTime": "2022-04-13T09:00:00Z"})
+
+    body = json.loads(app.lambda_handler({"queryStringParameters": None}, None)["body"])
+
+    assert body["fromDateTime"] == "2022-04-13T09:00:00Z"
+    assert body["harvestCount"] == "2"
+    assert app.load_watermark() == "2022-04-13T10:05:00Z"
+
+
+def test_failed_records_are_left_pending_and_the_watermark_moves(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "CHECKPOINT_MODE", True)
+    feed = {"records": [{"uuid": "a", "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"}]}
+    feed_status = [200]
+
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            return FakeResponse(json.dumps(feed), status_code=feed_status[0])
+        return FakeResponse("Service Unavailable", status_code=503)
+
+    http_session.get.side_effect = fake_get
+    app.write_state_object(app.WATERMARK_NAME, {"lastModifiedTime": "2022-04-13T09:00:00Z"})
+
+    response = app.lambda_handler({"queryStringParameters": None}, None)
+
+    assert json.loads(response["body"])["failedCount"] == "1"
+    assert app.load_watermark() == "2022-04-13T10:00:00Z"
+    assert app.load_pending() == {"insert": ["a"], "delete": []}
+
+    #A change feed that cannot be read keeps the watermark in place
+    feed_status[0] = 503
+    app.lambda_handler({"queryStringParameters": None}, None)
+
+    assert app.load_watermark() == "2022-04-13T10:00:00Z"
+
+
+class FakeContext:
+    invoked_function_arn = "arn:aws:lambda:ca-central-1:123456789012:function:hnap_json_harvest"
+
+    def __init__(self, remaining_seconds):
+        self.remaining = list(remaining_seconds)
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining.pop(0) * 1000 if len(self.remaining) > 1 else self.remaining[0] * 1000
+
+
+def test_full_reload_resumes_from_saved_cursor(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "FULL_RELOAD_WINDOW_DAYS", 1)
+    mocker.patch.object(app, "FULL_RELOAD_SELF_INVOKE", False)
+    change_queries = []
+
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            change_queries.append(kwargs["params"])
+            return FakeResponse(json.dumps({"records": []}))
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+    app.write_state_object(app.FULL_RELOAD_NAME, {
+        "cursor": "2022-04-01T00:00:00Z", "until": "2022-04-03T00:00:00Z", "started": "2022-04-03T00:00:00Z",
+        "windows": 0, "harvested": 0, "deleted": 0, "failed": 0, "done": False})
+    event = {"queryStringParameters": {"runtype": "full"}}
+
+    first = json.loads(app.lambda_handler(event, FakeContext([300, 10]))["body"])
+    assert "paused at 2022-04-02T00:00:00Z" in first["message"]
+    assert not app.full_reload_done(app.load_full_reload_cursor()[0])
+
+    second = json.loads(app.lambda_handler(event, FakeContext([300]))["body"])
+    assert "full reload complete, 2 window(s)" in second["message"]
+    assert app.full_reload_done(app.load_full_reload_cursor()[0])
+    assert change_queries == [
+        {"dateFrom": "2022-04-01T00:00:00Z", "dateTo": "2022-04-02T00:00:00Z"},
+        {"dateFrom": "2022-04-02T00:00:00Z", "dateTo": "2022-04-03T00:00:00Z"},
+    ]
+
+
+def test_full_reload_keeps_a_dense_window_pending_in_the_cursor(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "FULL_RELOAD_SELF_INVOKE", False)
+    mocker.patch.object(app, "FULL_RELOAD_RESERVE_SECONDS", 90)
+    mocker.patch.object(app, "DEADLINE_RESERVE_SECONDS", 200)
+    feed = {"records": [{"uuid": uuid, "status": "updated", "lastModifiedTime": "2022-04-01T10:00:00Z"}
+                        for uuid in ("a", "b", "c")] + [{"uuid": "d", "status": "deleted", "lastModifiedTime": "2022-04-01T11:00:00Z"}]}
+    change_queries = []
+
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            change_queries.append(kwargs["params"])
+            return FakeResponse(json.dumps(feed))
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+    app.write_state_object(app.FULL_RELOAD_NAME, {
+        "cursor": "2022-04-01T00:00:00Z", "until": "2022-04-02T00:00:00Z", "started": "2022-04-02T00:00:00Z",
+        "windows": 0, "harvested": 0, "deleted": 0, "failed": 0, "done": False})
+    event = {"queryStringParameters": {"runtype": "full"}}
+
+    first = json.loads(app.lambda_handler(event, FakeContext([150]))["body"])
+    cursor, _ = app.load_full_reload_cursor()
+    assert "with 4 record(s) of the last window pending" in first["message"]
+    assert cursor["done"] and sorted(cursor["pending"]["insert"]) == ["a", "b", "c"]
+    assert cursor["pending"]["delete"] == ["d"]
+    assert not app.full_reload_done(app.load_full_reload_cursor()[0])
+
+    second = json.loads(app.lambda_handler(event, FakeContext([300]))["body"])
+    assert "full reload complete, 1 window(s)" in second["message"]
+    assert app.full_reload_done(app.load_full_reload_cursor()[0])
+    assert len(change_queries) == 1
+    assert sorted(key for key in fake_s3.puts if key.startswith("records/") and key.endswith(".json")) == [
+        "records/a.json", "records/b.json", "records/c.json"]
+    assert app.load_pending() == {"insert": [], "delete": []}
+
+
+def test_full_reload_re_invokes_itself_before_the_timeout(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "FULL_RELOAD_SELF_INVOKE", True)
+    mocker.patch.object(app, "FULL_RELOAD_WINDOW_DAYS", 1)
+    lambda_client = mocker.MagicMock()
+    mocker.patch.object(app, "get_lambda_client", return_value=lambda_client)
+    http_session.get.return_value = FakeResponse(json.dumps({"records": []}))
+    app.write_state_object(app.FULL_RELOAD_NAME, {
+        "cursor": "2022-04-01T00:00:00Z", "until": "2022-04-03T00:00:00Z", "started": "2022-04-03T00:00:00Z",
+        "windows": 0, "harvested": 0, "deleted": 0, "failed": 0, "done": False})
+    event = {"queryStringParameters": {"runtype": "full"}}
+
+    body = json.loads(app.lambda_handler(event, FakeContext([300, 10]))["body"])
+
+    assert "continuing in a new invocation" in body["message"]
+    lambda_client.invoke.assert_called_once()
+    assert lambda_client.invoke.call_args.kwargs["InvocationType"] == "Event"
+
+    #An invocation started too late to process a window does not start another one
+    body = json.loads(app.lambda_handler(event, FakeContext([10]))["body"])
+
+    assert "the next scheduled run will continue" in body["message"]
+    lambda_client.invoke.assert_called_once()
+
+
+def test_full_reload_leaves_deferred_records_to_the_scheduled_run(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "FULL_RELOAD_SELF_INVOKE", True)
+    mocker.patch.object(app, "GN_BACKOFF_MAX_SECONDS", 0.05)
+    mocker.patch.object(app.time, "sleep")
+    lambda_client = mocker.MagicMock()
+    mocker.patch.object(app, "get_lambda_client", return_value=lambda_client)
+
+    def fake_get(url, headers=None, **kwargs):
+        if "/a/" in url:
+            return FakeResponse("Too Many Requests", status_code=429, headers={"Retry-After": "3600"})
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+    app.write_state_object(app.FULL_RELOAD_NAME, {
+        "cursor": "2022-04-02T00:00:00Z", "until": "2022-04-03T00:00:00Z", "started": "2022-04-03T00:00:00Z",
+        "windows": 1, "harvested": 0, "deleted": 0, "failed": 0, "done": False,
+        "pending": {"insert": ["a", "b"], "delete": []}})
+
+    body = json.loads(app.lambda_handler({"queryStringParameters": {"runtype": "full"}}, FakeContext([300]))["body"])
+
+    assert body["harvestCount"] == "1"
+    assert "the next scheduled run will continue" in body["message"]
+    lambda_client.invoke.assert_not_called()
+    assert app.load_full_reload_cursor()[0]["pending"] == {"insert": ["a"], "delete": []}
+
+
+def test_iter_json_array_parses_items_split_across_chunks():
+    document = json.dumps({"count": 3, "records": [{"uuid": "a"}, {"uuid": "b \u00e9"}, {"uuid": "c"}]}).encode("utf-8")
+    chunks = [document[i:i + 5] for i in range(0, len(document), 5)]
+
+    items = list(app.iter_json_array(chunks, "records"))
+
+    assert items == [{"uuid": "a"}, {"uuid": "b \u00e9"}, {"uuid": "c"}]
+
+
+def test_change_feed_yields_before_download_completes(http_session):
+    records = [{"uuid": "u%d" % i, "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"} for i in range(3)]
+    records.append({"uuid": "gone", "status": "deleted", "lastModifiedTime": "2022-04-13T10:00:00Z"})
+    body = json.dumps({"records": records})
+    downloaded = []
+
+    class StreamedResponse(FakeResponse):
+        def iter_content(self, chunk_size=1):
+            for chunk in super().iter_content(chunk_size=16):
+                downloaded.append(chunk)
+                yield chunk
+
+    http_session.get.return_value = StreamedResponse(body)
+    feed = app.ChangeFeed("https://gn/records/status/change", fromDateTime="2022-04-13T00:00:00Z")
+
+    first = next(iter(feed))
+
+    assert first == "u0"
+    assert len(b"".join(downloaded)) < len(body)
+
+
+def test_change_feed_pages_until_a_short_page(http_session, mocker):
+    mocker.patch.object(app, "CHANGE_FEED_PAGE_SIZE", 2)
+    records = [{"uuid": "u%d" % i, "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"} for i in range(5)]
+
+    def fake_get(url, params=None, **kwargs):
+        page = records[params["from"]:params["from"] + params["size"]]
+        return FakeResponse(json.dumps({"records": page}))
+
+    http_session.get.side_effect = fake_get
+    feed = app.ChangeFeed("https://gn/records/status/change")
+
+    assert list(feed) == ["u0", "u1", "u2", "u3", "u4"]
+    assert [call.kwargs["params"]["from"] for call in http_session.get.call_args_list] == [0, 2, 4]
+
+
+def test_change_feed_collapses_duplicates_to_their_latest_status(http_session):
+    http_session.get.return_value = FakeResponse(json.dumps({"records": [
+        {"uuid": "a", "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"},
+        {"uuid": "b", "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00"},
+        {"uuid": "a", "status": "deleted", "lastModifiedTime": "2022-04-13T11:00:00Z"},
+        {"uuid": "c", "status": "deleted", "lastModifiedTime": "2022-04-13T09:00:00Z"},
+        {"uuid": "c", "status": "created", "lastModifiedTime": "2022-04-13T09:30:00+00:00"},
+        {"uuid": "b", "status": "updated", "lastModifiedTime": "2022-04-13T10:30:00Z"},
+        {"uuid": "old", "status": "updated", "lastModifiedTime": "2022-04-12T10:00:00Z"},
+    ]}))
+
+    changes = app.ChangeFeed("https://gn/records/status/change", fromDateTime="2022-04-13T00:00:00Z").classify()
+
+    assert changes.inserted == {"b", "c"}
+    assert changes.deleted == {"a"}
+    assert changes.latest == "2022-04-13T11:00:00Z"
+    assert changes.error is None
+
+
+def test_lambda_handler_never_fetches_records_deleted_later_in_the_feed(fake_s3, http_session):
+    fetched = []
+
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            return FakeResponse(json.dumps({"records": [
+                {"uuid": "a", "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"},
+                {"uuid": "a", "status": "deleted", "lastModifiedTime": "2022-04-13T10:01:00Z"},
+            ]}))
+        fetched.append(url)
+        return FakeResponse("{}")
+
+    http_session.get.side_effect = fake_get
+
+    body = json.loads(app.lambda_handler({"queryStringParameters": {"fromDateTime": "2022-04-13T00:00:00Z"}}, None)["body"])
+
+    assert fetched == []
+    assert body["deleteCount"] == "1"
+
+
+@pytest.mark.parametrize("record_format, compression", [("passthrough", "none"), ("passthrough", "gzip"), ("pretty", "gzip")])
+def test_harvest_uuid_storage_modes(fake_s3, http_session, mocker, record_format, compression):
+    mocker.patch.object(app, "RECORD_FORMAT", record_format)
+    mocker.patch.object(app, "RECORD_COMPRESSION", compression)
+    raw = '{"title":"A","abstract":"\u00e9t\u00e9"}'
+    http_session.get.return_value = FakeResponse(raw)
+
+    assert app.harvest_uuid("a", "https://gn/records/", "/formatters/json", "json-bucket") == app.HARVESTED
+
+    body = fake_s3.body("json-bucket", "a.json")
+    if compression == "gzip":
+        body = gzip.decompress(body)
+    if record_format == "passthrough":
+        assert body == raw.encode("utf-8")
+    else:
+        assert json.loads(body) == json.loads(raw)
+
+
+def test_passthrough_rejects_a_non_json_body(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "RECORD_FORMAT", "passthrough")
+    http_session.get.return_value = FakeResponse("<html>Maintenance</html>")
+
+    with pytest.raises(ValueError):
+        app.harvest_uuid("a", "https://gn/records/", "/formatters/json", "json-bucket")
+    assert fake_s3.objects == {}
+
+
+def test_lambda_handler_emits_one_emf_metrics_record(fake_s3, http_session, capsys):
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            return FakeResponse(json.dumps({"records": in_window([
+                {"uuid": "a", "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"},
+                {"uuid": "b", "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"},
+            ], kwargs["params"])}))
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+
+    app.lambda_handler({"queryStringParameters": {"fromDateTime": "2022-04-13T00:00:00Z"}}, None)
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"')]
+    assert len(records) == 1
+    record = records[0]
+    definition = record["_aws"]["CloudWatchMetrics"][0]
+    assert definition["Dimensions"] == [["FunctionName", "RunType"]]
+    assert record["RunType"] == "reload"
+    assert record["RecordsHarvested"] == 2
+    assert record["ChangeRecords"] == 2
+    assert record["RecordLatencyHistogram"]["Count"] == 2
+    for name in ("ChangeFeedDuration", "HarvestDuration", "TotalDuration", "FetchLatencyP99", "BytesUploaded"):
+        assert name in record
+        assert name in [metric["Name"] for metric in definition["Metrics"]]
+
+
+def test_histogram_percentiles_use_bucket_upper_bounds():
+    run_metrics = app.RunMetrics()
+    for ms in [3] * 98 + [40, 20000]:
+        run_metrics.observe("Record", ms / 1000.0)
+
+    record = run_metrics.to_emf()
+
+    assert record["RecordLatencyP50"] == 5
+    assert record["RecordLatencyP99"] == 50
+    assert record["RecordLatencyMax"] == 20000
+
+
+def test_lambda_handler_fans_out_large_change_sets_to_workers(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "FANOUT_THRESHOLD", 4)
+    mocker.patch.object(app, "FANOUT_SHARD_SIZE", 3)
+    mocker.patch.object(app, "FANOUT_DISPATCHER", "process")
+    mocker.patch.object(app, "FANOUT_CONCURRENCY", 2)
+    uuids = ["uuid-%d" % i for i in range(10)]
+
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            return FakeResponse(json.dumps({"records": [
+                {"uuid": uuid, "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"} for uuid in uuids
+            ]}))
+        if "uuid-7" in url:
+            return FakeResponse("Internal Server Error", status_code=500)
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+    workers = []
+    dispatch = app.ProcessPoolDispatcher.dispatch
+
+    def recording_dispatch(self, events):
+        for event, response, e in dispatch(self, events):
+            workers.append((event["shard"]["insert"], json.loads(response["body"])))
+            yield event, response, e
+
+    mocker.patch.object(app.ProcessPoolDispatcher, "dispatch", recording_dispatch)
+
+    body = json.loads(app.lambda_handler({"queryStringParameters": {"fromDateTime": "2022-04-13T00:00:00Z"}}, None)["body"])
+
+    # The records are harvested by the worker processes, the coordinator only read the change feed
+    assert sorted(shard for shard, _ in workers) == [uuids[0:3], uuids[3:6], uuids[6:9], uuids[9:]]
+    assert sum(int(worker["harvestCount"]) for _, worker in workers) == 9
+    assert [list(worker["failures"]) for _, worker in workers if worker["failures"]] == [["uuid-7"]]
+    assert all("status/change" in call.args[0] for call in http_session.get.call_args_list)
+    assert body["harvestCount"] == "9"
+    assert body["failedCount"] == "1"
+    assert "failures" not in body
+
+
+def test_fan_out_reports_every_uuid_of_a_failed_worker():
+    class FakeDispatcher:
+        def dispatch(self, events):
+            for event in events:
+                shard = event["shard"]["insert"]
+                if "c" in shard:
+                    yield event, None, RuntimeError("Task timed out")
+                else:
+                    body = {"harvestCount": str(len(shard)), "skippedCount": "0", "failedCount": "0", "failures": {}}
+                    yield event, {"body": json.dumps(body)}, None
+
+    error_msg, stats = app.fan_out(["a", "b", "c", "d", "e"], FakeDispatcher(), shard_size=2)
+
+    assert stats["harvested"] == 3
+    assert stats["failures"] == {"c": "Task timed out", "d": "Task timed out"}
+    assert error_msg == "Could not harvest 2 record(s)"
+
+
+def test_gn_get_retries_with_backoff_and_honours_retry_after(http_session, mocker):
+    app.start_run_metrics()
+    sleep = mocker.patch.object(app.time, "sleep")
+    http_session.get.side_effect = [
+        FakeResponse("Too Many Requests", status_code=429, headers={"Retry-After": "1"}),
+        requests.Timeout("read timed out"),
+        FakeResponse("{}"),
+    ]
+
+    response = app.gn_get("https://gn/records/a/formatters/json")
+
+    assert response.status_code == 200
+    assert http_session.get.call_count == 3
+    assert http_session.get.call_args.kwargs["timeout"] == app.GN_TIMEOUT_SECONDS
+    assert sleep.call_args_list[0].args[0] >= 1
+    assert app.metrics().counters["Retries"] == 2
+
+
+def test_fan_out_stops_dispatching_at_the_deadline():
+    class FakeDispatcher:
+        def dispatch(self, events):
+            for event in events:
+                body = {"harvestCount": str(len(event["shard"]["insert"])), "skippedCount": "0", "failedCount": "0"}
+                yield event, {"body": json.dumps(body)}, None
+
+    error_msg, stats = app.fan_out(["a", "b", "c", "d", "e"], FakeDispatcher(), shard_size=2,
+                                   context=FakeContext([300, 300, 10]))
+
+    assert error_msg is None
+    assert stats["harvested"] == 4
+    assert stats["pending"] == ["e"]
+
+
+def test_long_retry_after_leaves_the_record_pending_instead_of_sleeping(fake_s3, http_session, mocker):
+    sleep = mocker.patch.object(app.time, "sleep")
+    mocker.patch.object(app, "GN_BACKOFF_MAX_SECONDS", 0.05)
+
+    def fake_get(url, headers=None, **kwargs):
+        if "/b/" in url:
+            return FakeResponse("Too Many Requests", status_code=429, headers={"Retry-After": "3600"})
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+    error_msg, stats = app.harvest_uuids(["a", "b"], "https://gn/records/", "/formatters/json",
+                                         "json-bucket", "ca-central-1", bucket_folder_path="records", workers=1)
+
+    assert (stats["harvested"], stats["failed"], stats["pending"]) == (1, 0, ["b"])
+    assert error_msg is None
+    assert all(call.args[0] <= 0.05 for call in sleep.call_args_list)
+    assert app.get_rate_controller().paused_until - time.monotonic() <= 0.05
+
+
+def test_gn_get_does_not_retry_past_the_deadline(http_session, mocker):
+    sleep = mocker.patch.object(app.time, "sleep")
+    http_session.get.return_value = FakeResponse("Too Many Requests", status_code=429, headers={"Retry-After": "5"})
+
+    with pytest.raises(app.RetryDeferred):
+        app.gn_get("https://gn/records/a/formatters/json", context=FakeContext([app.DEADLINE_RESERVE_SECONDS + 2]))
+
+    assert http_session.get.call_count == 1
+    sleep.assert_not_called()
+
+
+def test_gn_get_returns_the_error_once_retries_are_used_up(http_session, mocker):
+    mocker.patch.object(app.time, "sleep")
+    mocker.patch.object(app, "GN_MAX_RETRIES", 2)
+    http_session.get.return_value = FakeResponse("Service Unavailable", status_code=503)
+
+    assert app.gn_get("https://gn/records/a/formatters/json").status_code == 503
+    assert http_session.get.call_count == 3
+
+
+def test_rate_controller_increases_additively_and_decreases_multiplicatively():
+    controller = app.RateController(max_limit=8, latency_target=1.0, cooldown=60)
+    controller.limit = 2.0
+
+    controller.on_success(0.1)
+    controller.on_success(0.1)
+    assert controller.limit == pytest.approx(2.0 + 1 / 2.0 + 1 / 2.5)
+
+    controller.on_overload()
+    controller.on_overload()  # within the cooldown, a burst of errors halves the limit once
+    assert controller.limit == pytest.approx((2.0 + 1 / 2.0 + 1 / 2.5) / 2)
+
+    for _ in range(200):
+        controller.on_success(0.1)
+    assert controller.limit == 8
+
+
+def test_work_left_at_the_deadline_is_drained_first_by_the_next_run(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "HARVEST_WORKERS", 1)
+    feed = {"records": [{"uuid": uuid, "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"}
+                        for uuid in ["a", "b", "c", "d"]]}
+    fetched = []
+
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            return FakeResponse(json.dumps(feed))
+        fetched.append(url.split("/")[-3])
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+    event = {"queryStringParameters": {"fromDateTime": "2022-04-13T00:00:00Z"}}
+
+    # Out of time after two records
+    body = json.loads(app.lambda_handler(event, FakeContext([100, 100, 10]))["body"])
+
+    assert body["harvestCount"] == "2"
+    assert body["pendingCount"] == "2"
+    assert json.loads(fake_s3.body("json-bucket", "harvest_state/records/pending.json"))["insert"] == ["c", "d"]
+
+    fetched.clear()
+    feed = {"records": [{"uuid": "e", "status": "updated", "lastModifiedTime": "2022-04-13T11:00:00Z"},
+                        {"uuid": "d", "status": "deleted", "lastModifiedTime": "2022-04-13T11:00:00Z"}]}
+    body = json.loads(app.lambda_handler(event, None)["body"])
+
+    assert fetched == ["c", "e"]
+    assert body["deleteCount"] == "1"
+    assert body["pendingCount"] == "0"
+    assert json.loads(fake_s3.body("json-bucket", "harvest_state/records/pending.json"))["insert"] == []
+
+
+def test_drained_uuids_that_fail_again_stay_pending(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "GN_MAX_RETRIES", 0)
+    app.save_pending(["x", "y"], [])
+    feed = {"records": [{"uuid": "z", "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"}]}
+
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            return FakeResponse(json.dumps(feed))
+        if "/x/" in url:
+            return FakeResponse("Internal Server Error", status_code=500)
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+    body = json.loads(app.lambda_handler({"queryStringParameters": {"fromDateTime": "2022-04-13T00:00:00Z"}}, None)["body"])
+
+    assert body["harvestCount"] == "2" and body["failedCount"] == "1"
+    assert app.load_pending() == {"insert": ["x"], "delete": []}
+
+
+def test_unchanged_records_are_fetched_conditionally_and_not_downloaded_again(fake_s3, http_session):
+    conditional = []
+
+    def fake_get(url, headers=None, **kwargs):
+        conditional.append(headers.get("If-None-Match"))
+        if headers.get("If-None-Match") == '"v1"':
+            return FakeResponse("", status_code=304)
+        return FakeResponse(json.dumps({"url": url}), headers={"ETag": '"v1"', "Last-Modified": "Wed, 13 Apr 2022 10:00:00 GMT"})
+
+    http_session.get.side_effect = fake_get
+    harvest = lambda: app.harvest_uuids(["a", "b"], "https://gn/records/", "/formatters/json",
+                                        "json-bucket", "ca-central-1", bucket_folder_path="records")
+
+    harvest()
+    record_puts = lambda: [key for key in fake_s3.puts if key.startswith("records/")]
+    puts = len(record_puts())
+    conditional.clear()
+    app.start_run_metrics()
+    error_msg, stats = harvest()
+
+    assert conditional == ['"v1"', '"v1"']
+    assert stats["skipped"] == 2
+    assert len(record_puts()) == puts
+    assert app.metrics().counters["RecordsNotModified"] == 2
+    assert app.load_validators()["a"] == {"etag": '"v1"', "lastModified": "Wed, 13 Apr 2022 10:00:00 GMT"}
+
+    app.delete_uuids(["a"], "geojson-bucket", folder_path="records")
+    assert "a" not in app.load_validators() and "a" not in app.load_manifest()
+    conditional.clear()
+    _, stats = harvest()
+
+    assert sorted(conditional, key=str) == ['"v1"', None]
+    assert (stats["harvested"], stats["skipped"]) == (1, 1)
+    assert len(record_puts()) == puts + 1
+
+
+def test_bundle_writer_uses_multipart_upload_and_indexes_every_record(fake_s3):
+    bundle = app.BundleWriter("json-bucket", "bundles/run.ndjson.gz", part_size=5 * 1024 * 1024)
+    records = {"uuid-%d" % i: {"id": i, "text": os.urandom(50000).hex()} for i in range(120)}
+    for uuid, record in records.items():
+        bundle.add(uuid, json.dumps(record, indent=4).encode("utf-8"))
+
+    info = bundle.close()
+
+    assert info["records"] == 120
+    assert app.metrics().counters["UploadParts"] >= 2
+    body = fake_s3.body("json-bucket", "bundles/run.ndjson.gz")
+    lines = gzip.decompress(body).decode("utf-8").splitlines()
+    assert [json.loads(line) for line in lines] == list(records.values())
+    index = json.loads(fake_s3.body("json-bucket", "bundles/run.index.json"))
+    offset, length = index["records"]["uuid-7"]
+    assert json.loads(gzip.decompress(body[offset:offset + length])) == records["uuid-7"]
+
+
+def test_run_bundles_are_compacted_into_a_snapshot(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "BUNDLE_MODE", True)
+    mocker.patch.object(app, "BUNDLE_SETTLE_MINUTES", 0)
+    runs = [
+        [{"uuid": "a", "status": "updated"}, {"uuid": "b", "status": "updated"}],
+        [{"uuid": "b", "status": "updated"}, {"uuid": "a", "status": "deleted"}, {"uuid": "c", "status": "updated"}],
+    ]
+    version = {"n": 0}
+
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            return FakeResponse(json.dumps({"records": [dict(r, lastModifiedTime="2022-04-13T10:00:00Z") for r in runs[version["n"]]]}))
+        return FakeResponse(json.dumps({"uuid": url.split("/")[-3], "version": version["n"]}))
+
+    http_session.get.side_effect = fake_get
+    event = {"queryStringParameters": {"fromDateTime": "2022-04-13T00:00:00Z"}}
+    app.lambda_handler(event, None)
+    version["n"] = 1
+    app.lambda_handler(event, None)
+
+    body = json.loads(app.lambda_handler({"queryStringParameters": {"runtype": "compact"}}, None)["body"])
+
+    assert "snapshot of 2 record(s)" in body["message"]
+    snapshot = json.loads(fake_s3.body("json-bucket", "harvest_state/records/bundle_snapshot.json"))
+    records = [json.loads(line) for line in gzip.decompress(fake_s3.body("json-bucket", snapshot["key"])).splitlines()]
+    assert sorted((r["uuid"], r["version"]) for r in records) == [("b", 1), ("c", 1)]
+    assert snapshot["key"].startswith("bundles/records/snapshots/")
+
+    body = json.loads(app.lambda_handler({"queryStringParameters": {"runtype": "compact"}}, None)["body"])
+    assert "no new run bundle" in body["message"]
+
+
+def test_full_reload_and_queue_runs_are_bundled_for_the_snapshot(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "BUNDLE_MODE", True)
+    mocker.patch.object(app, "BUNDLE_SETTLE_MINUTES", 0)
+    mocker.patch.object(app, "FULL_RELOAD_SELF_INVOKE", False)
+    queue = InMemoryQueue()
+    feed = [{"uuid": uuid, "status": "updated", "lastModifiedTime": "2022-04-01T10:00:00Z"} for uuid in ("a", "b")]
+
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            return FakeResponse(json.dumps({"records": in_window(feed, kwargs["params"])}))
+        return FakeResponse(json.dumps({"uuid": url.split("/")[-3]}))
+
+    http_session.get.side_effect = fake_get
+    app.write_state_object(app.FULL_RELOAD_NAME, {
+        "cursor": "2022-04-01T00:00:00Z", "until": "2022-04-02T00:00:00Z", "started": "2022-04-02T00:00:00Z",
+        "windows": 0, "harvested": 0, "deleted": 0, "failed": 0, "done": False})
+
+    body = json.loads(app.lambda_handler({"queryStringParameters": {"runtype": "full"}}, None)["body"])
+    assert "run bundle written to" in body["message"]
+    queue.send({"uuid": "c", "action": "insert"})
+    queue.send({"uuid": "a", "action": "delete"})
+    queue.deliver(app.lambda_handler)
+    app.lambda_handler({"queryStringParameters": {"runtype": "compact"}}, None)
+
+    snapshot = json.loads(fake_s3.body("json-bucket", "harvest_state/records/bundle_snapshot.json"))
+    records = [json.loads(line) for line in gzip.decompress(fake_s3.body("json-bucket", snapshot["key"])).splitlines()]
+    assert sorted(r["uuid"] for r in records) == ["b", "c"]
+
+
+def test_load_config_reports_every_missing_or_invalid_setting():
+    with pytest.raises(app.ConfigError) as error:
+        app.load_config({"BUCKET_NAME": "json-bucket", "BASE_URL": "maps.canada.ca", "RUN_INTERVAL_MINUTES": "ten"})
+
+    message = str(error.value)
+    for problem in ("GEOJSON_BUCKET_NAME is not set", "GN_JSON_RECORD_URL_START is not set",
+                    "BASE_URL is not an http(s) URL", "RUN_INTERVAL_MINUTES"):
+        assert problem in message
+    assert "BUCKET_NAME is not set" not in message.replace("GEOJSON_BUCKET_NAME", "")
+
+    config = app.load_config({"BUCKET_NAME": "json-bucket/records", "GEOJSON_BUCKET_NAME": "geojson-bucket",
+                              "BASE_URL": "https://maps.canada.ca", "GN_JSON_RECORD_URL_START": "https://maps.canada.ca/r/",
+                              "RUN_INTERVAL_MINUTES": ""})
+    assert config.run_interval_minutes == 11
+
+
+def test_load_config_reports_invalid_optional_settings_with_the_required_ones():
+    environ = {"BUCKET_NAME": "json-bucket", "GEOJSON_BUCKET_NAME": "geojson-bucket", "BASE_URL": "https://maps.canada.ca",
+               "GN_JSON_RECORD_URL_START": "https://maps.canada.ca/r/", "HARVEST_WORKERS": "eight",
+               "GN_BACKOFF_MAX_SECONDS": "-1", "RECORD_FORMAT": "yaml", "BUNDLE_MODE": "yes", "GN_TIMEOUT_SECONDS": " "}
+
+    with pytest.raises(app.ConfigError) as error:
+        app.load_config(environ)
+
+    message = str(error.value)
+    for name in ("HARVEST_WORKERS", "GN_BACKOFF_MAX_SECONDS", "RECORD_FORMAT", "BUNDLE_MODE"):
+        assert name + " is invalid" in message
+    assert "GN_TIMEOUT_SECONDS" not in message
+    values, errors = app.load_tuning(environ)
+    assert len(errors) == 4
+    assert (values["HARVEST_WORKERS"], values["GN_MAX_CONCURRENCY"], values["RECORD_FORMAT"]) == (8, 8, "pretty")
+
+
+def test_verbose_runs_stream_per_uuid_outcomes_into_a_report(fake_s3, http_session):
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            return FakeResponse(json.dumps({"records": [
+                {"uuid": "a", "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"},
+                {"uuid": "bad", "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"},
+                {"uuid": "c", "status": "deleted", "lastModifiedTime": "2022-04-13T10:00:00Z"},
+            ]}))
+        if "bad" in url:
+            return FakeResponse("Not Found", status_code=404)
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+    event = {"queryStringParameters": {"fromDateTime": "2022-04-13T00:00:00Z", "verbose": "true"}}
+
+    body = json.loads(app.lambda_handler(event, None)["body"])
+
+    bucket, key = body["report"][len("s3://"):].split("/", 1)
+    assert key.startswith("harvest_state/records/reports/")
+    assert "uuid" not in body["message"]
+    lines = [json.loads(line) for line in gzip.decompress(fake_s3.body(bucket, key)).splitlines()]
+    outcomes = {(line["uuid"], line["action"], line["outcome"]) for line in lines[:-1]}
+    assert outcomes == {("a", "harvest", "harvested"), ("bad", "harvest", "failed"), ("c", "delete", "deleted")}
+    assert "404" in [line for line in lines if line.get("uuid") == "bad"][0]["reason"]
+    summary = lines[-1]["summary"]
+    assert (summary["harvested"], summary["failed"], summary["deleted"]) == (1, 1, 1)
+    assert summary["outcomes"]["harvest:failed"] == 1
+
+
+def test_report_counts_every_outcome_added_by_concurrent_workers(fake_s3):
+    report = app.RunReport("json-bucket", "reports/run.ndjson.gz")
+
+    def add(worker):
+        for i in range(500):
+            report.add("uuid-%d-%d" % (worker, i), "harvest", "harvested")
+
+    threads = [threading.Thread(target=add, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report.close()
+
+    lines = gzip.decompress(fake_s3.body("json-bucket", "reports/run.ndjson.gz")).splitlines()
+    assert len(lines) == 8 * 500 + 1
+    assert json.loads(lines[-1])["summary"]["outcomes"] == {"harvest:harvested": 8 * 500}
+
+
+def test_reconcile_harvests_only_missing_records_and_deletes_only_orphans(fake_s3, http_session):
+    catalogue = ["%x%07d-uuid" % (i % 16, i) for i in range(40)] + ["zz-uuid"]
+    for uuid in catalogue[:30] + ["zz-uuid"]:
+        fake_s3.put_object(Bucket="json-bucket", Key="records/" + uuid + ".json", Body=b"{}")
+    for uuid in catalogue + ["orphan-1", "f-orphan"]:
+        fake_s3.put_object(Bucket="geojson-bucket", Key="records/" + uuid + ".geojson", Body=b"{}")
+    fake_s3.put_object(Bucket="json-bucket", Key="records/old/orphan-2.json", Body=b"{}")
+    fetched = []
+    windows = []
+
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            windows.append(kwargs["params"]["dateFrom"])
+            return FakeResponse(json.dumps({"records": in_window([
+                {"uuid": uuid, "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"} for uuid in catalogue
+            ] + [{"uuid": "orphan-1", "status": "deleted", "lastModifiedTime": "2022-04-13T10:00:00Z"}], kwargs["params"])}))
+        fetched.append(url.split("/records/")[1].split("/")[0])
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+    # A missing record is uploaded again even if the manifest has its digest
+    app.save_manifest({uuid: app.record_digest({"url": "x"}) for uuid in catalogue})
+
+    body = json.loads(app.lambda_handler({"queryStringParameters": {"runtype": "reconcile"}}, None)["body"])
+
+    assert min(windows) == app.FULL_RELOAD_START
+    assert sorted(fetched) == sorted(catalogue[30:40])
+    assert body["harvestCount"] == "10" and body["deleteCount"] == "2"
+    assert "10 missing and 2 orphaned" in body["message"]
+    assert fake_s3.keys("geojson-bucket", "records/orphan") == []
+    assert fake_s3.keys("geojson-bucket", "records/f-orphan") == []
+    assert len(fake_s3.keys("geojson-bucket")) == len(catalogue)
+
+
+def test_reconcile_harvests_records_stored_without_their_geojson(fake_s3, http_session):
+    for uuid in ("a", "b"):
+        fake_s3.put_object(Bucket="json-bucket", Key="records/" + uuid + ".json", Body=b"{}")
+    fake_s3.put_object(Bucket="geojson-bucket", Key="records/a.geojson", Body=b"{}")
+    feed = {"records": [{"uuid": uuid, "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"}
+                        for uuid in ("a", "b")]}
+
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            return FakeResponse(json.dumps({"records": in_window(feed["records"], kwargs["params"])}))
+        return FakeResponse(json.dumps({"uuid": url.split("/records/")[1].split("/")[0]}))
+
+    http_session.get.side_effect = fake_get
+    app.save_manifest({"b": app.record_digest({"uuid": "b"})})
+    puts = len(fake_s3.puts)
+
+    body = json.loads(app.lambda_handler({"queryStringParameters": {"runtype": "reconcile"}}, None)["body"])
+
+    assert "1 missing and 0 orphaned" in body["message"]
+    assert [key for key in fake_s3.puts[puts:] if key.startswith("records/")] == ["records/b.json"]
+
+
+def test_reconcile_deletes_nothing_when_a_feed_window_fails(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "CHANGE_FEED_MAX_SPLITS", 0)
+    for uuid in ("a", "b"):
+        fake_s3.put_object(Bucket="geojson-bucket", Key="records/" + uuid + ".geojson", Body=b"{}")
+    records = [{"uuid": "a", "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"},
+               {"uuid": "b", "status": "updated", "lastModifiedTime": "2010-01-01T10:00:00Z"}]
+
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            if in_window(records[1:], kwargs["params"]):
+                return FakeResponse("Service Unavailable", status_code=503)
+            return FakeResponse(json.dumps({"records": in_window(records, kwargs["params"])}))
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+
+    body = json.loads(app.lambda_handler({"queryStringParameters": {"runtype": "reconcile"}}, None)["body"])
+
+    assert body["harvestCount"] == "1" and body["deleteCount"] == "0"
+    assert "1 orphaned record(s) were not deleted" in body["message"]
+    assert len(fake_s3.keys("geojson-bucket")) == 2
+
+
+def test_reconcile_deletes_nothing_above_the_orphan_ratio(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "RECONCILE_MAX_ORPHAN_RATIO", 0.5)
+    for uuid in ("a", "b", "c"):
+        fake_s3.put_object(Bucket="json-bucket", Key="records/" + uuid + ".json", Body=b"{}")
+        fake_s3.put_object(Bucket="geojson-bucket", Key="geo/" + uuid + ".geojson", Body=b"{}")
+    feed = {"records": [{"uuid": "a", "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"}]}
+    http_session.get.side_effect = lambda url, headers=None, **kwargs: FakeResponse(
+        json.dumps({"records": in_window(feed["records"], kwargs["params"])}))
+
+    error_msg, missing, orphans = app.reconcile("https://gn/status/change", "json-bucket", "geojson-bucket",
+                                                bucket_folder_path="records", geojson_folder_path="geo")
+
+    assert (missing, orphans) == ([], [])
+    assert "2 orphaned record(s) out of 3" in error_msg
+
+    mocker.patch.object(app, "RECONCILE_MAX_ORPHAN_RATIO", 1)
+    assert app.reconcile("https://gn/status/change", "json-bucket", "geojson-bucket",
+                         bucket_folder_path="records", geojson_folder_path="geo") == (None, [], ["b", "c"])
+
+
+def test_geojson_records_are_in_the_folder_of_the_geojson_bucket():
+    config = app.load_config({"BUCKET_NAME": "json-bucket/records", "GEOJSON_BUCKET_NAME": "geojson-bucket/geo",
+                              "BASE_URL": "https://gn", "GN_JSON_RECORD_URL_START": "https://gn/records/"})
+    assert app.geojson_location(config) == ("geojson-bucket", "geo")
+
+    config = app.load_config({"BUCKET_NAME": "json-bucket/records", "GEOJSON_BUCKET_NAME": "geojson-bucket",
+                              "BASE_URL": "https://gn", "GN_JSON_RECORD_URL_START": "https://gn/records/"})
+    assert app.geojson_location(config) == ("geojson-bucket", "records")
+
+
+def test_queue_batches_report_only_the_failed_messages_for_redelivery(fake_s3, http_session, mocker):
+    queue = InMemoryQueue(batch_size=4, max_receives=2)
+    mocker.patch.object(app, "get_sqs_client", return_value=queue)
+    mocker.patch.object(app, "HARVEST_QUEUE_URL", "https://sqs.example/harvest")
+    fake_s3.put_object(Bucket="geojson-bucket", Key="records/gone.geojson", Body=b"{}")
+
+    def fake_get(url, headers=None, **kwargs):
+        if "status/change" in url:
+            return FakeResponse(json.dumps({"records": [
+                {"uuid": uuid, "status": "updated", "lastModifiedTime": "2022-04-13T10:00:00Z"} for uuid in ("a", "b", "bad")
+            ] + [{"uuid": "gone", "status": "deleted", "lastModifiedTime": "2022-04-13T10:00:00Z"}]}))
+        if "/bad/" in url:
+            return FakeResponse("Not Found", status_code=404)
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+
+    # The scheduled run only queues the records
+    body = json.loads(app.lambda_handler({"queryStringParameters": {"fromDateTime": "2022-04-13T00:00:00Z"}}, None)["body"])
+    assert "4 record(s) queued" in body["message"]
+    assert not any(key.startswith("records/") for key in fake_s3.keys("json-bucket"))
+
+    queue.send({"uuid": "a", "action": "insert"})
+    queue.send({"action": "insert"})
+    responses = queue.deliver(app.lambda_handler)
+
+    failed = [item["itemIdentifier"] for response in responses for item in response["batchItemFailures"]]
+    assert sorted(failed) == ["msg-3", "msg-6"]
+    assert fake_s3.keys("json-bucket", "records/") == ["records/a.json", "records/b.json"]
+    assert fake_s3.keys("geojson-bucket") == []
+    # Only the failed messages come back, until they are dead-lettered
+    assert queue.drain(app.lambda_handler) == 1
+    assert sorted(message[0] for message in queue.dead_letters) == ["msg-3", "msg-6"]
+
+
+def test_queue_records_without_a_message_id_are_skipped(fake_s3, http_session):
+    http_session.get.side_effect = lambda url, headers=None, **kwargs: FakeResponse(json.dumps({"url": url}))
+    event = InMemoryQueue().event([("msg-1", json.dumps({"uuid": "a"}), 1), (None, "not json", 1)])
+    del event["Records"][1]["messageId"]
+
+    response = app.lambda_handler(event, None)
+
+    assert response == {"batchItemFailures": []}
+    assert fake_s3.keys("json-bucket", "records/") == ["records/a.json"]
+
+
+def test_concurrent_claims_get_disjoint_leases_that_expire(fake_s3, mocker):
+    uuids = ["uuid-%d" % i for i in range(50)]
+    claims = {}
+
+    def claim(owner):
+        claims[owner] = app.S3LeaseStore(retries=50).claim(owner, uuids, 60)
+
+    threads = [threading.Thread(target=claim, args=("run-%d" % i,)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    claimed = [uuid for owner_claims in claims.values() for uuid in owner_claims]
+    assert sorted(claimed) == sorted(uuids)
+    # The claims of a run that never released them expire
+    owner = next(owner for owner, owner_claims in claims.items() if owner_claims)
+    mocker.patch.object(app.time, "time", return_value=time.time() + 61)
+    assert app.S3LeaseStore().claim("run-new", claims[owner], 60) == claims[owner]
+
+
+def test_contending_runs_never_share_a_lease_and_leave_unclaimed_uuids_pending(fake_s3, mocker):
+    mocker.patch.object(app, "LEASE_STORE", "s3")
+    uuids = ["%x%07d-uuid" % (i % 16, i) for i in range(64)]
+    results = {}
+    barrier = threading.Barrier(8)
+
+    def run(owner):
+        barrier.wait()
+        results[owner] = app.claim_uuids(uuids, owner)
+
+    threads = [threading.Thread(target=run, args=("run-%d" % i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    claimed = [uuid for mine, _ in results.values() for uuid in mine]
+    assert len(claimed) == len(set(claimed))
+    for mine, busy in results.values():
+        assert sorted(mine + busy) == sorted(uuids)
+    assert len(fake_s3.keys(*app.get_state_location(app.LEASES_NAME % "0"))) == 1
+    assert len([key for key in fake_s3.puts if "/leases/" in key]) >= 16
+
+
+def test_uuids_are_left_pending_when_the_leases_cannot_be_written(fake_s3, mocker):
+    mocker.patch.object(app, "LEASE_STORE", "s3")
+    mocker.patch.object(app.time, "sleep")
+    conflict = ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+    mocker.patch.object(app, "write_state_object", side_effect=conflict)
+
+    assert app.claim_uuids(["a1", "b2"], "run-1") == ([], ["a1", "b2"])
+
+    store = mocker.MagicMock()
+    store.claim.side_effect = RuntimeError("lease store unreachable")
+    mocker.patch.object(app, "get_lease_store", return_value=store)
+    assert app.claim_uuids(["a1"], "run-1") == ([], ["a1"])
+
+
+def test_overlapping_runs_harvest_each_record_once(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "LEASE_STORE", "local")
+    uuids = ["uuid-%d" % i for i in range(12)]
+    fetched = []
+    started = threading.Event()
+
+    def fake_get(url, headers=None, **kwargs):
+        fetched.append(url)
+        started.set()
+        time.sleep(0.05)
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+    harvest = lambda: app.harvest_uuids(uuids, "https://gn/records/", "/formatters/json", "json-bucket",
+                                        "ca-central-1", bucket_folder_path="records", workers=2)
+    results = []
+    first = threading.Thread(target=lambda: results.append(harvest()))
+    first.start()
+    started.wait()
+    error_msg, stats = harvest()
+    first.join()
+
+    # The second run leaves the records claimed by the first one pending
+    assert len(fetched) == len(set(fetched)) == 12
+    assert stats["harvested"] + results[0][1]["harvested"] == 12
+    assert sorted(stats["pending"] + results[0][1]["pending"]) == sorted(uuids)
+    assert app.get_lease_store().leases == {}
+
+
+def test_streamed_uuids_are_claimed_in_chunks_as_they_are_read(fake_s3, http_session, mocker):
+    mocker.patch.object(app, "LEASE_STORE", "local")
+    mocker.patch.object(app, "LEASE_CLAIM_CHUNK_SIZE", 2)
+    claim = mocker.spy(app, "claim_uuids")
+    read = []
+    read_at_fetch = []
+
+    def stream():
+        for i in range(10):
+            read.append(i)
+            yield "uuid-%d" % i
+
+    def fake_get(url, headers=None, **kwargs):
+        read_at_fetch.append(len(read))
+        return FakeResponse(json.dumps({"url": url}))
+
+    http_session.get.side_effect = fake_get
+    error_msg, stats = app.harvest_uuids(stream(), "https://gn/records/", "/formatters/json", "json-bucket",
+                                         "ca-central-1", bucket_folder_path="records", workers=1)
+
+    assert stats["harvested"] == 10
+    assert read_at_fetch[0] == 2
+    assert [len(call.args[0]) for call in claim.call_args_list] == [2] * 5
+    assert app.get_lease_store().leases == {}
+
+
+def test_wide_ranges_are_read_in_adaptive_concurrent_windows(http_session, mocker):
+    mocker.patch.object(app, "CHANGE_FEED_WINDOW_RECORDS", 10)
+    mocker.patch.object(app, "CHANGE_FEED_CONCURRENCY", 3)
+    app.start_run_metrics()
+    # A sparse year, then dense months
+    records = [{"uuid": "sparse-%d" % i, "status": "updated", "lastModifiedTime": "2021-%02d-10T00:00:00Z" % (i + 1)}
+               for i in range(12)]
+    records += [{"uuid": "dense-%d" % i, "status": "updated", "lastModifiedTime": "%d-%02d-%02dT%02d:00:00Z" % (
+                 2022 + (2 + i % 16) // 12, (2 + i % 16) % 12 + 1, 1 + i % 28, i % 24)} for i in range(1200)]
+    records += [{"uuid": "dense-1", "status": "deleted", "lastModifiedTime": "2023-09-30T00:00:00Z"}]
+    queries = []
+    failed_once = []
+
+    def fake_get(url, headers=None, **kwargs):
+        params = kwargs["params"]
+        queries.append((params["dateFrom"], params["dateTo"]))
+        if not failed_once and params["dateFrom"] <= "2021-06-10T00:00:00Z" <= params["dateTo"]:
+            failed_once.append(params)
+            return FakeResponse("Gateway Timeout", status_code=504)
+        return FakeResponse(json.dumps({"records": in_window(records, params)}))
+
+    http_session.get.side_effect = fake_get
+    mocker.patch.object(app, "GN_MAX_RETRIES", 0)
+
+    feed = app.open_change_feed("https://gn/records/status/change", fromDateTime="2021-01-01T00:00:00Z",
+                                toDateTime="2023-12-01T00:00:00Z")
+    changes = feed.classify()
+
+    assert isinstance(feed, app.PartitionedChangeFeed)
+    assert changes.error is None
+    assert changes.inserted == {record["uuid"] for record in records} - {"dense-1"}
+    assert changes.deleted == {"dense-1"}
+    assert changes.latest == "2023-09-30T00:00:00Z"
+    # The failed window is read again in halves, the dense months in windows narrower than 7 days
+    assert app.metrics().counters["ChangeFeedSplits"] == 1
+    widths = [app.parse_utc(end) - app.parse_utc(start) for start, end in queries]
+    assert max(widths) > app.datetime.timedelta(days=7) > min(widths)
+    assert queries[0][0] == "2021-01-01T00:00:00Z" and max(end for _, end in queries) == "2023-12-01T00:00:00Z"